@@ -0,0 +1,166 @@
+'''
+Shared OpenAI-compatible clients for every LLM backend and for the evaluator.
+
+One endpoint per (base_url, key) holds a sync and an async client over keep-alive httpx pools, a bound on the
+requests in flight to it, and a retry budget. request / async_request run one call with jittered exponential
+backoff: a retry is only made while the endpoint has budget left, which every success refills a little, so a
+failing endpoint is not hammered by all the workers retrying at once. Errors are raised to the caller, never
+handled interactively.
+'''
+import os
+import time
+import random
+import asyncio
+import threading
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+MAX_CONCURRENCY = 16
+MAX_RETRIES = 5
+BACKOFF_MIN = 1
+BACKOFF_MAX = 40
+# retries allowed per success, and the retries an endpoint may bank
+RETRY_RATIO = 0.2
+RETRY_BUDGET = 10
+
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError,
+                    openai.InternalServerError)
+
+
+def configure(max_concurrency=None, max_retries=None):
+    '''
+    Process-wide limits, for the endpoints created afterwards
+    '''
+    global MAX_CONCURRENCY, MAX_RETRIES
+    if max_concurrency is not None:
+        MAX_CONCURRENCY = max_concurrency
+    if max_retries is not None:
+        MAX_RETRIES = max_retries
+
+
+def backoff_delay(attempt):
+    '''
+    Jittered exponential backoff: uniform in [BACKOFF_MIN, min(BACKOFF_MAX, BACKOFF_MIN * 2 ** attempt)]
+    '''
+    return random.uniform(BACKOFF_MIN, min(BACKOFF_MAX, BACKOFF_MIN * 2 ** attempt))
+
+
+class endpoint:
+    def __init__(self, base_url=None, key=None, max_concurrency=None):
+        max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self.base_url = base_url
+        self.key = key
+        self.max_concurrency = max_concurrency
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        # retries are done here, with the budget, not by the openai client
+        self.client = OpenAI(base_url=base_url, api_key=key, max_retries=0,
+                             http_client=httpx.Client(limits=limits, timeout=httpx.Timeout(600, connect=10)))
+        self._async_client = None
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.async_semaphores = {}
+        self.retry_tokens = RETRY_BUDGET
+        self.lock = threading.Lock()
+
+    @property
+    def async_client(self):
+        with self.lock:
+            if self._async_client is None:
+                limits = httpx.Limits(max_connections=self.max_concurrency,
+                                      max_keepalive_connections=self.max_concurrency)
+                self._async_client = AsyncOpenAI(
+                    base_url=self.base_url, api_key=self.key, max_retries=0,
+                    http_client=httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600, connect=10)))
+            return self._async_client
+
+    def async_semaphore(self):
+        # an asyncio.Semaphore belongs to one event loop
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            semaphore = self.async_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self.async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return semaphore
+
+    def succeeded(self):
+        with self.lock:
+            self.retry_tokens = min(RETRY_BUDGET, self.retry_tokens + RETRY_RATIO)
+
+    def may_retry(self, attempt, error):
+        if attempt >= MAX_RETRIES or not isinstance(error, RETRYABLE_ERRORS):
+            return False
+        with self.lock:
+            if self.retry_tokens < 1:
+                return False
+            self.retry_tokens -= 1
+            return True
+
+    def request(self, call):
+        '''
+        call(client) -> result, run with at most max_concurrency others in flight and retried on transient errors
+        '''
+        attempt = 0
+        while True:
+            try:
+                with self.semaphore:
+                    result = call(self.client)
+                self.succeeded()
+                return result
+            except Exception as e:
+                if not self.may_retry(attempt, e):
+                    raise
+                print(f"{self.base_url or 'openai'}: {e!r}, retry {attempt + 1}")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    async def async_request(self, call):
+        '''
+        await call(async_client) -> result, like request
+        '''
+        attempt = 0
+        while True:
+            try:
+                async with self.async_semaphore():
+                    result = await call(self.async_client)
+                self.succeeded()
+                return result
+            except Exception as e:
+                if not self.may_retry(attempt, e):
+                    raise
+                print(f"{self.base_url or 'openai'}: {e!r}, retry {attempt + 1}")
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+_endpoints_pid = os.getpid()
+
+
+def get_endpoint(base_url=None, key=None):
+    global _endpoints, _endpoints_pid
+    with _endpoints_lock:
+        if _endpoints_pid != os.getpid():
+            # connections are not shared with a forked parent
+            _endpoints, _endpoints_pid = {}, os.getpid()
+        entry = _endpoints.get((base_url, key))
+        if entry is None:
+            entry = _endpoints[(base_url, key)] = endpoint(base_url, key)
+        return entry
+
+
+def get_client(base_url=None, key=None):
+    return get_endpoint(base_url, key).client
+
+
+def get_async_client(base_url=None, key=None):
+    return get_endpoint(base_url, key).async_client
+
+
+def request(base_url, key, call):
+    return get_endpoint(base_url, key).request(call)
+
+
+async def async_request(base_url, key, call):
+    return await get_endpoint(base_url, key).async_request(call)
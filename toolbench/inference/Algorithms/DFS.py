@@ -3,24 +3,37 @@ from Tree.Tree import my_tree, tree_node
 from Prompts.ReAct_prompts import FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION, FORMAT_INSTRUCTIONS_USER_FUNCTION
 from Prompts.Tree_search_prompts import DIVERSITY_PROMPT
 from Algorithms.base_search import base_search_method
-from copy import deepcopy
-from LLM_rank.rank_candidate import sum_based_rankn, rank2_subfix
+from Downstream_tasks.base_env import early_tool_calls
+from LLM_rank.rank_candidate import RANK_STRATEGIES, rank_memo, rank2_subfix
 import json
+import copy
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 
 class DFS_tree_search(base_search_method):
 
-    def __init__(self, llm, io_func, process_id=0, callbacks=None):
+    def __init__(self, llm, io_func, process_id=0, callbacks=None, expand_workers=1, rank_strategy="sum",
+                 tool_call_workers=1, stream_tool_calls=False):
         super(DFS_tree_search, self).__init__(
             llm, io_func, process_id, callbacks)
         """Depth-first search. 
         with_filter=True: Every time a child node is generated, choose the best multiple iterations to go.
         with_filter=False: Do as Preorder traversal.
+        expand_workers > 1: with_filter=True generates the children of a node, and ranks them, concurrently.
+        rank_strategy: how with_filter=True orders the children, see LLM_rank.rank_candidate.RANK_STRATEGIES.
+        tool_call_workers > 1: the tool calls of one assistant message are sent concurrently.
+        stream_tool_calls: with an llm that supports it, a tool call is sent as soon as it is generated, while the
+        rest of the message is still being generated.
         """
         self.io_func = io_func
         self.llm = llm
         self.process_id = process_id
+        self.expand_workers = expand_workers
+        assert rank_strategy in RANK_STRATEGIES, f"unknown rank_strategy {rank_strategy}"
+        self.rank_strategy = rank_strategy
+        self.tool_call_workers = tool_call_workers
+        self.stream_tool_calls = stream_tool_calls and getattr(llm, "supports_tool_call_stream", False)
         self.restart()
 
         self.callbacks = callbacks if callbacks is not None else []
@@ -30,6 +43,7 @@ class DFS_tree_search(base_search_method):
         self.terminal_node = []
         self.give_up_node = []
         self.now_expand_num = 0
+        self.rank_memo = rank_memo()
         self.query_count = 0
         self.total_tokens = 0
 
@@ -103,7 +117,7 @@ class DFS_tree_search(base_search_method):
             self.forward_args.pop("self")
         self.tree = my_tree()
         self.tree.root.node_type = "Action Input"
-        self.tree.root.io_state = deepcopy(self.io_func)
+        self.tree.root.io_state = self.io_func.fork()
 
         system = FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION
         system = system.replace("{task_description}",
@@ -117,6 +131,247 @@ class DFS_tree_search(base_search_method):
 
         return self.DFS(self.tree.root, single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter)
 
+    def get_diversity_message(self, temp_now_node):
+        '''
+        If a node already has children, a user message listing their actions so the model generates a different one
+        '''
+        if len(temp_now_node.children) == 0:
+            return None
+        former_candidates_des = ""
+        js_list = []
+        for k, child in enumerate(temp_now_node.children):
+            temp_node = child
+            while not temp_node.is_terminal and temp_node.node_type != "Action Input" and len(temp_node.children) > 0:
+                temp_node = temp_node.children[0]
+            if temp_node.node_type == "Action Input":
+                obj_dict = {
+                    "name": temp_node.father.description,
+                    "arguments": temp_node.description,
+                    "function_output": temp_node.observation,
+                    "mento-carlo-action-value": temp_node.compute_weight(),
+                }
+                js_list.append(obj_dict)
+
+        if len(js_list) == 0:
+            return None
+        former_candidates_des = former_candidates_des + \
+            f"{json.dumps(js_list,indent=2)}\n"
+        if temp_now_node.observation != "":
+            former_candidates_des = former_candidates_des + \
+                f"again, your former observation: {temp_now_node.observation}\n"
+        diverse_prompt = DIVERSITY_PROMPT
+        diverse_prompt = diverse_prompt.replace(
+            "{previous_candidate}", former_candidates_des)
+        return {"role": "user", "content": diverse_prompt}
+
+    def run_step(self, i, io_state, action_name, action_input):
+        '''
+        Run the i-th tool call of a message on a fork of io_state, returns (new io_state, observation, status)
+        '''
+        child_io_state = io_state.fork()
+        observation, status = child_io_state.step(
+            action_name=action_name, action_input=action_input)
+        return child_io_state, observation, status
+
+    def attach_new_message(self, temp_now_node, new_message, error_code, now_depth, final_answer_back_length, run_step):
+        '''
+        Parse the assistant message into Thought / Action / Action Input nodes under temp_now_node, running its tool
+        calls with run_step. Returns the last node and the agent block ids of the callbacks.
+        '''
+        agent_block_ids = []
+        # parse nodes from OpenAI-message like CoT method
+        assert new_message["role"] == "assistant"
+        if "content" in new_message.keys() and new_message["content"] != None:
+            temp_node = tree_node()
+            temp_node.node_type = "Thought"
+            temp_node.description = new_message["content"]
+            child_io_state = temp_now_node.io_state.fork()
+
+            temp_node.io_state = child_io_state
+            temp_node.is_terminal = child_io_state.check_success() != 0
+            temp_node.messages = temp_now_node.messages.fork()
+            temp_node.father = temp_now_node
+            temp_now_node.children.append(temp_node)
+            temp_node.print(self.process_id)
+            temp_now_node = temp_node
+
+            if error_code != 0:
+                temp_now_node.observation_code = error_code
+                temp_now_node.pruned = True
+
+        # if "function_call" in new_message.keys():
+        if "tool_calls" in new_message.keys() and new_message["tool_calls"] != None and len(new_message["tool_calls"]) > 0:
+            tool_calls = new_message["tool_calls"]
+            if self.process_id == 0:
+                print("number of parallel calls:",len(tool_calls))
+
+            for i in range(len(tool_calls)):
+            # on_agent_action
+                agent_block_ids = [callback.on_agent_action(
+                    depth=now_depth,
+                    # action=new_message["function_call"]["name"],
+                    action=tool_calls[i]["function"]["name"],
+                    # action_input=new_message["function_call"]["arguments"]
+                    action_input=tool_calls[i]["function"]["arguments"]
+                ) for callback in self.callbacks]
+                # function_name = new_message["function_call"]["name"]
+                function_name = tool_calls[i]["function"]["name"]
+                temp_node = tree_node()
+                temp_node.node_type = "Action"
+                temp_node.description = function_name
+                child_io_state = temp_now_node.io_state.fork()
+
+                temp_node.io_state = child_io_state
+                temp_node.is_terminal = child_io_state.check_success() != 0
+                temp_node.messages = temp_now_node.messages.fork()
+                temp_node.father = temp_now_node
+                temp_now_node.children.append(temp_node)
+
+                temp_node.print(self.process_id)
+                temp_now_node = temp_node
+
+                # function_input = new_message["function_call"]["arguments"]
+                function_input = tool_calls[i]["function"]["arguments"]
+                temp_node = tree_node()
+                temp_node.node_type = "Action Input"
+                temp_node.description = function_input
+
+                # on_tool_start
+                [callback.on_tool_start(
+                    depth=now_depth,
+                    tool_name=temp_now_node.description,
+                    tool_input=function_input
+                ) for callback in self.callbacks]
+                child_io_state, observation, status = run_step(
+                    i, temp_now_node.io_state, temp_now_node.description, function_input)
+                temp_node.observation = observation
+                temp_node.observation_code = status
+
+                temp_node.io_state = child_io_state
+                temp_node.is_terminal = child_io_state.check_success() != 0
+                temp_node.messages = temp_now_node.messages.fork()
+                temp_node.father = temp_now_node
+                temp_now_node.children.append(temp_node)
+                temp_node.print(self.process_id)
+                temp_now_node = temp_node
+                # on_tool_end
+                [callback.on_tool_end(
+                    depth=now_depth,
+                    output=observation,
+                    status=status
+                ) for callback in self.callbacks]
+                if status != 0:
+                    # return code defination can be seen in Downstream_tasks/rapid_api
+                    if status == 4:
+                        temp_now_node.pruned = True
+                    elif status == 1:  # hallucination api name
+                        # assert "function_call" in new_message.keys()
+                        # new_message["function_call"]["name"] = "invalid_hallucination_function_name"
+                        assert "tool_calls" in new_message.keys() and len(new_message["tool_calls"]) > 0
+                        tool_calls[i]["function"]["name"] = "invalid_hallucination_function_name"
+                    elif status == 3:  # final answer
+                        temp_now_node.is_terminal = True
+                        temp_now_node.make_finish(final_answer_back_length)
+                if i == 0:
+                    temp_now_node.messages.append(new_message)
+                if temp_now_node.node_type == "Action Input":
+                    temp_now_node.messages.append({
+                        # "role": "function",
+                        # "name": new_message["function_call"]["name"],
+                        # "content": temp_now_node.observation,
+                        "role":"tool",
+                        # "name": new_message["function_call"]["name"],
+                        "name": tool_calls[i]["function"]["name"],
+                        "content": temp_now_node.observation,
+                        "tool_call_id": tool_calls[i]['id'],
+                    })
+        else:
+            temp_now_node.messages.append(new_message)
+        return temp_now_node, agent_block_ids
+
+    def generate_child(self, llm, messages, io_state, run_tools):
+        '''
+        The llm call and the tool calls of one beam child, run in a worker thread. It does not touch the tree: the
+        tool calls run on forks of io_state and the nodes are attached later on the main thread.
+        '''
+        llm.change_messages(messages)
+        new_message, error_code, total_tokens, early_calls = self.parse(llm, io_state, run_tools)
+        new_message = {k:v for k,v in new_message.items() if v != None}
+        steps = []
+        if run_tools and new_message.get("tool_calls"):
+            steps = self.run_tool_calls(io_state, new_message["tool_calls"], early_calls)
+        return new_message, error_code, total_tokens, steps
+
+    def parse(self, llm, io_state, send_early):
+        '''
+        llm.parse, streamed when stream_tool_calls and send_early: the tool calls then start on io_state while the
+        message is generated. Returns the parse result and the early_tool_calls, or None.
+        '''
+        if not (self.stream_tool_calls and send_early):
+            return (*llm.parse(self.io_func.functions, process_id=self.process_id), None)
+        early_calls = early_tool_calls(io_state, self.tool_call_workers)
+        return (*llm.parse(self.io_func.functions, process_id=self.process_id, on_tool_call=early_calls.submit),
+                early_calls)
+
+    def run_tool_calls(self, io_state, tool_calls, early_calls=None):
+        '''
+        All the tool calls of a message at once, at most tool_call_workers at the same time, reusing the ones
+        early_calls already sent
+        '''
+        tool_calls = [(tool_call["function"]["name"], tool_call["function"]["arguments"]) for tool_call in tool_calls]
+        if early_calls is not None:
+            return early_calls.results(tool_calls)
+        return io_state.run_tool_calls(tool_calls, workers=self.tool_call_workers)
+
+    def expand_concurrently(self, now_node, next_tree_split_nodes, tree_beam_size, max_query_count, final_answer_back_length):
+        '''
+        with_filter only: generate the tree_beam_size children of now_node at the same time, with at most
+        expand_workers llm calls in flight. All the children see the same diversity message, built from the children
+        now_node had before. The children are then attached, and the callbacks fired, in order on this thread.
+        Returns a value for DFS to return, or None.
+        '''
+        diversity_message = self.get_diversity_message(now_node)
+        if diversity_message is not None:
+            now_node.messages.append(diversity_message)
+        messages = now_node.messages.to_list()
+        # like the sequential loop: at least one call, and the call reaching max_query_count is the last one
+        child_count = min(tree_beam_size, max(1, max_query_count - self.query_count))
+        with ThreadPoolExecutor(max_workers=self.expand_workers) as executor:
+            futures = [executor.submit(
+                self.generate_child, copy.copy(self.llm), list(messages), now_node.io_state,
+                self.query_count + j + 1 < max_query_count) for j in range(child_count)]
+            results = [future.result() for future in futures]
+
+        # We need to exclude the diversity_message, because it will influence child nodes
+        if diversity_message is not None:
+            now_node.messages[-1]["valid"] = False
+
+        now_depth = now_node.get_depth() // 3
+        for new_message, error_code, total_tokens, steps in results:
+            chain_block_ids = [callback.on_chain_start(
+                depth=now_depth,
+                inputs=list(now_node.messages)
+            ) for callback in self.callbacks]
+            [callback.on_llm_start(
+                depth=now_depth,
+                messages=list(now_node.messages)
+            ) for callback in self.callbacks]
+            [callback.on_llm_end(
+                depth=now_depth,
+                response=new_message
+            ) for callback in self.callbacks]
+            self.query_count += 1
+            self.total_tokens += total_tokens
+            if self.query_count >= max_query_count:  # a big return value will cause the Algo to exit
+                return 100000
+            temp_now_node, agent_block_ids = self.attach_new_message(
+                now_node, new_message, error_code, now_depth, final_answer_back_length,
+                lambda i, io_state, action_name, action_input: steps[i])
+            next_tree_split_nodes.append(temp_now_node)
+            self.send_agent_chain_end(
+                now_depth, agent_block_ids, chain_block_ids)
+        return None
+
     def DFS(self, now_node, single_chain_max_step, tree_beam_size, max_query_count, answer, with_filter=True):
         """Returns the number of grids to go back. When a child node of a node generates a final answer or give up, it should go back a few more grids
         In a sense, the larger this value is, the more diverse it is, and it is GreedySearch@n when it is enlarged to infinity.
@@ -142,201 +397,77 @@ class DFS_tree_search(base_search_method):
                     return 1
 
         next_tree_split_nodes = []
-        for i in range(tree_beam_size):
-            temp_now_node = now_node
-
-            """If a node have children now, We will prompt the model to generate different nodes than all the existing nodes"""
-            delete_former_diversity_message = False
-            diversity_message = None
-            if len(temp_now_node.children) > 0:
-
-                former_candidates_des = ""
-                js_list = []
-                for k, child in enumerate(temp_now_node.children):
-                    temp_node = child
-                    while not temp_node.is_terminal and temp_node.node_type != "Action Input" and len(temp_node.children) > 0:
-                        temp_node = temp_node.children[0]
-                    if temp_node.node_type == "Action Input":
-                        obj_dict = {
-                            "name": temp_node.father.description,
-                            "arguments": temp_node.description,
-                            "function_output": temp_node.observation,
-                            "mento-carlo-action-value": temp_node.compute_weight(),
-                        }
-                        js_list.append(obj_dict)
-
-                if len(js_list) > 0:
-                    former_candidates_des = former_candidates_des + \
-                        f"{json.dumps(js_list,indent=2)}\n"
-                    if temp_now_node.observation != "":
-                        former_candidates_des = former_candidates_des + \
-                            f"again, your former observation: {temp_now_node.observation}\n"
-                    diverse_prompt = DIVERSITY_PROMPT
-                    diverse_prompt = diverse_prompt.replace(
-                        "{previous_candidate}", former_candidates_des)
-                    diversity_message = {
-                        "role": "user", "content": diverse_prompt}
-                    temp_now_node.messages.append(diversity_message)
-
-                    delete_former_diversity_message = True
-            # on_chain_start
-            now_depth = temp_now_node.get_depth() // 3
-            chain_block_ids = [callback.on_chain_start(
-                depth=now_depth,
-                inputs=temp_now_node.messages
-            ) for callback in self.callbacks]
-            agent_block_ids = []
-            self.llm.change_messages(temp_now_node.messages)
-            # on_llm_start
-            [callback.on_llm_start(
-                depth=now_depth,
-                messages=temp_now_node.messages
-            ) for callback in self.callbacks]
-            new_message, error_code, total_tokens = self.llm.parse(
-                self.io_func.functions, process_id=self.process_id)
-            new_message = {k:v for k,v in new_message.items() if v != None}
-            # on_llm_end
-            [callback.on_llm_end(
-                depth=now_depth,
-                response=new_message
-            ) for callback in self.callbacks]
-            self.query_count += 1
-            self.total_tokens += total_tokens
-            if self.query_count >= max_query_count:  # a big return value will cause the Algo to exit
-                return 100000
-
-            # We need to exclude the diversity_message, because it will influence child nodes
-            if delete_former_diversity_message:
-                temp_now_node.messages[-1]["valid"] = False
-
-            # parse nodes from OpenAI-message like CoT method
-            assert new_message["role"] == "assistant"
-            if "content" in new_message.keys() and new_message["content"] != None:
-                temp_node = tree_node()
-                temp_node.node_type = "Thought"
-                temp_node.description = new_message["content"]
-                child_io_state = deepcopy(temp_now_node.io_state)
-                child_io_state.retriever=None
-
-                temp_node.io_state = child_io_state
-                temp_node.is_terminal = child_io_state.check_success() != 0
-                temp_node.messages = deepcopy(temp_now_node.messages)
-                temp_node.father = temp_now_node
-                temp_now_node.children.append(temp_node)
-                temp_node.print(self.process_id)
-                temp_now_node = temp_node
+        if with_filter and self.expand_workers > 1 and tree_beam_size > 1:
+            return_value = self.expand_concurrently(
+                now_node, next_tree_split_nodes, tree_beam_size, max_query_count, final_answer_back_length)
+            if return_value is not None:
+                return return_value
+        else:
+            for i in range(tree_beam_size):
+                temp_now_node = now_node
 
-                if error_code != 0:
-                    temp_now_node.observation_code = error_code
-                    temp_now_node.pruned = True
-
-            # if "function_call" in new_message.keys():
-            if "tool_calls" in new_message.keys() and new_message["tool_calls"] != None and len(new_message["tool_calls"]) > 0:
-                tool_calls = new_message["tool_calls"]
-                if self.process_id == 0:
-                    print("number of parallel calls:",len(tool_calls))
-
-                for i in range(len(tool_calls)):
-                # on_agent_action
-                    agent_block_ids = [callback.on_agent_action(
-                        depth=now_depth,
-                        # action=new_message["function_call"]["name"],
-                        action=tool_calls[i]["function"]["name"],
-                        # action_input=new_message["function_call"]["arguments"]
-                        action_input=tool_calls[i]["function"]["arguments"]
-                    ) for callback in self.callbacks]
-                    # function_name = new_message["function_call"]["name"]
-                    function_name = tool_calls[i]["function"]["name"]
-                    temp_node = tree_node()
-                    temp_node.node_type = "Action"
-                    temp_node.description = function_name
-                    child_io_state = deepcopy(temp_now_node.io_state)
-                    child_io_state.retriever=None
-
-                    temp_node.io_state = child_io_state
-                    temp_node.is_terminal = child_io_state.check_success() != 0
-                    temp_node.messages = deepcopy(temp_now_node.messages)
-                    temp_node.father = temp_now_node
-                    temp_now_node.children.append(temp_node)
-
-                    temp_node.print(self.process_id)
-                    temp_now_node = temp_node
-
-                    # function_input = new_message["function_call"]["arguments"]
-                    function_input = tool_calls[i]["function"]["arguments"]
-                    temp_node = tree_node()
-                    temp_node.node_type = "Action Input"
-                    temp_node.description = function_input
-                    child_io_state = deepcopy(temp_now_node.io_state)
-                    child_io_state.retriever=None
-                    
-                    # on_tool_start
-                    [callback.on_tool_start(
-                        depth=now_depth,
-                        tool_name=temp_now_node.description,
-                        tool_input=function_input
-                    ) for callback in self.callbacks]
-                    observation, status = child_io_state.step(
-                        action_name=temp_now_node.description, action_input=function_input)
-                    temp_node.observation = observation
-                    temp_node.observation_code = status
-
-                    temp_node.io_state = child_io_state
-                    temp_node.is_terminal = child_io_state.check_success() != 0
-                    temp_node.messages = deepcopy(temp_now_node.messages)
-                    temp_node.father = temp_now_node
-                    temp_now_node.children.append(temp_node)
-                    temp_node.print(self.process_id)
-                    temp_now_node = temp_node
-                    # on_tool_end
-                    [callback.on_tool_end(
-                        depth=now_depth,
-                        output=observation,
-                        status=status
-                    ) for callback in self.callbacks]
-                    if status != 0:
-                        # return code defination can be seen in Downstream_tasks/rapid_api
-                        if status == 4:
-                            temp_now_node.pruned = True
-                        elif status == 1:  # hallucination api name
-                            # assert "function_call" in new_message.keys()
-                            # new_message["function_call"]["name"] = "invalid_hallucination_function_name"
-                            assert "tool_calls" in new_message.keys() and len(new_message["tool_calls"]) > 0
-                            tool_calls[i]["function"]["name"] = "invalid_hallucination_function_name"
-                        elif status == 3:  # final answer
-                            temp_now_node.is_terminal = True
-                            temp_now_node.make_finish(final_answer_back_length)
-                    if i == 0:
-                        temp_now_node.messages.append(new_message)
-                    if temp_now_node.node_type == "Action Input":
-                        temp_now_node.messages.append({
-                            # "role": "function",
-                            # "name": new_message["function_call"]["name"],
-                            # "content": temp_now_node.observation,
-                            "role":"tool",
-                            # "name": new_message["function_call"]["name"],
-                            "name": tool_calls[i]["function"]["name"],
-                            "content": temp_now_node.observation,
-                            "tool_call_id": tool_calls[i]['id'],
-                        })
-            else:
-                temp_now_node.messages.append(new_message)
-            return_value = None
-            if not with_filter:  # DFSDT
-                result = self.DFS(temp_now_node, single_chain_max_step,
-                                  tree_beam_size, max_query_count, answer, with_filter)
-                if len(self.terminal_node) >= answer:
-                    return_value = 10000
-                elif result > 1:
-                    return_value = result-1
+                """If a node have children now, We will prompt the model to generate different nodes than all the existing nodes"""
+                diversity_message = self.get_diversity_message(temp_now_node)
+                delete_former_diversity_message = diversity_message is not None
+                if delete_former_diversity_message:
+                    temp_now_node.messages.append(diversity_message)
+                # on_chain_start
+                now_depth = temp_now_node.get_depth() // 3
+                chain_block_ids = [callback.on_chain_start(
+                    depth=now_depth,
+                    inputs=list(temp_now_node.messages)
+                ) for callback in self.callbacks]
+                agent_block_ids = []
+                self.llm.change_messages(temp_now_node.messages.to_list())
+                # on_llm_start
+                [callback.on_llm_start(
+                    depth=now_depth,
+                    messages=list(temp_now_node.messages)
+                ) for callback in self.callbacks]
+                # the call reaching max_query_count is not stepped, nothing to send early
+                new_message, error_code, total_tokens, early_calls = self.parse(
+                    self.llm, temp_now_node.io_state, self.query_count + 1 < max_query_count)
+                new_message = {k:v for k,v in new_message.items() if v != None}
+                # on_llm_end
+                [callback.on_llm_end(
+                    depth=now_depth,
+                    response=new_message
+                ) for callback in self.callbacks]
+                self.query_count += 1
+                self.total_tokens += total_tokens
+                if self.query_count >= max_query_count:  # a big return value will cause the Algo to exit
+                    return 100000
+
+                # We need to exclude the diversity_message, because it will influence child nodes
+                if delete_former_diversity_message:
+                    temp_now_node.messages[-1]["valid"] = False
+
+                run_step = self.run_step
+                if early_calls is not None and new_message.get("tool_calls"):
+                    steps = self.run_tool_calls(temp_now_node.io_state, new_message["tool_calls"], early_calls)
+                    run_step = lambda i, io_state, action_name, action_input: steps[i]
+                elif self.tool_call_workers > 1 and len(new_message.get("tool_calls") or []) > 1:
+                    # independent calls of one message go out together, the nodes are attached in order
+                    steps = self.run_tool_calls(temp_now_node.io_state, new_message["tool_calls"])
+                    run_step = lambda i, io_state, action_name, action_input: steps[i]
+                temp_now_node, agent_block_ids = self.attach_new_message(
+                    temp_now_node, new_message, error_code, now_depth, final_answer_back_length, run_step)
+                return_value = None
+                if not with_filter:  # DFSDT
+                    result = self.DFS(temp_now_node, single_chain_max_step,
+                                      tree_beam_size, max_query_count, answer, with_filter)
+                    if len(self.terminal_node) >= answer:
+                        return_value = 10000
+                    elif result > 1:
+                        return_value = result-1
 
-            else:
+                else:
 
-                next_tree_split_nodes.append(temp_now_node)
-            self.send_agent_chain_end(
-                now_depth, agent_block_ids, chain_block_ids)
-            if return_value is not None:
-                return return_value
+                    next_tree_split_nodes.append(temp_now_node)
+                self.send_agent_chain_end(
+                    now_depth, agent_block_ids, chain_block_ids)
+                if return_value is not None:
+                    return return_value
 
         # Sort the generated next_tree_split_nodes nodes when normal DFS
         if len(next_tree_split_nodes) > 1:
@@ -347,8 +478,10 @@ class DFS_tree_search(base_search_method):
                 "process_id": self.process_id,
                 "task_description": self.io_func.task_description,
                 "rank_func": rank2_subfix,
+                "memo": self.rank_memo,
+                "workers": self.expand_workers,
             }
-            scores, rank_query_count, total_tokens = sum_based_rankn(
+            scores, rank_query_count, total_tokens = RANK_STRATEGIES[self.rank_strategy](
                 self.llm, LLM_rank_args=LLM_rank_args, candidates=next_tree_split_nodes)
             self.query_count += rank_query_count
             self.total_tokens += total_tokens
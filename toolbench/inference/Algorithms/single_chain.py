@@ -1,9 +1,9 @@
 import json
 import re
-from Tree.Tree import my_tree, tree_node
+from Tree.Tree import my_tree, tree_node, message_history
 from Prompts.ReAct_prompts import FORMAT_INSTRUCTIONS_SYSTEM_FUNCTION, FORMAT_INSTRUCTIONS_USER_FUNCTION
 from Algorithms.base_search import base_search_method
-from copy import deepcopy
+from Downstream_tasks.base_env import early_tool_calls
 from toolbench.inference.LLM.llama_model import LlamaModel
 
 def fix_brackets(json_str):
@@ -125,8 +125,10 @@ def attack_response(observation,attack_type="T1"):
 class single_chain(base_search_method):
     """Implement of CoT method
     """
-    def __init__(self,llm,io_func,extra_prefix="",process_id=0,attack = None,start_message_list=None):
-        """extra_prefix and start_message_list is used in Reflection Algo"""
+    def __init__(self,llm,io_func,extra_prefix="",process_id=0,attack = None,start_message_list=None,tool_call_workers=1,stream_tool_calls=False):
+        """extra_prefix and start_message_list is used in Reflection Algo
+        tool_call_workers > 1: the tool calls of one assistant message are sent concurrently
+        stream_tool_calls: with an llm that supports it, a tool call is sent as soon as it is generated"""
         super(single_chain, self).__init__(llm,io_func, process_id, callbacks=None)
         self.io_func = io_func
         self.llm = llm
@@ -134,6 +136,8 @@ class single_chain(base_search_method):
         self.start_message_list = start_message_list
         self.process_id = process_id
         self.attack = attack
+        self.tool_call_workers = tool_call_workers
+        self.stream_tool_calls = stream_tool_calls and getattr(llm, "supports_tool_call_stream", False)
 
         self.restart()
     def restart(self):
@@ -198,7 +202,7 @@ class single_chain(base_search_method):
                 print(f"[single_chain]try for the {i+1} time")
             self.tree = my_tree()
             self.tree.root.node_type = "Action Input"
-            self.tree.root.io_state = deepcopy(self.io_func)
+            self.tree.root.io_state = self.io_func.fork()
             out_node = self.do_chain(self.tree.root, single_chain_max_step)
             self.terminal_node.append(out_node)
             self.try_list.append(self.to_json_single())
@@ -225,14 +229,20 @@ class single_chain(base_search_method):
 
         else:
             """In Reflection Algo, we startswith former trials and reflections, so the caller will give the start messages"""
-            self.tree.root.messages = self.start_message_list
+            self.tree.root.messages = message_history(self.start_message_list)
         
         now_node = self.tree.root
         while True:
             # recursively parse message into nodes
-            self.llm.change_messages(now_node.messages)
+            self.llm.change_messages(now_node.messages.to_list())
+            early_calls = None
             if isinstance(self.llm, LlamaModel):
                 new_message,error_code,total_tokens = self.llm.parse(functions=self.io_func.functions,process_id=self.process_id)
+            elif self.stream_tool_calls:
+                early_calls = early_tool_calls(now_node.io_state, self.tool_call_workers)
+                new_message, error_code, total_tokens = self.llm.parse(tools=self.io_func.functions,
+                                                                   process_id=self.process_id,
+                                                                   on_tool_call=early_calls.submit)
             else:
                 new_message, error_code, total_tokens = self.llm.parse(tools=self.io_func.functions,
                                                                    process_id=self.process_id)
@@ -244,11 +254,11 @@ class single_chain(base_search_method):
                 temp_node = tree_node()
                 temp_node.node_type = "Thought"
                 temp_node.description = new_message["content"]
-                child_io_state = deepcopy(now_node.io_state)
+                child_io_state = now_node.io_state.fork()
                 
                 temp_node.io_state = child_io_state
                 temp_node.is_terminal = child_io_state.check_success() != 0 
-                temp_node.messages = now_node.messages.copy()
+                temp_node.messages = now_node.messages.fork()
                 temp_node.father = now_node
                 now_node.children.append(temp_node)
                 temp_node.print(self.process_id)
@@ -263,16 +273,25 @@ class single_chain(base_search_method):
                 tool_calls = new_message["tool_calls"]
                 if self.process_id == 0:
                     print("number of parallel calls:",len(tool_calls))
+                steps = None
+                if early_calls is not None:
+                    steps = early_calls.results(
+                        [(tool_call["function"]["name"], tool_call["function"]["arguments"]) for tool_call in tool_calls])
+                elif self.tool_call_workers > 1 and len(tool_calls) > 1:
+                    # independent calls go out together, the nodes are still attached one after another
+                    steps = now_node.io_state.run_tool_calls(
+                        [(tool_call["function"]["name"], tool_call["function"]["arguments"]) for tool_call in tool_calls],
+                        workers=self.tool_call_workers)
                 for i in range(len(tool_calls)):
                     function_name = tool_calls[i]["function"]["name"]
                     temp_node = tree_node()
                     temp_node.node_type = "Action"
                     temp_node.description = function_name
-                    child_io_state = deepcopy(now_node.io_state)
+                    child_io_state = now_node.io_state.fork()
 
                     temp_node.io_state = child_io_state
                     temp_node.is_terminal = child_io_state.check_success() != 0
-                    temp_node.messages = now_node.messages.copy()
+                    temp_node.messages = now_node.messages.fork()
                     temp_node.father = now_node
                     now_node.children.append(temp_node)
 
@@ -283,10 +302,13 @@ class single_chain(base_search_method):
                     temp_node = tree_node()
                     temp_node.node_type = "Action Input"
                     temp_node.description = function_input
-                    child_io_state = deepcopy(now_node.io_state)
+                    if steps is not None:
+                        child_io_state, observation, status = steps[i]
+                    else:
+                        child_io_state = now_node.io_state.fork()
 
-                    observation, status = child_io_state.step(action_name=now_node.description,
-                                                              action_input=function_input)
+                        observation, status = child_io_state.step(action_name=now_node.description,
+                                                                  action_input=function_input)
                     if self.attack and self.attack.startswith("T"):
                         temp_node.observation = attack_response(observation, self.attack)
                     else:
@@ -296,7 +318,7 @@ class single_chain(base_search_method):
 
                     temp_node.io_state = child_io_state
                     temp_node.is_terminal = child_io_state.check_success() != 0
-                    temp_node.messages = now_node.messages.copy()
+                    temp_node.messages = now_node.messages.fork()
                     temp_node.father = now_node
                     now_node.children.append(temp_node)
                     temp_node.print(self.process_id)
@@ -325,11 +347,11 @@ class single_chain(base_search_method):
                 temp_node = tree_node()
                 temp_node.node_type = "Action"
                 temp_node.description = function_name
-                child_io_state = deepcopy(now_node.io_state)
+                child_io_state = now_node.io_state.fork()
 
                 temp_node.io_state = child_io_state
                 temp_node.is_terminal = child_io_state.check_success() != 0
-                temp_node.messages = now_node.messages.copy()
+                temp_node.messages = now_node.messages.fork()
                 temp_node.father = now_node
                 now_node.children.append(temp_node)
 
@@ -343,7 +365,7 @@ class single_chain(base_search_method):
                 temp_node = tree_node()
                 temp_node.node_type = "Action Input"
                 temp_node.description = function_input
-                child_io_state = deepcopy(now_node.io_state)
+                child_io_state = now_node.io_state.fork()
 
                 observation, status = child_io_state.step(action_name=now_node.description,
                                                           action_input=function_input)
@@ -356,7 +378,7 @@ class single_chain(base_search_method):
 
                 temp_node.io_state = child_io_state
                 temp_node.is_terminal = child_io_state.check_success() != 0
-                temp_node.messages = now_node.messages.copy()
+                temp_node.messages = now_node.messages.fork()
                 temp_node.father = now_node
                 now_node.children.append(temp_node)
                 temp_node.print(self.process_id)
@@ -1,4 +1,84 @@
+import copy
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_tool_call_pools = {}
+_tool_call_pools_lock = threading.Lock()
+
+
+def get_tool_call_pool(workers):
+    '''
+    Process-wide thread pool for tool calls, shared by every search of the process
+    '''
+    with _tool_call_pools_lock:
+        pool = _tool_call_pools.get(workers)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tool_call")
+            _tool_call_pools[workers] = pool
+        return pool
+
+
+def same_tool_input(sent_input, action_input):
+    '''
+    Whether two tool inputs make the same call: the same text, or the same json as the tool service parses it.
+    A streamed call is sent with its bare json, the final message may keep the text around it.
+    '''
+    if sent_input == action_input:
+        return True
+    try:
+        return json.loads(sent_input) == json.loads(action_input)
+    except (ValueError, TypeError):
+        return False
+
+
+class early_tool_calls:
+    '''
+    Tool calls of an assistant message sent while the message is still being generated. submit is the
+    on_tool_call hook of a streaming llm.parse: every complete call other than Finish starts at once on a fork of
+    io_state. results then gives the same answer as io_state.run_tool_calls, reusing the calls already sent.
+    '''
+
+    def __init__(self, io_state, workers=1):
+        self.io_state = io_state
+        self.workers = max(1, workers)
+        self.sent = {}
+
+    def submit(self, index, action_name, action_input):
+        # Finish changes the node_state, it runs in order in results
+        if action_name == "Finish" or index in self.sent:
+            return
+        future = get_tool_call_pool(self.workers).submit(self.io_state.fork().step, action_name=action_name, action_input=action_input)
+        self.sent[index] = (action_name, action_input, future)
+
+    def results(self, tool_calls):
+        '''
+        tool_calls: [(action_name, action_input)] of the final message. A call sent with other arguments than the
+        final ones (a retried generation) is run again. Returns [(io_state, observation, status)].
+        '''
+        results = []
+        io_state = self.io_state
+        for i, (action_name, action_input) in enumerate(tool_calls):
+            io_state = io_state.fork()
+            sent = self.sent.pop(i, None)
+            if sent is not None and sent[0] == action_name and same_tool_input(sent[1], action_input):
+                observation, status = sent[2].result()
+            else:
+                observation, status = io_state.step(action_name=action_name, action_input=action_input)
+            results.append((io_state, observation, status))
+        self.cancel()
+        return results
+
+    def cancel(self):
+        # calls already running finish on their own fork, nothing waits for them
+        for _, _, future in self.sent.values():
+            future.cancel()
+        self.sent = {}
+
+
 class base_env:
+    # attributes that belong to a single search node, everything else is shared by all the forks of an env
+    node_state = ()
 
     def __init__(self):
         self.task_description = ""
@@ -6,6 +86,31 @@ class base_env:
         self.tool_names = []
         self.functions = []
 
+    def fork(self):
+        '''
+        Env state for a new tree node: a shallow copy sharing functions, descriptions, retriever and service
+        config with its parent, with its own copy of the node_state attributes only
+        '''
+        child = copy.copy(self)
+        for name in self.node_state:
+            setattr(child, name, copy.copy(getattr(self, name)))
+        return child
+
+    def run_tool_calls(self, tool_calls, workers=1):
+        '''
+        Run the tool calls of one assistant message as if one after another, each on a fork of the state left by
+        the former one. Returns [(io_state, observation, status)] in the order of tool_calls.
+        With workers > 1 the calls other than Finish are sent at the same time: only Finish changes the node_state,
+        so they do not depend on each other. Finish calls run in order afterwards.
+        tool_calls: [(action_name, action_input)]
+        '''
+        calls = early_tool_calls(self, workers)
+        concurrent = [i for i, (action_name, _) in enumerate(tool_calls) if action_name != "Finish"]
+        if workers > 1 and len(concurrent) > 1:
+            for i in concurrent:
+                calls.submit(i, *tool_calls[i])
+        return calls.results(tool_calls)
+
     def restart(self):
         '''
         Restrat the environment
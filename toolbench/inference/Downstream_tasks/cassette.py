@@ -0,0 +1,159 @@
+import os
+import mmap
+import json
+import struct
+import hashlib
+import threading
+from toolbench.inference.Downstream_tasks.task_manifest import file_lock
+
+CASSETTE_MODES = ("record", "replay", "read-through")
+
+# record layout: magic, sha256 key, status code, payload length, then the utf-8 observation
+_RECORD_HEADER = struct.Struct("<4s32siI")
+_MAGIC = b"TBC1"
+
+
+def canonical_tool_input(tool_input):
+    '''
+    Equal json inputs written differently (key order, spacing) map to the same key
+    '''
+    if isinstance(tool_input, str):
+        try:
+            tool_input = json.loads(tool_input, strict=False)
+        except (json.JSONDecodeError, ValueError):
+            return tool_input
+    return json.dumps(tool_input, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def cassette_key(category, tool_name, api_name, tool_input, strip="", max_tokens=None):
+    '''
+    max_tokens: the observation budget of the budget compress method, the service compresses the answer to it
+    '''
+    fields = [category, tool_name, api_name, canonical_tool_input(tool_input), strip]
+    if max_tokens is not None:
+        fields.append(max_tokens)
+    identity = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(identity.encode("utf-8")).digest()
+
+
+class cassette_store:
+    """Content-addressed, append-only store of tool observations, read through mmap.
+
+    Each record is (key, status code, observation string); the newest record of a key wins. Several processes can
+    share one file: appends and compaction happen under a file lock, readers pick up appended records and notice a
+    compacted (replaced) file by its inode. When the file grows over max_bytes it is rewritten with the newest
+    records only, down to 3/4 of max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = {}
+        self.scanned = 0
+        self.inode = None
+        self.mm = None
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        open(path, "ab").close()
+        with self.lock:
+            self._refresh()
+
+    def _remap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        with open(self.path, "rb") as reader:
+            size = os.fstat(reader.fileno()).st_size
+            if size > 0:
+                self.mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        return size
+
+    def _refresh(self):
+        '''
+        Index the records written since the last scan. Caller must hold self.lock.
+        '''
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode:
+            self.inode = stat.st_ino
+            self.index = {}
+            self.scanned = 0
+        elif stat.st_size == self.scanned:
+            return
+        size = self._remap()
+        offset = self.scanned
+        while offset + _RECORD_HEADER.size <= size:
+            magic, key, status, length = _RECORD_HEADER.unpack_from(self.mm, offset)
+            end = offset + _RECORD_HEADER.size + length
+            if magic != _MAGIC or end > size:
+                break  # torn write of a crashed writer, stop here
+            self.index[key] = (offset + _RECORD_HEADER.size, length, status)
+            offset = end
+        self.scanned = offset
+
+    def get(self, key):
+        '''
+        (observation, status code) or None
+        '''
+        with self.lock:
+            if key not in self.index:
+                self._refresh()
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            start, length, status = entry
+            return self.mm[start:start + length].decode("utf-8"), status
+
+    def put(self, key, observation, status):
+        payload = observation.encode("utf-8")
+        record = _RECORD_HEADER.pack(_MAGIC, key, status, len(payload)) + payload
+        with self.lock, file_lock(self.path + ".lock"):
+            self._refresh()
+            with open(self.path, "ab") as writer:
+                writer.write(record)
+            self._refresh()
+            if self.max_bytes is not None and self.scanned > self.max_bytes:
+                self._compact()
+
+    def _compact(self):
+        '''
+        Keep the newest records that fit in 3/4 of max_bytes. Caller must hold both locks.
+        '''
+        budget = self.max_bytes * 3 // 4
+        entries = sorted(self.index.items(), key=lambda item: item[1][0], reverse=True)
+        kept = []
+        total = 0
+        for key, (start, length, status) in entries:
+            total += _RECORD_HEADER.size + length
+            if total > budget:
+                break
+            kept.append((key, start, length, status))
+        tmp_path = self.path + f".tmp{os.getpid()}"
+        with open(tmp_path, "wb") as writer:
+            for key, start, length, status in reversed(kept):
+                writer.write(_RECORD_HEADER.pack(_MAGIC, key, status, length))
+                writer.write(self.mm[start:start + length])
+        os.replace(tmp_path, self.path)
+        self._refresh()
+
+    def __len__(self):
+        with self.lock:
+            self._refresh()
+            return len(self.index)
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path, max_bytes=None):
+    '''
+    One store per file and process, shared by every env
+    '''
+    key = os.path.abspath(path)
+    with _cassettes_lock:
+        cassette = _cassettes.get(key)
+        if cassette is None:
+            cassette = cassette_store(path, max_bytes=max_bytes)
+            _cassettes[key] = cassette
+        return cassette
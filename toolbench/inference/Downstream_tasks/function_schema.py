@@ -0,0 +1,165 @@
+import json
+import threading
+from toolbench.utils import standardize, change_name
+
+
+class frozen_dict(dict):
+    """dict that refuses mutation. Still a dict for json.dumps, the openai client and isinstance checks.
+
+    Copies return the object itself, so deepcopy of an env or of a message list does not duplicate shared schemas.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("compiled function schemas are shared between envs and can not be modified")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (frozen_dict, (dict(self),))
+
+    def __hash__(self):
+        return id(self)
+
+
+class frozen_list(list):
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("compiled function schemas are shared between envs and can not be modified")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (frozen_list, (list(self),))
+
+    def __hash__(self):
+        return id(self)
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return frozen_dict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return frozen_list(freeze(value) for value in obj)
+    return obj
+
+
+class compiled_schema_cache:
+    """Interned, frozen openai function schemas keyed by (category, tool, api, attack, seed).
+
+    Every env asking for the same key gets the very same objects, so thousands of in-flight tasks hold one copy.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        '''
+        build() -> (openai_function_json, cate_name, pure_api_name), only called on a miss
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+        function_json, cate_name, pure_api_name = build()
+        entry = (freeze(function_json), cate_name, pure_api_name)
+        with self.lock:
+            return self.entries.setdefault(key, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_compiled_schemas = compiled_schema_cache()
+
+
+def get_compiled_function(key, build):
+    return _compiled_schemas.get(key, build)
+
+
+def missing_arguments_error(function_name, missing):
+    '''
+    The TypeError message of python for a call of function_name without the parameters missing
+    '''
+    names = [repr(name) for name in missing]
+    if len(names) == 1:
+        listed = names[0]
+    elif len(names) == 2:
+        listed = f"{names[0]} and {names[1]}"
+    else:
+        listed = ", ".join(names[:-1]) + f", and {names[-1]}"
+    plural = "argument" if len(names) == 1 else "arguments"
+    return f"{function_name}() missing {len(names)} required positional {plural}: {listed}"
+
+
+class tool_input_validator:
+    """Local checks of an action input against the api, done before spending a service call on it.
+
+    Built from the true required parameters of the api, not from the (possibly attacked) schema shown to the
+    model. Only what the tool service would certainly reject is checked, with the very answer of server.py:
+    unparsable json and missing required parameters without a default. Types are not checked, the service passes
+    them through as they are.
+    """
+
+    __slots__ = ("required", "module_name", "api_name")
+
+    def __init__(self, required, module_name, api_name):
+        '''
+        module_name, api_name: the tool module and function server.py runs for the api
+        '''
+        self.required = tuple(required)
+        self.module_name = module_name
+        self.api_name = api_name
+
+    @classmethod
+    def from_api_json(cls, api_json, module_name, api_name):
+        return cls((change_name(standardize(para["name"])) for para in api_json.get("required_parameters", [])
+                    if len(str(para.get("default", ""))) == 0), module_name, api_name)
+
+    def check(self, tool_input):
+        '''
+        None if the input may be sent, otherwise the response dict the tool service would have answered
+        '''
+        if tool_input == "":
+            arguments = {}
+        else:
+            try:
+                arguments = json.loads(tool_input)
+            except Exception:
+                return {"error": "Tool input parse error...\n", "response": ""}
+            if not isinstance(arguments, dict):
+                # not a keyword call, left to the service
+                return None
+        missing = [name for name in self.required if name not in arguments]
+        if missing:
+            return {"error": f"Function executing from {self.module_name} import {self.api_name} error...\n"
+                             f"{missing_arguments_error(self.api_name, missing)}",
+                    "response": ""}
+        return None
+
+
+_validators = {}
+
+
+def get_tool_input_validator(key, api_json, module_name, api_name):
+    '''
+    key: (category, tool, api), the validator does not depend on the attack
+    '''
+    validator = _validators.get(key)
+    if validator is None:
+        validator = _validators.setdefault(key, tool_input_validator.from_api_json(api_json, module_name, api_name))
+    return validator
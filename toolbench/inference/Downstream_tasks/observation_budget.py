@@ -0,0 +1,183 @@
+'''
+Observation compression to a token budget that keeps the observation valid json.
+
+Cutting the serialized response at a number of characters leaves broken json the model often calls the tool
+again for. Here the parsed response is shrunk instead: long strings are elided, arrays and objects keep their
+first items with a note of how many were dropped, and deep containers are summarized, more and more strictly
+until the json fits. Each try serializes under a character limit and gives up as soon as it is passed, so a large
+payload is never turned into a string as a whole.
+'''
+import ast
+import json
+
+DEFAULT_MAX_TOKENS = 512
+# items kept per array or object, characters kept per string and nesting kept, from the mildest level on
+ITEM_LIMITS = (50, 20, 10, 5, 3, 3, 2, 2, 1)
+STRING_LIMITS = (1000, 400, 200, 100, 60, 30, 30, 20, 10)
+DEPTH_LIMITS = (64, 64, 64, 8, 6, 3, 3, 2, 2)
+
+
+def estimate_tokens(text):
+    '''
+    4 characters a token, for backends without a tokenizer
+    '''
+    return (len(text) + 3) // 4
+
+
+def tokenizer_counter(tokenizer):
+    if tokenizer is None:
+        return estimate_tokens
+    return lambda text: len(tokenizer(text, add_special_tokens=False).input_ids)
+
+
+class _overflow(Exception):
+    pass
+
+
+class _writer:
+    def __init__(self, limit, items, string_length, depth):
+        self.limit = limit
+        self.items = items
+        self.string_length = string_length
+        self.depth = depth
+        self.parts = []
+        self.length = 0
+
+    def emit(self, text):
+        self.length += len(text)
+        if self.length > self.limit:
+            raise _overflow()
+        self.parts.append(text)
+
+    def string(self, value):
+        if len(value) > self.string_length:
+            value = value[:self.string_length] + f"... ({len(value)} chars)"
+        self.emit(json.dumps(value, ensure_ascii=False))
+
+    def value(self, value, depth=0):
+        if value is None or isinstance(value, (bool, int, float)):
+            self.emit(json.dumps(value))
+        elif isinstance(value, str):
+            self.string(value)
+        elif isinstance(value, dict):
+            if depth >= self.depth:
+                self.emit(json.dumps(f"{{{len(value)} keys}}"))
+                return
+            self.emit("{")
+            for k, (key, item) in enumerate(value.items()):
+                if k == self.items:
+                    self.emit(f', "...": "{len(value) - k} more keys"')
+                    break
+                if k:
+                    self.emit(", ")
+                self.string(str(key))
+                self.emit(": ")
+                self.value(item, depth + 1)
+            self.emit("}")
+        elif isinstance(value, (list, tuple)):
+            if depth >= self.depth:
+                self.emit(json.dumps(f"[{len(value)} items]"))
+                return
+            self.emit("[")
+            for k, item in enumerate(value):
+                if k == self.items:
+                    self.emit(f', "... {len(value) - k} more items"')
+                    break
+                if k:
+                    self.emit(", ")
+                self.value(item, depth + 1)
+            self.emit("]")
+        else:
+            self.string(str(value))
+
+
+def budget_dumps(value, max_tokens=DEFAULT_MAX_TOKENS, count_tokens=estimate_tokens):
+    '''
+    json text of value within max_tokens, as counted by count_tokens
+    '''
+    limit = max_tokens * 4
+    for _ in range(3):
+        for items, string_length, depth in zip(ITEM_LIMITS, STRING_LIMITS, DEPTH_LIMITS):
+            writer = _writer(limit, items, string_length, depth)
+            try:
+                writer.value(value)
+            except _overflow:
+                continue
+            text = "".join(writer.parts)
+            tokens = count_tokens(text)
+            if tokens <= max_tokens:
+                return text
+            # denser text than 4 characters a token, try again with a shorter limit
+            limit = int(limit * max_tokens / tokens * 0.9)
+            break
+        else:
+            break
+    if isinstance(value, dict):
+        return json.dumps(f"{{{len(value)} keys}}")
+    if isinstance(value, (list, tuple)):
+        return json.dumps(f"[{len(value)} items]")
+    return json.dumps(str(value)[:max_tokens] + "...", ensure_ascii=False)
+
+
+def parse_response(response):
+    '''
+    The structure of a response the tool service already serialized, json or a python repr. The text itself when
+    it is neither.
+    '''
+    if not isinstance(response, str):
+        return response
+    stripped = response.strip()
+    if not stripped or stripped[0] not in "[{":
+        return response
+    try:
+        return json.loads(stripped)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(stripped)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return response
+
+
+def compress_response(response, max_tokens=DEFAULT_MAX_TOKENS, count_tokens=estimate_tokens):
+    '''
+    Text of a tool response within max_tokens: json for a structure, the text itself elided for plain text
+    '''
+    response = parse_response(response)
+    if not isinstance(response, str):
+        return budget_dumps(response, max_tokens, count_tokens)
+    if len(response) <= max_tokens or count_tokens(response) <= max_tokens:
+        return response
+    return response[:max_tokens * 4] + "..."
+
+
+def compress_observation(observation, max_tokens=DEFAULT_MAX_TOKENS, count_tokens=estimate_tokens):
+    '''
+    observation: json of {"error": ..., "response": ...} as the env returns it. The response is compressed to what
+    the budget leaves, and stays a string like the tool service sends it.
+    '''
+    if len(observation) <= max_tokens:
+        # no token is shorter than a character
+        return observation
+    if count_tokens(observation) <= max_tokens:
+        return observation
+    try:
+        outer = json.loads(observation)
+    except ValueError:
+        return budget_dumps(observation, max_tokens, count_tokens)
+    if not isinstance(outer, dict) or "response" not in outer:
+        return budget_dumps(outer, max_tokens, count_tokens)
+    others = json.dumps(dict(outer, response=""), ensure_ascii=False)
+    budget = max_tokens - count_tokens(others)
+    response = parse_response(outer["response"])
+    for _ in range(3):
+        if budget <= 0:
+            break
+        compressed = compress_response(response, budget, count_tokens)
+        text = json.dumps(dict(outer, response=compressed), ensure_ascii=False)
+        tokens = count_tokens(text)
+        if tokens <= max_tokens:
+            return text
+        # the quotes escaped in the outer json
+        budget -= tokens - max_tokens
+    return json.dumps(dict(outer, response="..."), ensure_ascii=False)
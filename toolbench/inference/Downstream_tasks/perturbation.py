@@ -0,0 +1,219 @@
+'''
+Offline precomputation of the query perturbations (Q1-Q4).
+
+The perturbations only depend on the query text and on the arguments used by the ground-truth answer, so they
+are computed once for a whole query file instead of once per env:
+
+    python toolbench/inference/Downstream_tasks/perturbation.py --input_query_file queries.json \
+        --gt_data_file gt.json --attack Q1,Q3 --output_query_file perturbed_{attack}.json
+
+The output has the same format as the input, with the perturbed "query", the "origin_query" and a "perturbation"
+field; pipeline_runner uses such queries as they are when the attack matches.
+'''
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+from functools import lru_cache
+
+QUERY_ATTACKS = ("Q1", "Q2", "Q3", "Q4")
+ATTACK_DICT_FILES = {"Q3": "data/replacement.txt", "Q4": "data/append.txt"}
+INDEX_VERSION = "1"
+
+
+def extract_gt_arguments(gt_entry):
+    '''
+    Unique argument values of all non-Finish tool calls in the first ground-truth answer
+    '''
+    gt_answer = gt_entry['answer']['answer_details'][0]
+    arguments = []
+
+    def process_next(next_array):
+        for next_entry in next_array:
+            try:
+                if next_entry['role'] == 'tool' and next_entry['message']['name'] != 'Finish':
+                    arguments.extend(list(json.loads(next_entry['message']['arguments'], strict=False).values()))
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON: {e}")
+            if 'next' in next_entry and next_entry['next']:
+                process_next(next_entry['next'])
+
+    if 'next' in gt_answer and gt_answer['next']:
+        process_next(gt_answer['next'])
+    try:
+        # unique in first-seen order, so the perturbation does not depend on the hash seed
+        arguments = list(dict.fromkeys(arguments))
+    except TypeError:
+        pass
+    return arguments
+
+
+@lru_cache(maxsize=None)
+def load_attack_dict(attack):
+    if attack not in ATTACK_DICT_FILES:
+        return None
+    with open(ATTACK_DICT_FILES[attack], 'r') as file:
+        return json.load(file)
+
+
+def perturb_query(query, arguments, attack, attack_dict=None):
+    '''
+    Q1/Q2 drop the first/last mention of a gt argument, Q3 replaces arguments by a description, Q4 appends a
+    distracting sentence per argument. attack_dict is the replacement (Q3) or append (Q4) dict.
+    '''
+    if attack_dict is None:
+        attack_dict = load_attack_dict(attack)
+    last_occurrence_info = None
+    first_occurrence_info = None
+
+    for argument in arguments:
+        if str(argument) in query:
+            if attack == 'Q3':
+                if argument in attack_dict:
+                    query = query.replace(str(argument), attack_dict[argument])
+            if attack == 'Q4':
+                if argument in attack_dict:
+                    if query.endswith("."):
+                        query = query[:-1] + ","
+                    query = query + attack_dict[argument]
+
+            index = query.find(str(argument))
+            if index != -1:
+                if first_occurrence_info is None or index < first_occurrence_info[0]:
+                    first_occurrence_info = (index, str(argument))
+            index = query.rfind(str(argument))
+            if index != -1:
+                if last_occurrence_info is None or index > last_occurrence_info[0]:
+                    last_occurrence_info = (index, str(argument))
+    if attack == 'Q1' and first_occurrence_info:
+        index, argument = first_occurrence_info
+        query = query[:index] + query[index + len(argument):]
+    if attack == 'Q2' and last_occurrence_info:
+        index, argument = last_occurrence_info
+        query = query[:index] + query[index + len(argument):]
+    return query
+
+
+def _entry_hash(gt_entry):
+    return hashlib.sha1(json.dumps(gt_entry, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def build_argument_index(gt_data_file, index_file=None):
+    '''
+    query_id -> gt arguments, cached next to the gt file. When the gt file changes, only the entries whose content
+    changed are walked again.
+    '''
+    index_file = index_file or gt_data_file + ".arguments.json"
+    stat = os.stat(gt_data_file)
+    signature = f"{INDEX_VERSION}:{stat.st_mtime_ns}:{stat.st_size}"
+    cached = {"signature": None, "entries": {}}
+    if os.path.exists(index_file):
+        try:
+            with open(index_file, 'r', encoding='utf-8') as reader:
+                cached = json.load(reader)
+        except (json.JSONDecodeError, OSError):
+            pass
+    if cached["signature"] == signature:
+        return {query_id: entry["arguments"] for query_id, entry in cached["entries"].items()}
+
+    with open(gt_data_file, 'r', encoding='utf-8') as file:
+        gt_data = json.load(file)
+    entries = {}
+    for query_id, gt_entry in gt_data.items():
+        entry_hash = _entry_hash(gt_entry)
+        old_entry = cached["entries"].get(query_id)
+        if old_entry is not None and old_entry["hash"] == entry_hash:
+            entries[query_id] = old_entry
+        else:
+            entries[query_id] = {"hash": entry_hash, "arguments": extract_gt_arguments(gt_entry)}
+    try:
+        tmp_file = index_file + f".tmp{os.getpid()}"
+        with open(tmp_file, 'w', encoding='utf-8') as writer:
+            json.dump({"signature": signature, "entries": entries}, writer)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print(f"Can not save argument index {index_file}: {e}")
+    return {query_id: entry["arguments"] for query_id, entry in entries.items()}
+
+
+_argument_indexes = {}
+
+
+def get_argument_index(gt_data_file):
+    '''
+    Process-wide argument index, for envs that perturb on the fly
+    '''
+    key = os.path.abspath(gt_data_file)
+    if key not in _argument_indexes:
+        _argument_indexes[key] = build_argument_index(gt_data_file)
+    return _argument_indexes[key]
+
+
+def _perturb_chunk(chunk):
+    attack, items = chunk
+    attack_dict = load_attack_dict(attack)
+    return [perturb_query(query, arguments, attack, attack_dict) for query, arguments in items]
+
+
+def perturb_query_file(input_query_file, output_query_file, gt_data_file, attack, workers=1, chunk_size=256):
+    '''
+    Write the query file with the query of every entry perturbed by attack. Entries already perturbed in a former
+    output with the same query and gt arguments are reused.
+    '''
+    assert attack in QUERY_ATTACKS, f"{attack} is not a query perturbation"
+    with open(input_query_file, 'r') as reader:
+        querys = json.load(reader)
+    argument_index = build_argument_index(gt_data_file)
+
+    former = {}
+    if os.path.exists(output_query_file):
+        with open(output_query_file, 'r') as reader:
+            for data_dict in json.load(reader):
+                if data_dict.get("perturbation") == attack:
+                    former[data_dict["perturbation_key"]] = data_dict["query"]
+
+    output, todo = [], []
+    for query_id, data_dict in enumerate(querys):
+        if "query_id" in data_dict:
+            query_id = data_dict["query_id"]
+        query = data_dict.get("origin_query", data_dict["query"])
+        arguments = argument_index[str(query_id)]
+        key = hashlib.sha1(json.dumps([attack, query, arguments], sort_keys=True).encode("utf-8")).hexdigest()
+        new_dict = dict(data_dict)
+        new_dict.update({"origin_query": query, "perturbation": attack, "perturbation_key": key})
+        if key in former:
+            new_dict["query"] = former[key]
+        else:
+            todo.append((new_dict, query, arguments))
+        output.append(new_dict)
+
+    chunks = [(attack, [(query, arguments) for _, query, arguments in todo[i:i + chunk_size]])
+              for i in range(0, len(todo), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = pool.map(_perturb_chunk, chunks)
+    else:
+        results = [_perturb_chunk(chunk) for chunk in chunks]
+    perturbed = [query for result in results for query in result]
+    for (new_dict, _, _), query in zip(todo, perturbed):
+        new_dict["query"] = query
+
+    with open(output_query_file, 'w') as writer:
+        json.dump(output, writer, indent=2, ensure_ascii=False)
+    print(f"{attack}: {len(todo)} perturbed, {len(output) - len(todo)} reused -> {output_query_file}")
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute Q1-Q4 query perturbations")
+    parser.add_argument('--input_query_file', type=str, required=True)
+    parser.add_argument('--gt_data_file', type=str, required=True)
+    parser.add_argument('--attack', type=str, required=True, help='Q1,Q2,Q3,Q4 or a comma separated list')
+    parser.add_argument('--output_query_file', type=str, required=True,
+                        help='Output path, "{attack}" is replaced by the attack name')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    for attack in args.attack.split(","):
+        perturb_query_file(args.input_query_file, args.output_query_file.replace("{attack}", attack),
+                           args.gt_data_file, attack, workers=args.workers)
@@ -2,10 +2,15 @@ import re
 import os
 import json
 import time
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from tqdm import tqdm
 from termcolor import colored
 import random
+from functools import lru_cache
+from toolbench import client_pool
 from toolbench.inference.LLM.chatgpt_function_model import ChatGPTFunction
 from toolbench.inference.LLM.llama_model import LlamaModel
 from toolbench.inference.LLM.davinci_model import Davinci
@@ -14,7 +19,7 @@ from toolbench.inference.LLM.tool_llama_model import ToolLLaMA
 from toolbench.inference.LLM.retriever import ToolRetriever
 from toolbench.inference.Algorithms.single_chain import single_chain
 from toolbench.inference.Algorithms.DFS import DFS_tree_search
-from toolbench.inference.server import get_rapidapi_response
+from toolbench.inference.server import get_rapidapi_response, Info, prepare_tool_name_and_url
 from toolbench.utils import (
     standardize,
     change_name,
@@ -22,27 +27,23 @@ from toolbench.utils import (
 )
 
 from toolbench.inference.Downstream_tasks.base_env import base_env
+from toolbench.inference.Downstream_tasks.task_manifest import task_manifest, parse_shard, in_shard
+from toolbench.inference.Downstream_tasks.transport import get_transport
+from toolbench.inference.Downstream_tasks.tool_catalog import get_catalog, get_tool_definition
+from toolbench.inference.Downstream_tasks.cassette import get_cassette, cassette_key, CASSETTE_MODES
+from toolbench.inference.Downstream_tasks.perturbation import QUERY_ATTACKS, get_argument_index, perturb_query
+from toolbench.inference.Downstream_tasks.function_schema import freeze, get_compiled_function, get_tool_input_validator
+from toolbench.inference.Downstream_tasks.observation_budget import compress_observation, tokenizer_counter
+from toolbench.inference.Downstream_tasks.tool_executor import get_tool_executor, tool_timeout, tool_worker_error, TOOLS_ROOT
+
+
+SCHEMA_ATTACKS = ("D1", "D2", "D3", "D4", "D5", "D6")
 
 
 # For pipeline environment preparation
 def get_white_list(tool_root_dir):
-    # print(tool_root_dir)
-    white_list_dir = os.path.join(tool_root_dir)
-    white_list = {}
-    for cate in tqdm(os.listdir(white_list_dir)):
-        if not os.path.isdir(os.path.join(white_list_dir, cate)):
-            continue
-        for file in os.listdir(os.path.join(white_list_dir, cate)):
-            if not file.endswith(".json"):
-                continue
-            standard_tool_name = file.split(".")[0]
-            # print(standard_tool_name)
-            with open(os.path.join(white_list_dir, cate, file)) as reader:
-                js_data = json.load(reader)
-            origin_tool_name = js_data["tool_name"]
-            white_list[standardize(origin_tool_name)] = {"description": js_data["tool_description"],
-                                                         "standard_tool_name": standard_tool_name}
-    return white_list
+    # served by the compiled catalog, the tool tree is only parsed again when it changes
+    return get_catalog(tool_root_dir).white_list()
 
 
 def contain(candidate_list, white_list):
@@ -54,9 +55,64 @@ def contain(candidate_list, white_list):
     return output
 
 
+FINISH_FUNCTION = freeze({
+    "type": "function",
+    "function": {
+        "name": "Finish",
+        "description": "If you believe that you have obtained a result that can answer the task, please call this function to provide the final answer. Alternatively, if you recognize that you are unable to proceed with the task in the current state, call this function to restart. Remember: you must ALWAYS call this function at the end of your attempt, and the only part that will be shown to the user is the final answer, so it should contain sufficient information.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "return_type": {
+                    "type": "string",
+                    "enum": ["give_answer", "give_up_and_restart"],
+                },
+                "final_answer": {
+                    "type": "string",
+                    "description": "The final answer you want to give the user. You should have this field if \"return_type\"==\"give_answer\"",
+                }
+            },
+            "required": ["return_type"],
+        },
+    }
+})
+
+
+@lru_cache(maxsize=4096)
+def build_task_description(tool_descriptions):
+    '''
+    tool_descriptions: tuple of (standardized tool name, description). The same tool sets come back query after
+    query, so the string is built once per set.
+    '''
+    task_description = f'''You should use functions to help handle the real time user querys. Remember:
+1.ALWAYS call \"Finish\" function at the end of the task. And the final answer should contain enough information to show to the user,If you can't handle the task, or you find that function calls always fail(the function is not valid now), use function Finish->give_up_and_restart.
+2.Do not use origin tool names, use only subfunctions' names.
+You have access of the following tools:\n'''
+
+    unduplicated_reflection = {}
+    for standardize_tool_name, tool_des in tool_descriptions:
+        unduplicated_reflection[standardize_tool_name] = tool_des
+
+    for k, (standardize_tool_name, tool_des) in enumerate(unduplicated_reflection.items()):
+        try:
+            striped = tool_des[:512].replace('\n', '').strip()
+        except:
+            striped = ""
+        if striped == "":
+            striped = "None"
+        task_description += f"{k + 1}.{standardize_tool_name}: {striped}\n"
+    return task_description
+
+
 # rapidapi env wrapper
 class rapidapi_wrapper(base_env):
-    def __init__(self, query_json, tool_descriptions, retriever, args, process_id=0, query_id=0):
+    node_state = ("success",)
+
+    def __init__(self, query_json, tool_descriptions, retriever, args, process_id=0, query_id=0, white_list=None,
+                 tokenizer=None):
+        '''
+        tokenizer: the backbone's, measures the observations of the budget compress method
+        '''
         super(rapidapi_wrapper).__init__()
 
         self.tool_root_dir = args.tool_root_dir
@@ -64,20 +120,41 @@ class rapidapi_wrapper(base_env):
         self.rapidapi_key = args.rapidapi_key
         self.use_rapidapi_key = args.use_rapidapi_key
         self.api_customization = args.api_customization
+        tool_executor_workers = getattr(args, "tool_executor_workers", 0) or 0
+        if tool_executor_workers > 0 and (self.use_rapidapi_key or self.api_customization):
+            self.tool_executor = get_tool_executor(tool_executor_workers,
+                                                   timeout=getattr(args, "tool_timeout", None) or 30,
+                                                   memory_mb=getattr(args, "tool_memory_mb", 0) or 0)
+        else:
+            self.tool_executor = None
         self.service_url = os.getenv("SERVICE_URL", "http://8.130.32.149:8080/rapidapi")
+        self.service_rate_limit = getattr(args, "service_rate_limit", 30)
+        self.cassette_mode = getattr(args, "cassette_mode", None)
+        if self.cassette_mode:
+            assert self.cassette_mode in CASSETTE_MODES, f"unknown cassette_mode {self.cassette_mode}"
+            self.cassette = get_cassette(args.cassette_path, max_bytes=getattr(args, "cassette_max_bytes", None))
+        else:
+            self.cassette = None
         self.max_observation_length = args.max_observation_length
         self.observ_compress_method = args.observ_compress_method
+        self.max_observation_tokens = getattr(args, "max_observation_tokens", None) or 256
+        self.count_tokens = tokenizer_counter(tokenizer)
         self.retriever = retriever
         self.process_id = process_id
         self.attack = args.attack
+        self.attack_seed = getattr(args, "attack_seed", None)
         self.gt_data_file = args.gt_data_file
+        self.white_list = white_list
         self.tool_names = []
         self.cate_names = []
-        if self.attack == 'Q1' or self.attack == 'Q2' or self.attack == 'Q3' or self.attack == 'Q4':
+        if self.attack in QUERY_ATTACKS and query_json.get("perturbation") != self.attack:
             self.input_description = self.fuzz_query_param(query_json["query"], query_id)
         else:
             self.input_description = query_json["query"]
         self.functions = []
+        self.function_index = {}
+        self.validators = []
+        self.validate_tool_input = getattr(args, "validate_tool_input", False)
         self.api_name_reflect = {}
 
         if self.retriever is not None:
@@ -91,54 +168,26 @@ class rapidapi_wrapper(base_env):
                 tool_descriptions = self.build_tool_description(data_dict)
         for k, api_json in enumerate(data_dict["api_list"]):
             standard_tool_name = tool_descriptions[k][0]
-            openai_function_json, cate_name, pure_api_name = self.api_json_to_openai_json(api_json, standard_tool_name)
+            openai_function_json, cate_name, pure_api_name = self.compiled_openai_json(api_json, standard_tool_name)
             self.functions.append(openai_function_json)
+            # the first function of a name wins, like the suffix scan of _step
+            self.function_index.setdefault(openai_function_json["function"]["name"], k)
+            # the module and function server.py runs, named in its answers
+            info = Info(category=cate_name, tool_name=standard_tool_name, api_name=pure_api_name, tool_input="",
+                        strip="")
+            _, _, module_api_name, module_name = prepare_tool_name_and_url(TOOLS_ROOT, info)
+            self.validators.append(get_tool_input_validator(
+                (api_json["category_name"], standard_tool_name, api_json["api_name"]), api_json, module_name,
+                module_api_name))
 
             self.api_name_reflect[openai_function_json["function"]["name"]] = pure_api_name
             self.tool_names.append(standard_tool_name)
             self.cate_names.append(cate_name)
 
-        finish_func = {
-            "type": "function",
-            "function": {
-                "name": "Finish",
-                "description": "If you believe that you have obtained a result that can answer the task, please call this function to provide the final answer. Alternatively, if you recognize that you are unable to proceed with the task in the current state, call this function to restart. Remember: you must ALWAYS call this function at the end of your attempt, and the only part that will be shown to the user is the final answer, so it should contain sufficient information.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "return_type": {
-                            "type": "string",
-                            "enum": ["give_answer", "give_up_and_restart"],
-                        },
-                        "final_answer": {
-                            "type": "string",
-                            "description": "The final answer you want to give the user. You should have this field if \"return_type\"==\"give_answer\"",
-                        }
-                    },
-                    "required": ["return_type"],
-                },
-            }
-        }
-
-        self.functions.append(finish_func)
+        self.functions.append(FINISH_FUNCTION)
         self.CALL_MAX_TIME = 3
-        self.task_description = f'''You should use functions to help handle the real time user querys. Remember:
-1.ALWAYS call \"Finish\" function at the end of the task. And the final answer should contain enough information to show to the user,If you can't handle the task, or you find that function calls always fail(the function is not valid now), use function Finish->give_up_and_restart.
-2.Do not use origin tool names, use only subfunctions' names.
-You have access of the following tools:\n'''
-
-        unduplicated_reflection = {}
-        for standardize_tool_name, tool_des in tool_descriptions:
-            unduplicated_reflection[standardize_tool_name] = tool_des
-
-        for k, (standardize_tool_name, tool_des) in enumerate(unduplicated_reflection.items()):
-            try:
-                striped = tool_des[:512].replace('\n', '').strip()
-            except:
-                striped = ""
-            if striped == "":
-                striped = "None"
-            self.task_description += f"{k + 1}.{standardize_tool_name}: {striped}\n"
+        self.task_description = build_task_description(
+            tuple((standardize_tool_name, tool_des) for standardize_tool_name, tool_des in tool_descriptions))
 
         self.success = 0
 
@@ -146,68 +195,12 @@ You have access of the following tools:\n'''
         self.argument_list.append(argument)
 
     def fuzz_query_param(self, query, query_id):
-        with open(self.gt_data_file, 'r', encoding='utf-8') as file:
-            gt_data = json.load(file)
-
-        gt_answer = gt_data[str(query_id)]['answer']['answer_details'][0]
-        arguments = []
-
-        def process_next(next_array):
-            for next_entry in next_array:
-                try:
-                    if next_entry['role'] == 'tool' and next_entry['message']['name'] != 'Finish':
-                        arguments.extend(list(json.loads(next_entry['message']['arguments'], strict=False).values()))
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON: {e}")
-                if 'next' in next_entry and next_entry['next']:
-                    process_next(next_entry['next'])
-
-        if 'next' in gt_answer and gt_answer['next']:
-            process_next(gt_answer['next'])
-        try:
-            arguments = list(set(arguments))
-        except:
-            pass
-
-        last_occurrence_info = None
-        first_occurrence_info = None
-
-        for argument in arguments:
-            if str(argument) in query:
-                if self.attack == 'Q3':
-                    with open('data/replacement.txt', 'r') as file:
-                        replacement_dict = json.load(file)
-                    if argument in replacement_dict:
-                        query = query.replace(str(argument), replacement_dict[argument])
-                if self.attack == 'Q4':
-                    with open('data/append.txt', 'r') as file:
-                        append_dict = json.load(file)
-                    if argument in append_dict:
-                        if query.endswith("."):
-                            query = query[:-1] + ","
-                        query = query + append_dict[argument]
-
-                index = query.find(str(argument))
-                if index != -1:
-                    if first_occurrence_info is None or index < first_occurrence_info[0]:
-                        first_occurrence_info = (index, str(argument))
-                index = query.rfind(str(argument))
-                if index != -1:
-                    if last_occurrence_info is None or index > last_occurrence_info[0]:
-                        last_occurrence_info = (index, str(argument))
-        if self.attack == 'Q1' and first_occurrence_info:
-            index, argument = first_occurrence_info
-            query = query[:index] + query[index + len(argument):]
-        if self.attack == 'Q2' and last_occurrence_info:
-            index, argument = last_occurrence_info
-            query = query[:index] + query[index + len(argument):]
-
-        # print("arguments_after:",arguments)
-        # print("query_after:",query)
-        return query
+        # query files precomputed by Downstream_tasks/perturbation.py skip this
+        arguments = get_argument_index(self.gt_data_file)[str(query_id)]
+        return perturb_query(query, arguments, self.attack)
 
     def build_tool_description(self, data_dict):
-        white_list = get_white_list(self.tool_root_dir)
+        white_list = self.white_list if self.white_list is not None else get_white_list(self.tool_root_dir)
         origin_tool_names = [standardize(cont["tool_name"]) for cont in data_dict["api_list"]]
         tool_des = contain(origin_tool_names, white_list)
         tool_descriptions = [[cont["standard_tool_name"], cont["description"]] for cont in tool_des]
@@ -222,14 +215,12 @@ You have access of the following tools:\n'''
             category = tool_dict["category"]
             tool_name = tool_dict["tool_name"]
             api_name = tool_dict["api_name"]
-            if os.path.exists(jsons_path):
-                if os.path.exists(os.path.join(jsons_path, category)):
-                    if os.path.exists(os.path.join(jsons_path, category, tool_name + ".json")):
-                        query_json["api_list"].append({
-                            "category_name": category,
-                            "tool_name": tool_name,
-                            "api_name": api_name
-                        })
+            if get_catalog(jsons_path).has_tool(category, tool_name):
+                query_json["api_list"].append({
+                    "category_name": category,
+                    "tool_name": tool_name,
+                    "api_name": api_name
+                })
         return query_json
 
     def fetch_api_json(self, query_json):
@@ -241,57 +232,66 @@ You have access of the following tools:\n'''
                 api_name = change_name(standardize(item["api_name"]))
             elif "name" in item:
                 api_name = change_name(standardize(item["name"]))
-            tool_json = json.load(open(os.path.join(self.tool_root_dir, cate_name, tool_name + ".json"), "r"))
-            append_flag = False
-            api_dict_names = []
-            for api_dict in tool_json["api_list"]:
-                api_dict_names.append(api_dict["name"])
-                pure_api_name = change_name(standardize(api_dict["name"]))
-                if pure_api_name != api_name:
-                    continue
-                api_json = {}
-                api_json["category_name"] = cate_name
-                api_json["api_name"] = api_dict["name"]
-                api_json["api_description"] = api_dict["description"]
-                api_json["required_parameters"] = api_dict["required_parameters"]
-                api_json["optional_parameters"] = api_dict["optional_parameters"]
-                api_json["tool_name"] = tool_json["tool_name"]
-                data_dict["api_list"].append(api_json)
-                append_flag = True
-                break
-            if not append_flag:
-                print(api_name, api_dict_names)
+            tool_definition = get_tool_definition(self.tool_root_dir, cate_name, tool_name)
+            if tool_definition is None:
+                raise FileNotFoundError(os.path.join(self.tool_root_dir, cate_name, tool_name + ".json"))
+            api_dict = tool_definition["api_index"].get(api_name)
+            if api_dict is None:
+                print(api_name, tool_definition["api_names"])
+                continue
+            api_json = {}
+            api_json["category_name"] = cate_name
+            api_json["api_name"] = api_dict["name"]
+            api_json["api_description"] = api_dict["description"]
+            # shared with the tool definition cache, the D-series attacks build new parameter lists
+            api_json["required_parameters"] = api_dict["required_parameters"]
+            api_json["optional_parameters"] = api_dict["optional_parameters"]
+            api_json["tool_name"] = tool_definition["tool_name"]
+            data_dict["api_list"].append(api_json)
         return data_dict
 
     def attack_param_description(self, api_json):
         incorrect_description = "Method to sort by: relevant, newest, oldest, most_played, most_commented, or most_liked."
-        for para in api_json["required_parameters"]:
-            para["description"] = incorrect_description
-
-        for para in api_json["optional_parameters"]:
-            para["description"] = incorrect_description
-
-        attacked_api_json = api_json
+        attacked_api_json = dict(api_json)
+        attacked_api_json["required_parameters"] = [dict(para, description=incorrect_description)
+                                                    for para in api_json["required_parameters"]]
+        attacked_api_json["optional_parameters"] = [dict(para, description=incorrect_description)
+                                                    for para in api_json["optional_parameters"]]
         return attacked_api_json
 
-    def shuffle_param_description(self, api_json):
+    def shuffle_param_description(self, api_json, rng=random):
         required_descriptions = [para["description"] for para in api_json["required_parameters"]]
         optional_descriptions = [para["description"] for para in api_json["optional_parameters"]]
         descriptions = required_descriptions + optional_descriptions
-        random.shuffle(descriptions)
-        index = 0
-        for para in api_json["required_parameters"]:
-            if index < len(descriptions):
-                para["description"] = descriptions[index]
-                index += 1
-        for para in api_json["optional_parameters"]:
-            if index < len(descriptions):
-                para["description"] = descriptions[index]
-                index += 1
-
-        shuffled_api_json = api_json
+        rng.shuffle(descriptions)
+        shuffled_api_json = dict(api_json)
+        shuffled_api_json["required_parameters"] = [dict(para, description=description) for para, description in
+                                                    zip(api_json["required_parameters"], descriptions)]
+        shuffled_api_json["optional_parameters"] = [dict(para, description=description) for para, description in
+                                                    zip(api_json["optional_parameters"],
+                                                        descriptions[len(required_descriptions):])]
         return shuffled_api_json
 
+    def reverse_param_order(self, api_json):
+        reversed_api_json = dict(api_json)
+        reversed_api_json["required_parameters"] = api_json["required_parameters"][::-1]
+        reversed_api_json["optional_parameters"] = api_json["optional_parameters"][::-1]
+        return reversed_api_json
+
+    def compiled_openai_json(self, api_json, standard_tool_name):
+        '''
+        api_json_to_openai_json through the process-wide schema cache. The schema only depends on the api, the tool
+        name and the D-series attack, so every env gets the same frozen dicts. D4 without an attack_seed shuffles
+        differently for every env, like before, and is not cached.
+        '''
+        attack = self.attack if self.attack in SCHEMA_ATTACKS else None
+        if attack == 'D4' and self.attack_seed is None:
+            function_json, cate_name, pure_api_name = self.api_json_to_openai_json(api_json, standard_tool_name)
+            return freeze(function_json), cate_name, pure_api_name
+        seed = self.attack_seed if attack == 'D4' else None
+        key = (api_json["category_name"], standard_tool_name, api_json["api_name"], attack, seed)
+        return get_compiled_function(key, lambda: self.api_json_to_openai_json(api_json, standard_tool_name))
+
     def api_json_to_openai_json(self, api_json, standard_tool_name):
         description_max_length = 256
         function_templete = {
@@ -331,10 +331,13 @@ You have access of the following tools:\n'''
             if self.attack == 'D3':
                 api_json = self.attack_param_description(api_json)
             if self.attack == 'D4':
-                api_json = self.shuffle_param_description(api_json)
+                if self.attack_seed is None:
+                    api_json = self.shuffle_param_description(api_json)
+                else:
+                    rng = random.Random(f"{self.attack_seed}:{api_json['category_name']}:{standard_tool_name}:{api_json['api_name']}")
+                    api_json = self.shuffle_param_description(api_json, rng)
             if self.attack == 'D5':
-                api_json["required_parameters"].reverse()
-                api_json["optional_parameters"].reverse()
+                api_json = self.reverse_param_order(api_json)
 
             for para in api_json["required_parameters"]:
                 name = standardize(para["name"])
@@ -412,7 +415,9 @@ You have access of the following tools:\n'''
 
     def step(self, **args):
         obs, code = self._step(**args)
-        if len(obs) > self.max_observation_length:
+        if self.observ_compress_method == "budget":
+            obs = compress_observation(obs, self.max_observation_tokens, self.count_tokens)
+        elif len(obs) > self.max_observation_length:
             # obs = obs[:self.max_observation_length] + "..."
             obs = obs[:self.max_observation_length]
 
@@ -465,82 +470,129 @@ You have access of the following tools:\n'''
             else:
                 return "{error:\"\"return_type\" is not a valid choice\"}", 2
         else:
-
-            for k, function_dict in enumerate(self.functions):
-                function = function_dict['function']
-                # import pdb; pdb.set_trace()
-                if function["name"].endswith(action_name):
-                    pure_api_name = self.api_name_reflect[function["name"]]
-                    payload = {
-                        "category": self.cate_names[k],
-                        "tool_name": self.tool_names[k],
-                        "api_name": pure_api_name,
-                        "tool_input": action_input,
-                        "strip": self.observ_compress_method,
-                        "toolbench_key": self.toolbench_key
-                    }
+            k = self.function_index.get(action_name)
+            if k is None:
+                # the model sometimes drops the start of a long name, fall back to the suffix match
+                for j, function_dict in enumerate(self.functions):
+                    if function_dict['function']["name"].endswith(action_name):
+                        k = j
+                        break
+            if k is None or k >= len(self.validators):
+                return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+            function_name = self.functions[k]['function']["name"]
+            if self.validate_tool_input:
+                rejected = self.validators[k].check(action_input)
+                if rejected is not None:
+                    # the same answer the tool service would give, without the round trip
                     if self.process_id == 0:
-                        print(colored(f"query to {self.cate_names[k]}-->{self.tool_names[k]}-->{action_name}",
-                                      color="yellow"))
-                    if self.use_rapidapi_key or self.api_customization:
-                        payload["rapidapi_key"] = self.rapidapi_key
-                        response = get_rapidapi_response(payload, api_customization=self.api_customization)
-                    else:
-                        time.sleep(2)  # rate limit: 30 per minute
-                        headers = {"toolbench_key": self.toolbench_key}
-                        timeout = None if self.service_url.endswith("virtual") else 15
-                        try:
-                            response = requests.post(self.service_url, json=payload, headers=headers, timeout=timeout)
-                        except requests.exceptions.Timeout:
-                            return json.dumps({"error": f"Timeout error...", "response": ""}), 5
-                        if response.status_code != 200:
-                            return json.dumps(
-                                {"error": f"request invalid, data error. status_code={response.status_code}",
-                                 "response": ""}), 12
-                        try:
-                            response = response.json()
-                        except:
-                            print(response)
-                            return json.dumps({"error": f"request invalid, data error", "response": ""}), 12
-                    # 1 Hallucinating function names
-                    # 4 means that the model decides to pruning by itself
-                    # 5 represents api call timeout
-                    # 6 for 404
-                    # 7 means not subscribed
-                    # 8 represents unauthorized
-                    # 9 represents too many requests
-                    # 10 stands for rate limit
-                    # 11 message contains "error" field
-                    # 12 error sending request
-                    if response["error"] == "API not working error...":
-                        status_code = 6
-                    elif response["error"] == "Unauthorized error...":
-                        status_code = 7
-                    elif response["error"] == "Unsubscribed error...":
-                        status_code = 8
-                    elif response["error"] == "Too many requests error...":
-                        status_code = 9
-                    elif response["error"] == "Rate limit per minute error...":
-                        print("Reach api calling limit per minute, sleeping...")
-                        time.sleep(10)
-                        status_code = 10
-                    elif response["error"] == "Message error...":
-                        status_code = 11
-                    else:
-                        status_code = 0
-                    return json.dumps(response), status_code
-                    # except Exception as e:
-                    #     return json.dumps({"error": f"Timeout error...{e}", "response": ""}), 5
-            return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+                        print(colored(f"rejected input of {function_name}: {rejected['error'].strip()}", color="yellow"))
+                    return json.dumps(rejected), 0
+            return self._call_function(k, function_name, action_name, action_input)
+
+    def _call_function(self, k, function_name, action_name, action_input):
+        pure_api_name = self.api_name_reflect[function_name]
+        payload = {
+            "category": self.cate_names[k],
+            "tool_name": self.tool_names[k],
+            "api_name": pure_api_name,
+            "tool_input": action_input,
+            "strip": self.observ_compress_method,
+            "toolbench_key": self.toolbench_key
+        }
+        if self.observ_compress_method == "budget":
+            payload["max_observation_tokens"] = self.max_observation_tokens
+        if self.process_id == 0:
+            print(colored(f"query to {self.cate_names[k]}-->{self.tool_names[k]}-->{action_name}",
+                          color="yellow"))
+        cassette = self.cassette
+        if cassette is None:
+            return self._send(payload)
+        key = cassette_key(payload["category"], payload["tool_name"], payload["api_name"], action_input,
+                           payload["strip"], payload.get("max_observation_tokens"))
+        if self.cassette_mode != "record":
+            recorded = cassette.get(key)
+            if recorded is not None:
+                return recorded
+            if self.cassette_mode == "replay":
+                return json.dumps({"error": "Cassette miss error...", "response": ""}), 12
+        observation, status_code = self._send(payload)
+        if status_code not in (5, 9, 10, 12):  # timeouts, rate limits and send errors are not answers of the tool
+            cassette.put(key, observation, status_code)
+        return observation, status_code
+
+    def _send(self, payload):
+        if self.use_rapidapi_key or self.api_customization:
+            payload["rapidapi_key"] = self.rapidapi_key
+            if self.tool_executor is None:
+                response = get_rapidapi_response(payload, api_customization=self.api_customization)
+            else:
+                try:
+                    response = self.tool_executor.execute(payload, api_customization=self.api_customization)
+                except tool_timeout:
+                    return json.dumps({"error": f"Timeout error...", "response": ""}), 5
+                except tool_worker_error as e:
+                    return json.dumps({"error": f"Tool executor error...\n{e}", "response": ""}), 12
+        else:
+            headers = {"toolbench_key": self.toolbench_key}
+            timeout = None if self.service_url.endswith("virtual") else 15
+            transport = get_transport(self.service_url, calls_per_minute=self.service_rate_limit)
+            try:
+                response = transport.post(payload, headers=headers, timeout=timeout)
+            except requests.exceptions.Timeout:
+                return json.dumps({"error": f"Timeout error...", "response": ""}), 5
+            if response.status_code != 200:
+                return json.dumps(
+                    {"error": f"request invalid, data error. status_code={response.status_code}",
+                     "response": ""}), 12
+            try:
+                response = response.json()
+            except:
+                print(response)
+                return json.dumps({"error": f"request invalid, data error", "response": ""}), 12
+        # 1 Hallucinating function names
+        # 4 means that the model decides to pruning by itself
+        # 5 represents api call timeout
+        # 6 for 404
+        # 7 means not subscribed
+        # 8 represents unauthorized
+        # 9 represents too many requests
+        # 10 stands for rate limit
+        # 11 message contains "error" field
+        # 12 error sending request
+        if response["error"] == "API not working error...":
+            status_code = 6
+        elif response["error"] == "Unauthorized error...":
+            status_code = 7
+        elif response["error"] == "Unsubscribed error...":
+            status_code = 8
+        elif response["error"] == "Too many requests error...":
+            status_code = 9
+        elif response["error"] == "Rate limit per minute error...":
+            # the transport already backed off and retried, the limit persisted
+            print("Reach api calling limit per minute")
+            status_code = 10
+        elif response["error"] == "Message error...":
+            status_code = 11
+        else:
+            status_code = 0
+        return json.dumps(response), status_code
 
 
 class pipeline_runner:
-    def __init__(self, args, add_retrieval=False, process_id=0, server=False):
+    def __init__(self, args, add_retrieval=False, process_id=0, server=False, build_task_list=True):
         self.args = args
         self.add_retrieval = add_retrieval
         self.process_id = process_id
         self.server = server
-        if not self.server:
+        self.workers = int(getattr(args, "workers", 1) or 1)
+        self.generation_batch_size = int(getattr(args, "generation_batch_size", 1) or 1)
+        cleanup_interval = getattr(args, "generation_cleanup_interval", None)
+        self.cleanup_interval = 1 if cleanup_interval is None else int(cleanup_interval)
+        self.shard = parse_shard(getattr(args, "shard", None))
+        client_pool.configure(max_concurrency=getattr(args, "llm_max_concurrency", None),
+                              max_retries=getattr(args, "llm_max_retries", None))
+        self.white_list = None
+        if not self.server and build_task_list:
             self.task_list = self.generate_task_list()
         else:
             self.task_list = []
@@ -553,10 +605,16 @@ class pipeline_runner:
             replace_llama_with_condense(ratio=ratio)
             if args.lora:
                 backbone_model = ToolLLaMALoRA(base_name_or_path=args.model_path, model_name_or_path=args.lora_path,
-                                               max_sequence_length=args.max_sequence_length)
+                                               max_sequence_length=args.max_sequence_length,
+                                               batch_size=self.generation_batch_size,
+                                               prefix_cache_mb=getattr(args, "prefix_cache_mb", 0) or 0,
+                                               cleanup_interval=self.cleanup_interval)
             else:
                 backbone_model = ToolLLaMA(model_name_or_path=args.model_path,
-                                           max_sequence_length=args.max_sequence_length, device=args.device)
+                                           max_sequence_length=args.max_sequence_length, device=args.device,
+                                           batch_size=self.generation_batch_size,
+                                           prefix_cache_mb=getattr(args, "prefix_cache_mb", 0) or 0,
+                                           cleanup_interval=self.cleanup_interval)
 
         else:
             backbone_model = args.backbone_model
@@ -578,8 +636,10 @@ class pipeline_runner:
         if not os.path.exists(answer_dir):
             os.makedirs(answer_dir, exist_ok=True)
         method = args.method
-        backbone_model = self.get_backbone_model()
+        # with a process pool every worker builds its own backbone in _init_pool_worker
+        backbone_model = self.get_backbone_model() if self.workers <= 1 or self.shares_backbone() else None
         white_list = get_white_list(args.tool_root_dir)
+        self.white_list = white_list
         task_list = []
         for query_id, data_dict in enumerate(querys):
             if "query_id" in data_dict:
@@ -615,7 +675,9 @@ class pipeline_runner:
 
         if method.startswith("CoT"):
             passat = int(method.split("@")[-1])
-            chain = single_chain(llm=llm_forward, io_func=env, process_id=process_id, attack=self.args.attack)
+            chain = single_chain(llm=llm_forward, io_func=env, process_id=process_id, attack=self.args.attack,
+                                 tool_call_workers=getattr(self.args, "tool_call_workers", 1),
+                                 stream_tool_calls=getattr(self.args, "stream_tool_calls", False))
             result = chain.start(
                 pass_at=passat,
                 single_chain_max_step=single_chain_max_step,
@@ -628,7 +690,11 @@ class pipeline_runner:
             with_filter = True
             if "woFilter" in method:
                 with_filter = False
-            chain = DFS_tree_search(llm=llm_forward, io_func=env, process_id=process_id, callbacks=callbacks)
+            chain = DFS_tree_search(llm=llm_forward, io_func=env, process_id=process_id, callbacks=callbacks,
+                                    expand_workers=getattr(self.args, "expand_workers", 1),
+                                    rank_strategy=getattr(self.args, "rank_strategy", "sum"),
+                                    tool_call_workers=getattr(self.args, "tool_call_workers", 1),
+                                    stream_tool_calls=getattr(self.args, "stream_tool_calls", False))
             result = chain.start(
                 single_chain_max_step=single_chain_max_step,
                 tree_beam_size=width,
@@ -651,10 +717,9 @@ class pipeline_runner:
         os.makedirs("/".join(splits[:-1]), exist_ok=True)
         os.makedirs("/".join(splits), exist_ok=True)
         output_file_path = os.path.join(output_dir_path, f"{query_id}_{method}.json")
-        if (not server) and os.path.exists(output_file_path):
-            return
         [callback.on_tool_retrieval_start() for callback in callbacks]
-        env = rapidapi_wrapper(data_dict, tool_des, retriever, args, process_id=process_id, query_id=query_id)
+        env = rapidapi_wrapper(data_dict, tool_des, retriever, args, process_id=process_id, query_id=query_id,
+                               white_list=self.white_list, tokenizer=getattr(backbone_model, "tokenizer", None))
         [callback.on_tool_retrieval_end(
             tools=env.functions
         ) for callback in callbacks]
@@ -678,7 +743,7 @@ class pipeline_runner:
             callbacks=callbacks
         )
         [callback.on_request_end(
-            chain=chain.terminal_node[0].messages,
+            chain=list(chain.terminal_node[0].messages),
             outputs=chain.terminal_node[0].description,
         ) for callback in callbacks]
         if output_dir_path is not None:
@@ -691,30 +756,97 @@ class pipeline_runner:
                 print(colored(f"[process({process_id})]valid={success}", "green"))
         return result
 
+    def run_claimed_task(self, manifest, task, retriever=None, process_id=0):
+        """Run one task if this worker can claim it in the manifest. Returns False if someone else owns it"""
+        query_id = task[2]
+        if not manifest.claim(query_id):
+            return False
+        try:
+            self.run_single_task(*task, retriever=retriever, process_id=process_id, server=False)
+        except BaseException:
+            manifest.release(query_id)
+            raise
+        manifest.finish(query_id)
+        return True
+
     def run(self):
         task_list = self.task_list
         random.seed(42)
         random.shuffle(task_list)
         print(f"total tasks: {len(task_list)}")
-        new_task_list = []
-        max_length = len(task_list)
-        for task in task_list:
-            out_dir_path = task[-2]
-            query_id = task[2]
-            output_file_path = os.path.join(out_dir_path, f"{query_id}_{self.args.method}.json")
-            if os.path.exists(output_file_path):
-                max_length -=1
-
-            if not os.path.exists(output_file_path) and len(new_task_list) < max_length:
-                new_task_list.append(task)
-        task_list = new_task_list
+        if self.shard is not None:
+            task_list = [task for task in task_list if in_shard(task[2], self.shard)]
+            print(f"shard {self.shard[0]}/{self.shard[1]} tasks: {len(task_list)}")
+        manifest = task_manifest(self.args.output_answer_file, self.args.method)
+        task_list = manifest.pending(task_list)
         print(f"undo tasks: {len(task_list)}")
-        # import pdb; pdb.set_trace()
+        if self.workers > 1 and self.shares_backbone():
+            return self.run_threads(manifest, task_list)
+        if self.workers > 1:
+            return self.run_pool(task_list)
         if self.add_retrieval:
             retriever = self.get_retriever()
         else:
             retriever = None
         for k, task in enumerate(task_list):
             print(f"process[{self.process_id}] doing task {k}/{len(task_list)}: real_task_id_{task[2]}")
-            result = self.run_single_task(*task, retriever=retriever, process_id=self.process_id)
+            self.run_claimed_task(manifest, task, retriever=retriever, process_id=self.process_id)
+
+    def shares_backbone(self):
+        '''
+        A batching local model serves all the workers from one process: they run as threads
+        '''
+        return self.args.backbone_model == "toolllama" and self.generation_batch_size > 1
 
+    def run_threads(self, manifest, task_list):
+        retriever = self.get_retriever() if self.add_retrieval else None
+
+        def run_task(task):
+            try:
+                ran = self.run_claimed_task(manifest, task, retriever=retriever, process_id=self.process_id)
+            except Exception as e:
+                traceback.print_exc()
+                return task[2], f"failed: {repr(e)}"
+            return task[2], "done" if ran else "skipped"
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for k, (query_id, status) in enumerate(executor.map(run_task, task_list)):
+                print(f"[threads] {k + 1}/{len(task_list)} real_task_id_{query_id}: {status}")
+
+    def run_pool(self, task_list):
+        # spawn instead of fork: the workers load torch models and may use CUDA
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes=self.workers, initializer=_init_pool_worker,
+                          initargs=(self.args, self.add_retrieval)) as pool:
+            for k, (query_id, status) in enumerate(pool.imap_unordered(_run_pool_task, task_list, chunksize=1)):
+                print(f"[pool] {k + 1}/{len(task_list)} real_task_id_{query_id}: {status}")
+
+
+# per-process state of the pool workers, the heavy objects are built once per worker instead of once per task
+_pool_runner = None
+_pool_retriever = None
+_pool_manifest = None
+
+
+def _init_pool_worker(args, add_retrieval):
+    global _pool_runner, _pool_retriever, _pool_manifest
+    identity = multiprocessing.current_process()._identity
+    process_id = identity[0] - 1 if identity else 0
+    runner = pipeline_runner(args, add_retrieval=add_retrieval, process_id=process_id, build_task_list=False)
+    runner.backbone_model = runner.get_backbone_model()
+    runner.white_list = get_white_list(args.tool_root_dir)
+    _pool_retriever = runner.get_retriever() if add_retrieval else None
+    _pool_manifest = task_manifest(args.output_answer_file, args.method)
+    _pool_runner = runner
+
+
+def _run_pool_task(task):
+    runner = _pool_runner
+    task = (task[0], runner.backbone_model) + tuple(task[2:])
+    query_id = task[2]
+    try:
+        ran = runner.run_claimed_task(_pool_manifest, task, retriever=_pool_retriever, process_id=runner.process_id)
+    except Exception as e:
+        traceback.print_exc()
+        return query_id, f"failed: {repr(e)}"
+    return query_id, "done" if ran else "skipped"
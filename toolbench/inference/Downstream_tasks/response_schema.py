@@ -0,0 +1,112 @@
+'''
+Process-wide index of the response examples, for the filter compress method.
+
+observation_shorten used to load <schema_root>/<category>/<tool>.json and scan its api_list on every tool
+response. Here a tool file is read once, the first time one of its apis answers, and the schema of each of its
+apis is compiled into a shortening plan: the tree of the keys to keep, applied to a response in one pass.
+
+A plan maps each key kept to what is kept inside its value: None for all of it, a plan for an object, [plan] for
+an array of objects.
+'''
+import os
+import json
+import threading
+from toolbench.utils import standardize, change_name
+
+
+def compile_plan(schema):
+    if isinstance(schema, dict):
+        return {key: compile_plan(value) for key, value in schema.items()}
+    if isinstance(schema, list) and schema and isinstance(schema[0], dict):
+        # the schema of an array is the one of its first item
+        return [compile_plan(schema[0])]
+    return None
+
+
+def apply_plan(origin, plan):
+    '''
+    The keys of origin the plan keeps, recursively, in a new dict
+    '''
+    result = {}
+    for key, value in origin.items():
+        if key not in plan:
+            continue
+        child = plan[key]
+        if child is not None:
+            if isinstance(value, dict) and isinstance(child, dict):
+                value = apply_plan(value, child)
+            elif isinstance(value, list) and value and isinstance(value[0], dict) and isinstance(child, list):
+                value = [apply_plan(item, child[0]) if isinstance(item, dict) else item for item in value]
+        result[key] = value
+    return result
+
+
+def load_schemas(path):
+    '''
+    standardized api name -> (schema, plan), from the first api of that name with a schema
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        schema_dicts = json.load(f)
+    schemas = {}
+    for schema_dict in schema_dicts.get("api_list", []):
+        schema = schema_dict.get("schema")
+        if not schema:
+            continue
+        if isinstance(schema, str):
+            try:
+                schema = json.loads(schema)
+            except ValueError:
+                continue
+        api_name = change_name(standardize(schema_dict["name"]))
+        if api_name not in schemas and isinstance(schema, dict):
+            schemas[api_name] = (schema, compile_plan(schema))
+    return schemas
+
+
+class response_schema_index:
+    def __init__(self, schema_root):
+        self.schema_root = schema_root
+        # (category, tool_name) -> {api name: (schema, plan)}, filled on first use
+        self.tools = {}
+        self.lock = threading.Lock()
+
+    def entry(self, category, tool_name, api_name):
+        key = (category, tool_name)
+        schemas = self.tools.get(key)
+        if schemas is None:
+            schemas = load_schemas(os.path.join(self.schema_root, category, tool_name + ".json"))
+            with self.lock:
+                schemas = self.tools.setdefault(key, schemas)
+        return schemas.get(api_name, (None, None))
+
+    def schema(self, category, tool_name, api_name):
+        '''
+        The response example of the api, None when it has none
+        '''
+        return self.entry(category, tool_name, api_name)[0]
+
+    def plan(self, category, tool_name, api_name):
+        return self.entry(category, tool_name, api_name)[1]
+
+    def shorten(self, response, category, tool_name, api_name):
+        '''
+        response with only the keys of the schema of the api, as is when the api has none
+        '''
+        plan = self.plan(category, tool_name, api_name)
+        if plan is None:
+            return response
+        return apply_plan(response, plan)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_response_schema_index(schema_root):
+    with _indexes_lock:
+        index = _indexes.get(schema_root)
+        if index is None:
+            index = _indexes[schema_root] = response_schema_index(schema_root)
+        return index
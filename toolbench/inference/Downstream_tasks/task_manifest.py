@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import zlib
+import threading
+import contextlib
+
+
+def parse_shard(shard):
+    '''
+    "i/N" -> (i, N). None or "" means no sharding.
+    '''
+    if shard is None or shard == "":
+        return None
+    if isinstance(shard, (tuple, list)):
+        index, count = shard
+    else:
+        index, count = str(shard).split("/")
+    index, count = int(index), int(count)
+    if count <= 0 or not 0 <= index < count:
+        raise ValueError(f"invalid shard {shard}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def in_shard(query_id, shard):
+    '''
+    Stable assignment of a query to a shard, independent of the task order and of the machine.
+    '''
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(str(query_id).encode("utf-8")) % count == index
+
+
+class task_manifest:
+    """Lock-protected, append-only record of which queries are claimed or done in an output directory.
+
+    Every worker (process or machine) sharing the output directory goes through the same manifest, so a
+    query_id is never run twice at the same time, and a crashed run resumes from the queries it never finished.
+    The threads of a process may share one manifest.
+    Records are json lines: {"key", "state", "host", "pid", "time"} with state in claimed/done/released.
+    """
+
+    def __init__(self, output_dir, method, lease_seconds=6 * 3600):
+        self.output_dir = output_dir
+        self.method = method
+        self.lease_seconds = lease_seconds
+        self.manifest_path = os.path.join(output_dir, f".manifest_{method}.jsonl")
+        self.lock_path = os.path.join(output_dir, f".manifest_{method}.lock")
+        self.host = socket.gethostname()
+        self.states = {}
+        self.offset = 0
+        self.lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        with self.locked():
+            if not os.path.exists(self.manifest_path):
+                self._seed_from_outputs()
+            self._refresh()
+
+    def output_file_path(self, query_id):
+        return os.path.join(self.output_dir, f"{query_id}_{self.method}.json")
+
+    @contextlib.contextmanager
+    def locked(self):
+        # lockf locks belong to the process and closing any fd of the file drops them, so the threads of this
+        # process take turns on self.lock before one of them takes the file lock
+        with self.lock, file_lock(self.lock_path):
+            yield
+
+    def _seed_from_outputs(self):
+        '''
+        Answers written before the manifest existed count as done, so old output directories resume correctly.
+        '''
+        suffix = f"_{self.method}.json"
+        now = time.time()
+        with open(self.manifest_path, "a") as writer:
+            for file in os.listdir(self.output_dir):
+                if file.endswith(suffix):
+                    record = {"key": file[:-len(suffix)], "state": "done", "host": self.host, "pid": os.getpid(), "time": now}
+                    writer.write(json.dumps(record) + "\n")
+
+    def _refresh(self):
+        '''
+        Read the records appended by other workers since the last call. Caller must hold the lock.
+        '''
+        with open(self.manifest_path, "r") as reader:
+            reader.seek(self.offset)
+            for line in reader:
+                if not line.endswith("\n"):
+                    break  # partially written line, read it next time
+                self.offset += len(line.encode("utf-8"))
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.states[record["key"]] = record
+
+    def _append(self, key, state):
+        record = {"key": key, "state": state, "host": self.host, "pid": os.getpid(), "time": time.time()}
+        with open(self.manifest_path, "a") as writer:
+            writer.write(json.dumps(record) + "\n")
+            writer.flush()
+            os.fsync(writer.fileno())
+        self._refresh()
+
+    def _claim_is_alive(self, record):
+        if record["host"] == self.host:
+            try:
+                os.kill(record["pid"], 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                return True
+            return True
+        # we cannot probe processes on other machines, fall back to a lease
+        return time.time() - record["time"] < self.lease_seconds
+
+    def _is_done(self, query_id):
+        record = self.states.get(str(query_id))
+        return record is not None and record["state"] == "done"
+
+    def is_done(self, query_id):
+        with self.lock:
+            return self._is_done(query_id)
+
+    def pending(self, task_list, key=lambda task: task[2]):
+        with self.locked():
+            self._refresh()
+            return [task for task in task_list if not self._is_done(key(task))]
+
+    def claim(self, query_id):
+        '''
+        Returns True if this worker now owns query_id, False if it is done or owned by a live worker
+        '''
+        key = str(query_id)
+        with self.locked():
+            self._refresh()
+            record = self.states.get(key)
+            if record is not None:
+                if record["state"] == "done":
+                    return False
+                if record["state"] == "claimed":
+                    if self._claim_is_alive(record):
+                        return False
+                    # the owner died; it may have written the answer before it could mark it done
+                    if os.path.exists(self.output_file_path(key)):
+                        self._append(key, "done")
+                        return False
+            self._append(key, "claimed")
+            return True
+
+    def finish(self, query_id):
+        with self.locked():
+            self._append(str(query_id), "done")
+
+    def release(self, query_id):
+        with self.locked():
+            self._append(str(query_id), "released")
+
+
+class file_lock:
+    # fcntl.lockf (unlike flock) is also honoured on NFS, which is how several machines share one output directory
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
@@ -0,0 +1,210 @@
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from tqdm import tqdm
+from toolbench.utils import standardize, change_name
+from toolbench.inference.Downstream_tasks.task_manifest import file_lock
+
+CATALOG_VERSION = "1"
+CATALOG_FILE_NAME = ".tool_catalog.sqlite"
+
+
+def tree_signature(tool_root_dir):
+    '''
+    Hash of (category, file, mtime, size) of every <category>/<tool>.json. Only stats the files, never parses them.
+    '''
+    digest = hashlib.sha1(CATALOG_VERSION.encode("utf-8"))
+    for cate in sorted(os.listdir(tool_root_dir)):
+        cate_dir = os.path.join(tool_root_dir, cate)
+        if not os.path.isdir(cate_dir):
+            continue
+        for entry in sorted(os.scandir(cate_dir), key=lambda entry: entry.name):
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            digest.update(f"{cate}/{entry.name}:{stat.st_mtime_ns}:{stat.st_size}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def default_catalog_path(tool_root_dir):
+    '''
+    Next to the tools if the tree is writable, otherwise in the temp dir keyed by the tree path.
+    '''
+    if os.access(tool_root_dir, os.W_OK):
+        return os.path.join(tool_root_dir, CATALOG_FILE_NAME)
+    path_hash = hashlib.sha1(os.path.abspath(tool_root_dir).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"tool_catalog_{path_hash}.sqlite")
+
+
+class tool_catalog:
+    """Compiled index of the tool tree, stored in SQLite and rebuilt when the tree signature changes.
+
+    tools: (category, tool_file) -> origin tool name, standardized tool name, description
+    apis: (category, tool_file, standardized api name) -> api dict
+    tool_file is the file name without ".json", which is what query files call the standardized tool name.
+    """
+
+    def __init__(self, tool_root_dir, catalog_path=None):
+        self.tool_root_dir = tool_root_dir
+        self.catalog_path = catalog_path or default_catalog_path(tool_root_dir)
+        self.lock = threading.Lock()
+        signature = tree_signature(tool_root_dir)
+        with file_lock(self.catalog_path + ".lock"):
+            if self._stored_signature() != signature:
+                self._build(signature)
+        self.conn = sqlite3.connect(f"file:{self.catalog_path}?mode=ro", uri=True, check_same_thread=False)
+        self._white_list = None
+        self._tool_files = None
+
+    def _stored_signature(self):
+        if not os.path.exists(self.catalog_path):
+            return None
+        try:
+            conn = sqlite3.connect(self.catalog_path)
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError:
+            return None
+        return row[0] if row else None
+
+    def _build(self, signature):
+        print(f"Building tool catalog of {self.tool_root_dir}...")
+        tmp_path = self.catalog_path + f".tmp{os.getpid()}"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE tools (category TEXT, tool_file TEXT, standard_name TEXT, tool_name TEXT, description TEXT,
+                                PRIMARY KEY (category, tool_file));
+            CREATE TABLE apis (category TEXT, tool_file TEXT, api_name TEXT, api_json TEXT,
+                               PRIMARY KEY (category, tool_file, api_name));
+        """)
+        for cate in tqdm(os.listdir(self.tool_root_dir)):
+            cate_dir = os.path.join(self.tool_root_dir, cate)
+            if not os.path.isdir(cate_dir):
+                continue
+            for file in os.listdir(cate_dir):
+                if not file.endswith(".json"):
+                    continue
+                with open(os.path.join(cate_dir, file)) as reader:
+                    js_data = json.load(reader)
+                tool_file = file.split(".")[0]
+                conn.execute("INSERT OR REPLACE INTO tools VALUES (?, ?, ?, ?, ?)",
+                             (cate, tool_file, standardize(js_data["tool_name"]), js_data["tool_name"],
+                              js_data["tool_description"]))
+                for api_dict in js_data.get("api_list", []):
+                    # the first api with a given standardized name wins, like the former linear scan
+                    conn.execute("INSERT OR IGNORE INTO apis VALUES (?, ?, ?, ?)",
+                                 (cate, tool_file, change_name(standardize(api_dict["name"])), json.dumps(api_dict)))
+        conn.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, self.catalog_path)
+
+    def white_list(self):
+        '''
+        standardized origin tool name -> {"description", "standard_tool_name"}, same as the former get_white_list
+        '''
+        if self._white_list is None:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT standard_name, description, tool_file FROM tools ORDER BY rowid").fetchall()
+            self._white_list = {standard_name: {"description": description, "standard_tool_name": tool_file}
+                                for standard_name, description, tool_file in rows}
+        return self._white_list
+
+    def tool_files(self):
+        '''
+        category -> set of tool files, for existence checks
+        '''
+        if self._tool_files is None:
+            with self.lock:
+                rows = self.conn.execute("SELECT category, tool_file FROM tools").fetchall()
+            tool_files = {}
+            for category, tool_file in rows:
+                tool_files.setdefault(category, set()).add(tool_file)
+            self._tool_files = tool_files
+        return self._tool_files
+
+    def has_tool(self, category, tool_file):
+        return tool_file in self.tool_files().get(category, ())
+
+    def tool_name(self, category, tool_file):
+        with self.lock:
+            row = self.conn.execute("SELECT tool_name FROM tools WHERE category = ? AND tool_file = ?",
+                                    (category, tool_file)).fetchone()
+        return row[0] if row else None
+
+    def load_tool(self, category, tool_file):
+        '''
+        {"tool_name", "api_index": standardized api name -> api dict, "api_names": [origin api names]}, None if unknown
+        '''
+        tool_name = self.tool_name(category, tool_file)
+        if tool_name is None:
+            return None
+        with self.lock:
+            rows = self.conn.execute("SELECT api_name, api_json FROM apis WHERE category = ? AND tool_file = ? ORDER BY rowid",
+                                     (category, tool_file)).fetchall()
+        api_index = {api_name: json.loads(api_json) for api_name, api_json in rows}
+        return {"tool_name": tool_name, "api_index": api_index,
+                "api_names": [api_dict["name"] for api_dict in api_index.values()]}
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(tool_root_dir):
+    '''
+    Process-wide catalog per tool tree. The tree signature is checked once per process.
+    '''
+    key = os.path.abspath(tool_root_dir)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = tool_catalog(tool_root_dir)
+            _catalogs[key] = catalog
+        return catalog
+
+
+class tool_definition_cache:
+    """Bounded LRU of parsed tool definitions (see tool_catalog.load_tool), shared by all envs of a process.
+
+    The cached api dicts are shared, callers must copy what they mutate.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, tool_root_dir, category, tool_file):
+        key = (os.path.abspath(tool_root_dir), category, tool_file)
+        with self.lock:
+            definition = self.entries.get(key)
+            if definition is not None:
+                self.entries.move_to_end(key)
+                return definition
+        definition = get_catalog(tool_root_dir).load_tool(category, tool_file)
+        if definition is None:
+            return None
+        with self.lock:
+            self.entries[key] = definition
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return definition
+
+
+_tool_definitions = tool_definition_cache()
+
+
+def get_tool_definition(tool_root_dir, category, tool_file):
+    return _tool_definitions.get(tool_root_dir, category, tool_file)
@@ -0,0 +1,179 @@
+'''
+Worker processes running the customized tool code (use_rapidapi_key / api_customization).
+
+get_rapidapi_response runs the code of the tool in the calling thread: a tool that hangs stalls its chain for
+good, and one that leaks or spins takes the whole process with it. tool_executor keeps warm worker processes
+instead, each one with a memory cap and a cpu cap per call, and gives every call a deadline. A worker that misses
+the deadline or dies is killed and replaced by a new one, which imports the tool modules seen so far before
+taking calls. The chains of a process share the workers, one call per worker at a time.
+'''
+import queue
+import signal
+import resource
+import importlib
+import threading
+import multiprocessing
+from toolbench.inference.server import Info, prepare_tool_name_and_url
+
+TOOLS_ROOT = "data.toolenv.tools"
+# seconds a new worker has to import its modules, not counted in the deadline of its first call
+STARTUP_TIMEOUT = 300
+TIMEOUT_RESPONSE = {"error": "Timeout error...", "response": ""}
+
+
+class tool_timeout(Exception):
+    pass
+
+
+class tool_worker_error(Exception):
+    pass
+
+
+class _cpu_limit_exceeded(BaseException):
+    # not an Exception, so the tool code can not swallow it
+    pass
+
+
+def _raise_cpu_limit(signum, frame):
+    raise _cpu_limit_exceeded()
+
+
+def _set_cpu_limit(seconds):
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        soft = hard
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(conn, modules, memory_mb, cpu_seconds):
+    from toolbench.inference.server import get_rapidapi_response
+    if memory_mb:
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        limit = memory_mb * 2 ** 20
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+    signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+    for module_name in modules:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            pass
+    conn.send("ready")
+    while True:
+        try:
+            payload, api_customization = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if cpu_seconds:
+                _set_cpu_limit(cpu_seconds)
+            try:
+                reply = (True, get_rapidapi_response(payload, api_customization=api_customization))
+            finally:
+                if cpu_seconds:
+                    _set_cpu_limit(None)
+        except _cpu_limit_exceeded:
+            reply = (True, dict(TIMEOUT_RESPONSE))
+        except Exception as e:
+            reply = (False, f"{type(e).__name__}: {e}")
+        conn.send(reply)
+
+
+class tool_worker:
+    def __init__(self, context, modules, memory_mb, cpu_seconds):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, list(modules), memory_mb, cpu_seconds),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def call(self, payload, api_customization, timeout):
+        if not self.ready:
+            if not self.conn.poll(STARTUP_TIMEOUT):
+                raise EOFError("tool worker did not start")
+            self.conn.recv()
+            self.ready = True
+        self.conn.send((payload, api_customization))
+        if not self.conn.poll(timeout):
+            raise tool_timeout()
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class tool_executor:
+    def __init__(self, workers=4, timeout=30, memory_mb=4096, modules=()):
+        '''
+        timeout: deadline of a call in seconds, also its cpu cap
+        memory_mb: data segment cap of a worker, heap and private mappings (0 for none)
+        modules: tool modules the workers import when they start
+        '''
+        # not fork: the search threads and a local model may be running in this process. The fork server is a
+        # fresh process that imports the server module once, the workers forked from it start warm.
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(["toolbench.inference.server"])
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.modules = set(modules)
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        for _ in range(workers):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        with self.lock:
+            modules = list(self.modules)
+        return tool_worker(self.context, modules, self.memory_mb, self.timeout)
+
+    def execute(self, payload, api_customization=False):
+        '''
+        get_rapidapi_response(payload) in a worker. Raises tool_timeout past the deadline, tool_worker_error when
+        the worker dies, and RuntimeError with the error of get_rapidapi_response itself.
+        '''
+        info = Info(category=payload["category"], tool_name=payload["tool_name"], api_name=payload["api_name"],
+                    tool_input=payload["tool_input"], strip=payload["strip"])
+        module_name = prepare_tool_name_and_url(TOOLS_ROOT, info)[3]
+        worker = self.idle.get()
+        try:
+            ok, result = worker.call(payload, api_customization, self.timeout)
+        except tool_timeout:
+            worker.kill()
+            worker = self.spawn()
+            raise
+        except (EOFError, OSError) as e:
+            worker.kill()
+            worker = self.spawn()
+            raise tool_worker_error(f"tool worker died: {e!r}")
+        finally:
+            self.idle.put(worker)
+        if not ok:
+            raise RuntimeError(result)
+        # preloaded by the next workers, once it is known not to hang
+        with self.lock:
+            self.modules.add(module_name)
+        return result
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_tool_executor(workers=4, timeout=30, memory_mb=4096):
+    '''
+    One executor per process. The settings of the first caller win.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = tool_executor(workers, timeout, memory_mb)
+        return _executor
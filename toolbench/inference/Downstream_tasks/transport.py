@@ -0,0 +1,108 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+RATE_LIMIT_ERRORS = (b"Rate limit per minute error...", b"Too many requests error...")
+
+
+class token_bucket:
+    """Thread-safe token bucket. rate_per_minute=None or 0 disables limiting.
+
+    penalize() pauses the whole bucket, so a rate-limit answer seen by one task slows down every task
+    sharing the service instead of each of them discovering the limit on its own.
+    """
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0 if rate_per_minute else None
+        self.capacity = burst if burst is not None else max(1, int(rate_per_minute or 0) // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None and self.paused_until == 0.0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class rapidapi_transport:
+    """Keep-alive session and rate limiter for one service url, shared by every env in the process"""
+
+    def __init__(self, service_url, calls_per_minute=30, pool_size=32, max_retries=4, backoff_base=2.0, backoff_max=60.0):
+        self.service_url = service_url
+        self.bucket = token_bucket(calls_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def is_rate_limited(self, response):
+        if response.status_code == 429:
+            return True
+        return response.status_code == 200 and any(error in response.content for error in RATE_LIMIT_ERRORS)
+
+    def backoff_seconds(self, attempt, response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # full jitter, so workers that were limited together do not retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def post(self, payload, headers=None, timeout=None):
+        '''
+        POST payload to the service, retrying with backoff while the service reports a rate limit.
+        Returns the last requests.Response, raises requests exceptions like requests.post
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            response = self.session.post(self.service_url, json=payload, headers=headers, timeout=timeout)
+            if not self.is_rate_limited(response) or attempt == self.max_retries:
+                return response
+            delay = self.backoff_seconds(attempt, response)
+            print(f"Reach api calling limit of {self.service_url}, backing off {delay:.1f}s...")
+            self.bucket.penalize(delay)
+        return response
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(service_url, calls_per_minute=30):
+    '''
+    One transport per service url and process. The rate limit of the first caller wins.
+    '''
+    with _transports_lock:
+        transport = _transports.get(service_url)
+        if transport is None:
+            transport = rapidapi_transport(service_url, calls_per_minute=calls_per_minute)
+            _transports[service_url] = transport
+        return transport
@@ -0,0 +1,265 @@
+'''
+Continuous batching for the local ToolLLaMA models.
+
+generate_stream decodes one prompt at a time, so chains sharing a model wait for each other's whole generation.
+batch_scheduler owns the model in a background thread and decodes all the requests in flight together, one token
+per step: a new request is prefilled and joins the batch between two steps, a finished one leaves it at once and
+its caller gets its result. Sequences of different lengths share one left padded kv cache, masked by the
+attention mask, each with its own position ids.
+
+The result of a request is the last event generate_stream would have yielded for it.
+'''
+import queue
+import atexit
+import threading
+from concurrent.futures import Future
+
+import torch
+
+from toolbench.inference.utils import prepare_logits_processor, generate_stream, stop_checker
+from toolbench.inference.LLM.prefix_cache import to_legacy
+
+
+class sequence:
+    '''
+    One request: its sampling parameters, its tokens and its Future
+    '''
+
+    def __init__(self, params, tokenizer, context_len, force_generate):
+        self.params = params
+        self.future = Future()
+        self.temperature = float(params.get("temperature", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        top_k = int(params.get("top_k", -1))  # -1 means disable
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.checker = stop_checker(tokenizer, params.get("stop", None), bool(params.get("stop_on_action", False)))
+        self.echo = bool(params.get("echo", True))
+        self.stop_token_ids = set(params.get("stop_token_ids", None) or []) | {tokenizer.eos_token_id}
+        self.force_generate = force_generate
+        self.logits_processor = prepare_logits_processor(self.temperature, self.repetition_penalty, self.top_p, top_k)
+
+        input_ids = tokenizer(params["prompt"]).input_ids
+        self.input_echo_len = len(input_ids)
+        self.output_ids = list(input_ids)
+        self.input_ids = input_ids[-(context_len - self.max_new_tokens - 8):]
+        # tokens in the kv cache, also the position of the next token fed
+        self.position = len(self.input_ids)
+        self.generated = 0
+        # output_ids as a tensor for the repetition penalty, filled in place
+        self.penalty_ids = None
+
+    def sample(self, logits, device):
+        '''
+        logits: [vocab] of the last position. Appends the next token, returns True when the sequence is done.
+        '''
+        if self.logits_processor:
+            if self.repetition_penalty > 1.0:
+                if self.penalty_ids is None:
+                    self.penalty_ids = torch.empty((1, len(self.output_ids) + self.max_new_tokens), dtype=torch.long,
+                                                   device=logits.device)
+                    self.penalty_ids[0, :len(self.output_ids)] = torch.as_tensor(self.output_ids, device=logits.device)
+                output_ids = self.penalty_ids[:, :len(self.output_ids)]
+            else:
+                output_ids = None
+            logits = self.logits_processor(output_ids, logits.unsqueeze(0))[0]
+        if device == "mps":
+            logits = logits.float().to("cpu")
+        if self.temperature < 1e-5 or self.top_p < 1e-8:  # greedy
+            token = int(torch.argmax(logits))
+        else:
+            probs = torch.softmax(logits, dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1))
+        if self.penalty_ids is not None:
+            self.penalty_ids[0, len(self.output_ids)] = token
+        self.output_ids.append(token)
+        i = self.generated
+        self.generated += 1
+        stopped = (token in self.stop_token_ids or self.checker.add(token)) and not (i == 0 and self.force_generate)
+        return stopped or i == self.max_new_tokens - 1
+
+    def result(self, tokenizer):
+        '''
+        The final event of generate_stream for this sequence
+        '''
+        i = self.generated - 1
+        output_ids = self.output_ids if self.echo else self.output_ids[self.input_echo_len:]
+        output = tokenizer.decode(output_ids, skip_special_tokens=True, spaces_between_special_tokens=False)
+        stopped = self.output_ids[-1] in self.stop_token_ids and not (i == 0 and self.force_generate)
+        if self.checker.stopped:
+            output = self.checker.cut(output)
+            stopped = True
+        if i == self.max_new_tokens - 1:
+            finish_reason = "length"
+        elif stopped:
+            finish_reason = "stop"
+        else:
+            finish_reason = None
+        return {
+            "text": output,
+            "usage": {
+                "prompt_tokens": self.input_echo_len,
+                "completion_tokens": i,
+                "total_tokens": self.input_echo_len + i,
+            },
+            "finish_reason": finish_reason,
+        }
+
+
+def _left_pad(past, mask, length):
+    '''
+    Left pad a (legacy tuple) kv cache [batch, heads, len, dim] and its attention mask [batch, len] to length
+    '''
+    pad = length - mask.shape[1]
+    if pad == 0:
+        return past, mask
+    past = tuple(tuple(torch.nn.functional.pad(tensor, (0, 0, pad, 0)) for tensor in layer) for layer in past)
+    mask = torch.nn.functional.pad(mask, (pad, 0))
+    return past, mask
+
+
+class batch_scheduler:
+    def __init__(self, model, tokenizer, device, context_len=8192, max_batch_size=8, force_generate=False,
+                 prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.device = device
+        self.context_len = context_len
+        self.max_batch_size = max_batch_size
+        self.force_generate = force_generate
+        self.cache_type = None
+        self.waiting = queue.Queue()
+        self.running = []
+        self.past = None
+        self.mask = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, params):
+        '''
+        Queue a generation, returns a Future of its final generate_stream event
+        '''
+        seq = sequence(params, self.tokenizer, self.context_len, self.force_generate)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name="batch_scheduler", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+        self.waiting.put(seq)
+        return seq.future
+
+    def close(self):
+        '''
+        Stop the decoding thread once the requests already queued are done
+        '''
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.waiting.put(None)
+            thread.join()
+
+    def generate(self, params):
+        if self.model.config.is_encoder_decoder:
+            # not batched, decoder-only models only
+            output = None
+            for output in generate_stream(self.model, self.tokenizer, params, self.device, self.context_len,
+                                          force_generate=self.force_generate, prefix_cache=self.prefix_cache):
+                pass
+            return output
+        return self.submit(params).result()
+
+    def loop(self):
+        with torch.inference_mode():
+            while True:
+                try:
+                    if not self.admit():
+                        # closed, and everything queued before is done
+                        return
+                    if self.running:
+                        self.step()
+                except Exception as e:
+                    # fail the requests in flight, keep serving the next ones
+                    for seq in self.running:
+                        seq.future.set_exception(e)
+                    self.running, self.past, self.mask = [], None, None
+
+    def admit(self):
+        '''
+        Prefill waiting requests into the batch, blocking while idle until a request or close comes. Returns
+        False once closed.
+        '''
+        while len(self.running) < self.max_batch_size:
+            try:
+                seq = self.waiting.get(block=not self.running)
+            except queue.Empty:
+                return True
+            if seq is None:
+                if self.running or not self.waiting.empty():
+                    # let the requests queued before close finish first
+                    self.waiting.put(None)
+                    return True
+                return False
+            if seq.future.set_running_or_notify_cancel():
+                try:
+                    self.prefill(seq)
+                except Exception as e:
+                    seq.future.set_exception(e)
+        return True
+
+    def prefill(self, seq):
+        reused, past = 0, None
+        if self.prefix_cache is not None:
+            reused, past = self.prefix_cache.lookup(seq.input_ids)
+            if past is not None and self.cache_type is not None:
+                past = self.cache_type.from_legacy_cache(past)
+        out = self.model(torch.as_tensor([seq.input_ids[reused:]], device=self.device), use_cache=True,
+                         past_key_values=past)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.input_ids, out.past_key_values)
+        if self.cache_type is None and hasattr(out.past_key_values, "to_legacy_cache"):
+            self.cache_type = type(out.past_key_values)
+        if seq.sample(out.logits[0, -1, :], self.device):
+            seq.future.set_result(seq.result(self.tokenizer))
+            return
+        past = to_legacy(out.past_key_values)
+        mask = torch.ones((1, seq.position), dtype=torch.long, device=self.device)
+        if self.past is None:
+            self.past, self.mask = past, mask
+        else:
+            length = max(self.mask.shape[1], mask.shape[1])
+            self.past, self.mask = _left_pad(self.past, self.mask, length)
+            past, mask = _left_pad(past, mask, length)
+            self.past = tuple(tuple(torch.cat([old, new], dim=0) for old, new in zip(old_layer, new_layer))
+                              for old_layer, new_layer in zip(self.past, past))
+            self.mask = torch.cat([self.mask, mask], dim=0)
+        self.running.append(seq)
+
+    def step(self):
+        input_ids = torch.as_tensor([[seq.output_ids[-1]] for seq in self.running], device=self.device)
+        position_ids = torch.as_tensor([[seq.position] for seq in self.running], device=self.device)
+        mask = torch.cat([self.mask, self.mask.new_ones((len(self.running), 1))], dim=1)
+        past = self.past if self.cache_type is None else self.cache_type.from_legacy_cache(self.past)
+        out = self.model(input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+                         past_key_values=past, use_cache=True)
+        self.past, self.mask = to_legacy(out.past_key_values), mask
+
+        keep = []
+        for row, seq in enumerate(self.running):
+            seq.position += 1
+            if seq.sample(out.logits[row, -1, :], self.device):
+                seq.future.set_result(seq.result(self.tokenizer))
+            else:
+                keep.append(row)
+        if len(keep) == len(self.running):
+            return
+        self.running = [self.running[row] for row in keep]
+        if not keep:
+            self.past, self.mask = None, None
+            return
+        index = torch.as_tensor(keep, device=self.mask.device)
+        mask = self.mask.index_select(0, index)
+        # drop the columns that are padding for every remaining sequence
+        start = int(mask.any(dim=0).nonzero()[0])
+        self.mask = mask[:, start:]
+        self.past = tuple(tuple(tensor.index_select(0, index)[:, :, start:] for tensor in layer) for layer in self.past)
@@ -1,16 +1,13 @@
 import os
 
-from openai import OpenAI
-import httpx
-from tenacity import retry, wait_random_exponential, stop_after_attempt
 from termcolor import colored
 import time
 import json
 import traceback
+from toolbench import client_pool
+from toolbench.inference.LLM.streaming import tool_call_stream
 
-@retry(wait=wait_random_exponential(min=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(key, base_url, messages, tools=None, tool_choice=None, key_pos=None,
-                            model="gpt-3.5-turbo", stop=None, process_id=0, **args):
+def build_request(messages, tools=None, tool_choice=None, model="gpt-3.5-turbo", stop=None, **args):
     use_messages = []
     for message in messages:
         if not ("valid" in message.keys() and message["valid"] == False):
@@ -34,28 +31,86 @@ def chat_completion_request(key, base_url, messages, tools=None, tool_choice=Non
         json_data.update({"tools": tools})
     if tool_choice is not None:
         json_data.update({"tool_choice": tool_choice})
+    return json_data
+
+
+def get_endpoint(key, base_url, model):
+    '''
+    (base_url, key) of the shared client in client_pool
+    '''
+    if model.startswith("gpt"):
+        return base_url or None, key
+    elif model.startswith("llama"):
+        return 'http://localhost:11434/v1/', 'ollama'
+    raise NotImplementedError("Model not supported")
+
+
+def chat_completion_request(key, base_url, messages, tools=None, tool_choice=None, key_pos=None,
+                            model="gpt-3.5-turbo", stop=None, process_id=0, **args):
+    json_data = build_request(messages, tools=tools, tool_choice=tool_choice, model=model, stop=stop, **args)
 
     try:
-        if model.startswith("gpt"):
-            client = OpenAI(base_url=base_url, api_key=key) if base_url else OpenAI(api_key=key)
-        elif model.startswith("llama"):
-            client = OpenAI(
-                base_url='http://localhost:11434/v1/',
-                api_key='ollama',
-            )
-        else:
-            raise NotImplementedError("Model not supported")
-        openai_response = client.chat.completions.create(**json_data)
+        openai_response = client_pool.request(*get_endpoint(key, base_url, model),
+                                              lambda client: client.chat.completions.create(**json_data))
         json_data = openai_response.dict()
         return json_data
 
     except Exception as e:
         print("Unable to generate ChatCompletion response")
         traceback.print_exc()
-        import pdb;  pdb.set_trace()
+        return {"error": str(e), "total_tokens": 0}
+
+
+def stream_chat_completion_request(key, base_url, messages, tools=None, tool_choice=None, key_pos=None,
+                                   model="gpt-3.5-turbo", stop=None, process_id=0, on_tool_call=None, **args):
+    '''
+    Same answer as chat_completion_request, read as a stream: every tool call is given to on_tool_call as soon as
+    its arguments are complete, and the generation is cancelled once a Finish call is.
+    '''
+    json_data = build_request(messages, tools=tools, tool_choice=tool_choice, model=model, stop=stop, **args)
+    json_data.update({"stream": True, "stream_options": {"include_usage": True}})
+
+    def read_stream(client):
+        # a retried request starts over, early_tool_calls does not send a call index twice
+        stream = client.chat.completions.create(**json_data)
+        calls = tool_call_stream(on_tool_call)
+        content = []
+        usage = None
+        chunk_count = 0
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage.dict()
+            if not chunk.choices:
+                continue
+            chunk_count += 1
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content.append(delta.content)
+            if calls.feed(delta.tool_calls):
+                stream.close()
+                break
+        if usage is None:
+            # cancelled before the usage chunk, a chunk is about one token
+            usage = {"total_tokens": chunk_count}
+        message = {
+            "role": "assistant",
+            "content": "".join(content) if content else None,
+            "tool_calls": calls.tool_calls() or None,
+        }
+        return {"choices": [{"message": message}], "usage": usage}
+
+    try:
+        return client_pool.request(*get_endpoint(key, base_url, model), read_stream)
+
+    except Exception as e:
+        print("Unable to generate ChatCompletion response")
+        traceback.print_exc()
         return {"error": str(e), "total_tokens": 0}
 
 class ChatGPTFunction:
+    # parse accepts on_tool_call, see LLM/streaming.py
+    supports_tool_call_stream = True
+
     def __init__(self, model="gpt-4-turbo-2024-04-09", openai_key="", base_url=None):
         self.model = model
         self.conversation_history = []
@@ -99,20 +154,28 @@ class ChatGPTFunction:
             )
         print("end_print" + "*" * 50)
 
-    def parse(self, tools, process_id, key_pos=None, **args):
+    def parse(self, tools, process_id, key_pos=None, on_tool_call=None, **args):
+        '''
+        on_tool_call(index, name, arguments): stream the answer and call it for every tool call as soon as its
+        arguments are complete, while the rest of the message is still generated
+        '''
 
         self.time = time.time()
         conversation_history = self.conversation_history
+        request = chat_completion_request
+        if on_tool_call is not None:
+            request = stream_chat_completion_request
+            args["on_tool_call"] = on_tool_call
         for _ in range(self.TRY_TIME):
             if _ != 0:
-                time.sleep(15)
+                time.sleep(client_pool.backoff_delay(_))
             if tools != []:
-                response = chat_completion_request(
+                response = request(
                     self.openai_key, self.base_url, conversation_history, tools=tools, process_id=process_id, key_pos=key_pos,
                     model=self.model, **args
                 )
             else:
-                response = chat_completion_request(
+                response = request(
                     self.openai_key, self.base_url, conversation_history, process_id=process_id, key_pos=key_pos, model=self.model, **args
                 )
             try:
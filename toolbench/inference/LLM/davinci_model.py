@@ -5,6 +5,7 @@ from termcolor import colored
 import json
 import random
 import openai
+from toolbench import client_pool
 from typing import Optional
 from toolbench.model.model_adapter import get_conversation_template
 from toolbench.inference.utils import SimpleChatIO, react_parser
@@ -19,30 +20,23 @@ class Davinci:
         self.chatio = SimpleChatIO()
 
     def prediction(self, prompt: str, stop: Optional[List[str]] = None) -> str:
-        max_try = 10
-        while True:
-            openai.api_key = self.openai_key
-            try:
-                response = openai.Completion.create(
-                    engine=self.model,
-                    prompt=prompt,
-                    temperature=0.5,
-                    max_tokens=512,
-                    top_p=1,
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                    stop="End Action"
+        try:
+            response = client_pool.request(None, self.openai_key, lambda client: client.completions.create(
+                model=self.model,
+                prompt=prompt,
+                temperature=0.5,
+                max_tokens=512,
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                stop="End Action"
 
-                )
-                result = response['choices'][0]['text'].strip()
-                break
-            except Exception as e:
-                print(e)
-                max_try -= 1
-                if max_try < 0:
-                    result = "Exceed max retry times. Please check your davinci api calling."
-                    break
-        return result, response["usage"]
+            ))
+        except openai.OpenAIError as e:
+            print(e)
+            return "Exceed max retry times. Please check your davinci api calling.", {"total_tokens": 0}
+        result = response.choices[0].text.strip()
+        return result, response.usage.dict()
         
     def add_message(self, message):
         self.conversation_history.append(message)
@@ -5,29 +5,27 @@ from typing import Optional
 
 from toolbench.utils import process_system_message
 from toolbench.inference.utils import SimpleChatIO, generate_stream, react_parser
-from openai import OpenAI,OpenAIError
+from openai import OpenAIError
+from toolbench import client_pool
 class LlamaModel:
     def __init__(self,key, model_name_or_path,base_url,  template:str="tool-llama-single-round", device: str="cuda", cpu_offloading: bool=False, max_sequence_length: int=2048) -> None:
         super().__init__()
         self.model_name = model_name_or_path
         self.template = template
         self.max_sequence_length = max_sequence_length
-        self.client = OpenAI(base_url=base_url, api_key=key) if base_url else OpenAI(api_key=key)
+        self.base_url = base_url or None
+        self.key = key
 
     def prediction(self, prompt: str) -> str:
-        max_retries = 2
-        for attempt in range(max_retries + 1):
-            try:
-                response = self.client.chat.completions.create(**prompt)
-                prediction = response.choices[0].message.content.strip()
-                total_tokens = response.usage.total_tokens
-
-                return prediction, total_tokens
-            except OpenAIError as e:
-                if attempt < max_retries:
-                    time.sleep(100)
-                else:
-                    return str(e), 0
+        try:
+            response = client_pool.request(self.base_url, self.key,
+                                           lambda client: client.chat.completions.create(**prompt))
+        except OpenAIError as e:
+            return str(e), 0
+        prediction = response.choices[0].message.content.strip()
+        total_tokens = response.usage.total_tokens
+
+        return prediction, total_tokens
 
     def add_message(self, message):
         self.conversation_history.append(message)
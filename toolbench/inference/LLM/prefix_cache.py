@@ -0,0 +1,123 @@
+'''
+Prefix kv cache for the local models.
+
+Consecutive steps of a chain, and the siblings DFS expands from one node, send prompts that only differ at the
+end: the system message with all the functions and the former turns come again every time. The cache keeps the
+past key/values of former prompts and gives back the longest one sharing a prefix with a new prompt, so only the
+new suffix is prefilled.
+
+Prefixes are matched by block of block_size tokens, through a chained hash of the blocks, so a lookup costs one
+pass over the prompt. The hash only finds a candidate: its tokens are compared with the prompt before its kv is
+reused. Entries are evicted least recently used first, to stay under a memory budget.
+'''
+import threading
+from collections import OrderedDict
+
+
+def to_legacy(past):
+    '''
+    ((key, value) per layer), [batch, heads, len, dim], whatever cache object the model returned
+    '''
+    return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+
+def block_hashes(input_ids, block_size):
+    '''
+    hash of input_ids[:block_size * (k + 1)] for every complete block k
+    '''
+    hashes = []
+    running = 0
+    for start in range(0, len(input_ids) - block_size + 1, block_size):
+        running = hash((running, tuple(input_ids[start:start + block_size])))
+        hashes.append(running)
+    return hashes
+
+
+class prefix_entry:
+    __slots__ = ("past", "tokens", "nbytes", "hashes")
+
+    def __init__(self, past, tokens, hashes):
+        self.past = past
+        # the token ids the kv is of, a hash match is checked against them
+        self.tokens = tokens
+        self.hashes = hashes
+        self.nbytes = sum(tensor.numel() * tensor.element_size() for layer in past for tensor in layer)
+
+
+class prefix_kv_cache:
+    def __init__(self, budget_mb=1024, block_size=32):
+        self.budget = int(budget_mb * 2 ** 20)
+        self.block_size = block_size
+        # full prompt hash -> entry, in lru order
+        self.entries = OrderedDict()
+        # block prefix hash -> full prompt hash of the latest entry starting with that prefix
+        self.index = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, input_ids):
+        '''
+        Returns (n, past): the kv of input_ids[:n] for the longest cached prefix, at least one token is left to
+        prefill. (0, None) on a miss.
+        '''
+        hashes = block_hashes(input_ids[:len(input_ids) - 1], self.block_size)
+        with self.lock:
+            for k in range(len(hashes) - 1, -1, -1):
+                key = self.index.get(hashes[k])
+                if key is None:
+                    continue
+                entry = self.entries[key]
+                n = (k + 1) * self.block_size
+                if entry.tokens[:n] != tuple(input_ids[:n]):
+                    # hash collision, the kv is of other tokens
+                    continue
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.reused_tokens += n
+                past = entry.past
+                break
+            else:
+                self.misses += 1
+                return 0, None
+        if n < past[0][0].shape[2]:
+            past = tuple(tuple(tensor[:, :, :n] for tensor in layer) for layer in past)
+        return n, past
+
+    def insert(self, input_ids, past):
+        '''
+        past: the kv of exactly input_ids, batch size 1
+        '''
+        hashes = block_hashes(input_ids, self.block_size)
+        if not hashes:
+            return
+        past = to_legacy(past)
+        key = hash((hashes[-1], tuple(input_ids[len(hashes) * self.block_size:])))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            entry = prefix_entry(past, tuple(input_ids), hashes)
+            if entry.nbytes > self.budget:
+                return
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            for block_hash in hashes:
+                self.index[block_hash] = key
+            while self.nbytes > self.budget:
+                self.evict()
+
+    def evict(self):
+        key, entry = self.entries.popitem(last=False)
+        self.nbytes -= entry.nbytes
+        for block_hash in entry.hashes:
+            if self.index.get(block_hash) == key:
+                del self.index[block_hash]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+            self.nbytes = 0
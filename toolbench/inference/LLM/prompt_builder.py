@@ -0,0 +1,121 @@
+'''
+Prompt rendering of the ToolLLaMA backends.
+
+Every step of a chain sends the whole conversation again, and its system message carries the schemas of all the
+functions, serialized with str(). prompt_builder renders the system block once per (system message, functions),
+and remembers the turns of the last prompt it built in the calling thread: the next prompt, which usually extends
+it, only renders its new messages. The token count of every rendered piece is kept with it, so the length of a
+prompt is known without tokenizing the prompt.
+'''
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+from toolbench.utils import process_system_message
+from toolbench.model.model_adapter import get_conversation_template
+
+
+@lru_cache(maxsize=None)
+def template_roles(template):
+    '''
+    openai role -> role written in the prompt, for a conversation template
+    '''
+    conv = get_conversation_template(template)
+    if template == "tool-llama":
+        return {"human": conv.roles[0], "gpt": conv.roles[1]}
+    elif template == "tool-llama-single-round" or template == "tool-llama-multi-rounds":
+        return {"system": conv.roles[0], "user": conv.roles[1], "function": conv.roles[2], "tool": conv.roles[2],
+                "assistant": conv.roles[3]}
+    raise ValueError(f"Unknown prompt template {template}")
+
+
+class rendered_turn:
+    __slots__ = ("message", "content", "functions", "end", "tokens")
+
+    def __init__(self, message, content, functions, end, tokens):
+        self.message = message
+        self.content = content
+        # the function ids a system turn was rendered with, None for the other turns
+        self.functions = functions
+        # length of the prompt and its token count up to the end of this turn
+        self.end = end
+        self.tokens = tokens
+
+
+class prompt_builder:
+    def __init__(self, template, tokenizer=None, max_system_blocks=16):
+        '''
+        tokenizer: counts the tokens of each rendered piece, without it a token is taken as 4 characters
+        '''
+        self.roles = template_roles(template)
+        self.tokenizer = tokenizer
+        self.max_system_blocks = max_system_blocks
+        # (system message, function ids) -> (functions, text, tokens), in lru order. The functions are kept so
+        # that their ids are not reused while the entry lives.
+        self.system_blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.suffix_tokens = self.count_tokens("Assistant:\n")
+
+    def count_tokens(self, text):
+        if self.tokenizer is None:
+            return (len(text) + 3) // 4
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def system_block(self, content, functions):
+        key = (content, tuple(id(function) for function in functions))
+        with self.lock:
+            entry = self.system_blocks.get(key)
+            if entry is not None:
+                self.system_blocks.move_to_end(key)
+                return entry[1], entry[2]
+        text = f"{self.roles['system']}: {process_system_message(content, functions)}\n"
+        tokens = self.count_tokens(text)
+        with self.lock:
+            self.system_blocks[key] = (functions, text, tokens)
+            while len(self.system_blocks) > self.max_system_blocks:
+                self.system_blocks.popitem(last=False)
+        return text, tokens
+
+    def build(self, messages, functions=()):
+        '''
+        The prompt of messages, ending with the assistant turn to generate. The system message lists functions,
+        when there are some.
+        '''
+        turns = getattr(self.local, "turns", [])
+        prompt = getattr(self.local, "prompt", "")
+        function_ids = tuple(id(function) for function in functions)
+        # the turns already rendered by the last call
+        reused = 0
+        for message, turn in zip(messages, turns):
+            if message is not turn.message or message['content'] is not turn.content:
+                break
+            if turn.functions is not None and turn.functions != function_ids:
+                break
+            reused += 1
+        turns = turns[:reused]
+        parts = [prompt[:turns[-1].end]] if turns else []
+        end, tokens = (turns[-1].end, turns[-1].tokens) if turns else (0, 0)
+        for message in messages[reused:]:
+            role = self.roles[message['role']]
+            content = message['content']
+            if role == "System" and functions:
+                text, text_tokens = self.system_block(content, functions)
+            else:
+                text = f"{role}: {content}\n"
+                text_tokens = self.count_tokens(text)
+            turn_functions = function_ids if role == "System" else None
+            end += len(text)
+            tokens += text_tokens
+            parts.append(text)
+            turns.append(rendered_turn(message, content, turn_functions, end, tokens))
+        self.local.turns = turns
+        self.local.prompt = "".join(parts)
+        return self.local.prompt + "Assistant:\n"
+
+    def prompt_tokens(self):
+        '''
+        Estimated token count of the last prompt built in this thread: the sum of the counts of its pieces
+        '''
+        turns = getattr(self.local, "turns", None)
+        return (turns[-1].tokens if turns else 0) + self.suffix_tokens
@@ -0,0 +1,140 @@
+'''
+Incremental parsing of streamed completions, so a tool call can be handed to the env as soon as its arguments are
+complete instead of when the whole message is.
+
+on_tool_call(index, name, arguments) is called once per complete call, from the thread reading the stream.
+'''
+import json
+
+
+class json_scanner:
+    '''
+    Tracks the nesting of a json object as its text arrives. complete is set once the top level object is closed
+    and parses. failed is set when it closes and does not parse, the scanner then takes no more text.
+    '''
+
+    def __init__(self):
+        self.text = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.complete = False
+        self.failed = False
+
+    def feed(self, text):
+        '''
+        Returns the number of characters of text consumed, which is less than len(text) when the object ends
+        inside it.
+        '''
+        if self.complete or self.failed:
+            return 0
+        for position, char in enumerate(text):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                self.started = True
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.text += text[:position + 1]
+                    try:
+                        json.loads(self.text)
+                        self.complete = True
+                    except ValueError:
+                        # not json, the call is left to the final message
+                        self.failed = True
+                    return position + 1
+        self.text += text
+        return len(text)
+
+
+class tool_call_stream:
+    '''
+    Reassembles the tool_calls deltas of a streamed chat completion
+    '''
+
+    def __init__(self, on_tool_call=None):
+        self.on_tool_call = on_tool_call
+        self.calls = {}
+        self.finished = False
+
+    def feed(self, tool_call_deltas):
+        '''
+        Returns True once a complete Finish call was seen, the rest of the generation is then not needed
+        '''
+        for delta in tool_call_deltas or []:
+            call = self.calls.get(delta.index)
+            if call is None:
+                call = self.calls[delta.index] = {"id": "", "name": "", "arguments": "", "scanner": json_scanner(),
+                                                  "sent": False}
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function is not None:
+                if delta.function.name:
+                    call["name"] += delta.function.name
+                if delta.function.arguments:
+                    call["arguments"] += delta.function.arguments
+                    call["scanner"].feed(delta.function.arguments)
+            if call["scanner"].complete and not call["sent"]:
+                call["sent"] = True
+                if self.on_tool_call is not None:
+                    self.on_tool_call(delta.index, call["name"], call["arguments"])
+                if call["name"] == "Finish":
+                    self.finished = True
+        return self.finished
+
+    def tool_calls(self):
+        return [{"id": call["id"], "function": {"name": call["name"], "arguments": call["arguments"]},
+                 "type": "function"} for _, call in sorted(self.calls.items())]
+
+
+class react_stream:
+    '''
+    Watches a streamed ReAct completion ("Thought: ...\\nAction: ...\\nAction Input: {...}") for its single call
+    '''
+
+    def __init__(self, on_tool_call=None):
+        self.on_tool_call = on_tool_call
+        self.text = ""
+        self.scanner = None
+        self.input_start = -1
+        # end of the Action Input json in text once it is complete
+        self.call_end = -1
+        self.finished = False
+
+    def feed(self, text):
+        '''
+        Returns True once a complete Finish call was seen, the rest of the generation is then not needed
+        '''
+        if self.finished:
+            return True
+        self.text += text
+        if self.scanner is None:
+            self.input_start = self.text.find("\nAction Input: ")
+            if self.input_start == -1:
+                return False
+            self.input_start += len("\nAction Input: ")
+            self.scanner = json_scanner()
+            text = self.text[self.input_start:]
+        if self.scanner.complete:
+            return False
+        self.scanner.feed(text)
+        if self.scanner.complete:
+            self.call_end = self.input_start + len(self.scanner.text)
+            action = self.text[self.text.find("Action: ") + len("Action: "): self.text.find("\nAction Input: ")]
+            if self.on_tool_call is not None:
+                self.on_tool_call(0, action, self.scanner.text)
+            self.finished = action == "Finish"
+            if self.finished:
+                # generation stops here, what came after the arguments in the same chunk is dropped
+                self.text = self.text[:self.call_end]
+        return self.finished
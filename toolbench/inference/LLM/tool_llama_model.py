@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding=utf-8
 import time
+import threading
 from termcolor import colored
 from typing import Optional, List
 import torch
@@ -10,9 +11,10 @@ from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
 )
-from toolbench.utils import process_system_message
-from toolbench.model.model_adapter import get_conversation_template
 from toolbench.inference.utils import SimpleChatIO, generate_stream, react_parser
+from toolbench.inference.LLM.batch_scheduler import batch_scheduler
+from toolbench.inference.LLM.prefix_cache import prefix_kv_cache
+from toolbench.inference.LLM.prompt_builder import prompt_builder
 import json, string, random
 
 
@@ -22,8 +24,17 @@ class ToolLLaMA:
             model_name_or_path: str, 
             template:str="tool-llama-single-round", 
             device: str="cpu",
-            max_sequence_length: int=8192
+            max_sequence_length: int=8192,
+            batch_size: int=1,
+            prefix_cache_mb: int=0,
+            cleanup_interval: int=1
         ) -> None:
+        '''
+        batch_size > 1: the generations of concurrent callers are decoded together, see LLM/batch_scheduler.py
+        prefix_cache_mb > 0: past key/values of former prompts are kept up to that size and their common prefix with
+        a new prompt is not prefilled again, see LLM/prefix_cache.py
+        cleanup_interval: gc and cuda cache cleanup after every cleanup_interval-th generation (0 = never)
+        '''
         super().__init__()
         self.model_name = model_name_or_path
         self.template = template
@@ -38,6 +49,15 @@ class ToolLLaMA:
             self.model.resize_token_embeddings(len(self.tokenizer))
         self.use_gpu = (True if device.startswith("cuda") else False)
         self.chatio = SimpleChatIO()
+        self._local = threading.local()
+        self.prompts = prompt_builder(self.template, self.tokenizer)
+        self.cleanup_interval = cleanup_interval
+        self.prefix_cache = prefix_kv_cache(prefix_cache_mb) if prefix_cache_mb > 0 else None
+        self.scheduler = None
+        if batch_size > 1:
+            self.scheduler = batch_scheduler(self.model, self.tokenizer, str(self.model.device), self.max_sequence_length,
+                                             max_batch_size=batch_size, force_generate=True,
+                                             prefix_cache=self.prefix_cache)
 
     def prediction(self, prompt: str, stop: Optional[List[str]] = None) -> str:
         with torch.no_grad():
@@ -48,14 +68,27 @@ class ToolLLaMA:
                 "max_new_tokens": 1024,
                 "stop": "</s>",
                 "stop_token_ids": None,
+                "stop_on_action": True,
                 "echo": False
             }
-            generate_stream_func = generate_stream
-            output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, "cuda", self.max_sequence_length, force_generate=True)
-            outputs = self.chatio.return_output(output_stream)
+            if self.scheduler is not None:
+                outputs = self.scheduler.generate(gen_params)["text"]
+            else:
+                generate_stream_func = generate_stream
+                output_stream = generate_stream_func(self.model, self.tokenizer, gen_params, "cuda", self.max_sequence_length, force_generate=True, prefix_cache=self.prefix_cache, cleanup_interval=self.cleanup_interval)
+                outputs = self.chatio.return_output(output_stream)
             prediction = outputs.strip()
         return prediction
         
+    @property
+    def conversation_history(self):
+        # the worker threads sharing a batching model each have their own conversation
+        return self._local.conversation_history
+
+    @conversation_history.setter
+    def conversation_history(self, messages):
+        self._local.conversation_history = messages
+
     def add_message(self, message):
         self.conversation_history.append(message)
 
@@ -93,33 +126,12 @@ class ToolLLaMA:
         print("end_print"+"*"*50)
 
     def parse(self, tools, process_id, **args):
-        conv = get_conversation_template(self.template)
-        if self.template == "tool-llama":
-            roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
-        elif self.template == "tool-llama-single-round" or self.template == "tool-llama-multi-rounds":
-            roles = {"system": conv.roles[0], "user": conv.roles[1], "function": conv.roles[2], "tool": conv.roles[2], "assistant": conv.roles[3]}
-
         self.time = time.time()
-        conversation_history = self.conversation_history
-
-        if tools != []:
-            functions = [tool['function'] for tool in tools]
-
-
-        prompt = ''
-        for message in conversation_history:
-            role = roles[message['role']]
-            content = message['content']
-            if role == "System" and tools != []:
-                content = process_system_message(content, functions=functions)
-            prompt += f"{role}: {content}\n"
-        prompt += "Assistant:\n"
-        if tools != []:
-            predictions = self.prediction(prompt)
-        else:
-            predictions = self.prediction(prompt)
+        functions = [tool['function'] for tool in tools]
+        prompt = self.prompts.build(self.conversation_history, functions)
+        predictions = self.prediction(prompt)
 
-        decoded_token_len = len(self.tokenizer(predictions))
+        decoded_token_len = self.prompts.prompt_tokens() + len(self.tokenizer(predictions).input_ids)
         if process_id == 0:
             print(f"[process({process_id})]total tokens: {decoded_token_len}")
         thought, action, action_input = react_parser(predictions)
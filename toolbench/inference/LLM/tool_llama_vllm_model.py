@@ -1,21 +1,18 @@
 # import os
 
-from openai import OpenAI
 # import httpx
-from tenacity import retry, wait_random_exponential, stop_after_attempt
 from termcolor import colored
 import time
 # import json
 import traceback
-from toolbench.utils import process_system_message
-from toolbench.model.model_adapter import get_conversation_template
+from toolbench import client_pool
 from toolbench.inference.utils import react_parser
+from toolbench.inference.LLM.streaming import react_stream
+from toolbench.inference.LLM.prompt_builder import prompt_builder
 import string, random, json
 
-@retry(wait=wait_random_exponential(min=1, max=40), stop=stop_after_attempt(3))
-def completion_request(key, base_url, prompt,
-                        model="ToolBench/ToolLLaMA-2-7b-v2", process_id=0, **args):
-    json_data = {
+def build_request(prompt, model="ToolBench/ToolLLaMA-2-7b-v2", **args):
+    return {
         "model": model,
         "prompt": prompt,
         "temperature": 0,
@@ -28,19 +25,63 @@ def completion_request(key, base_url, prompt,
         **args
     }
 
+
+def completion_request(key, base_url, prompt,
+                        model="ToolBench/ToolLLaMA-2-7b-v2", process_id=0, **args):
+    json_data = build_request(prompt, model=model, **args)
+
     try:
-        client = OpenAI(base_url=base_url, api_key=key)
-        vllm_response = client.completions.create(**json_data)
+        vllm_response = client_pool.request(base_url, key, lambda client: client.completions.create(**json_data))
         json_data = vllm_response.dict()
         return json_data
 
     except Exception as e:
         print("Unable to generate ChatCompletion response")
         traceback.print_exc()
-        import pdb;  pdb.set_trace()
+        return {"error": str(e), "total_tokens": 0}
+
+
+def stream_completion_request(key, base_url, prompt,
+                              model="ToolBench/ToolLLaMA-2-7b-v2", process_id=0, on_tool_call=None, **args):
+    '''
+    Same answer as completion_request, read as a stream: the ReAct call is given to on_tool_call as soon as its
+    Action Input is complete, and the generation is cancelled when the call is Finish.
+    '''
+    json_data = build_request(prompt, model=model, **args)
+    json_data.update({"stream": True, "stream_options": {"include_usage": True}})
+
+    def read_stream(client):
+        # a retried request starts over, early_tool_calls does not send a call index twice
+        stream = client.completions.create(**json_data)
+        react = react_stream(on_tool_call)
+        usage = None
+        chunk_count = 0
+        for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage.dict()
+            if not chunk.choices:
+                continue
+            chunk_count += 1
+            if react.feed(chunk.choices[0].text):
+                stream.close()
+                break
+        if usage is None:
+            # cancelled before the usage chunk, a chunk is about one token
+            usage = {"total_tokens": chunk_count}
+        return {"choices": [{"text": react.text}], "usage": usage}
+
+    try:
+        return client_pool.request(base_url, key, read_stream)
+
+    except Exception as e:
+        print("Unable to generate ChatCompletion response")
+        traceback.print_exc()
         return {"error": str(e), "total_tokens": 0}
 
 class ToolLLaMA_vllm:
+    # parse accepts on_tool_call, see LLM/streaming.py
+    supports_tool_call_stream = True
+
     def __init__(
             self, 
             model="ToolBench/ToolLLaMA-2-7b-v2", 
@@ -55,6 +96,7 @@ class ToolLLaMA_vllm:
         self.base_url = base_url
         self.time = time.time()
         self.TRY_TIME = 6
+        self.prompts = prompt_builder(self.template)
 
     def add_message(self, message):
         self.conversation_history.append(message)
@@ -90,31 +132,22 @@ class ToolLLaMA_vllm:
             )
         print("end_print" + "*" * 50)
 
-    def parse(self, tools, process_id, **args):
-        conv = get_conversation_template(self.template)
-        if self.template == "tool-llama":
-            roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
-        elif self.template == "tool-llama-single-round" or self.template == "tool-llama-multi-rounds":
-            roles = {"system": conv.roles[0], "user": conv.roles[1], "tool": conv.roles[2], "assistant": conv.roles[3]}
-
+    def parse(self, tools, process_id, on_tool_call=None, **args):
+        '''
+        on_tool_call(index, name, arguments): stream the answer and call it as soon as the Action Input is complete
+        '''
         self.time = time.time()
-        if tools != []:
-            functions = [tool['function'] for tool in tools]
-        conversation_history = self.conversation_history
+        functions = [tool['function'] for tool in tools]
+        # the same prompt for all the tries
+        prompt = self.prompts.build(self.conversation_history, functions)
+        request = completion_request
+        if on_tool_call is not None:
+            request = stream_completion_request
+            args["on_tool_call"] = on_tool_call
         for _ in range(self.TRY_TIME):
             if _ != 0:
-                time.sleep(15)
-            prompt = ''
-            for message in conversation_history:
-                role = roles[message['role']]
-                content = message['content']
-                if role == "System" and tools != []:
-                    content = process_system_message(content, functions)
-                # if role == "Assistant":
-                #     content = react_deparser(message['content'], message['tool_calls'][0]['function']["name"], message['tool_calls'][0]['function']['arguments']) #debug
-                prompt += f"{role}: {content}\n"
-            prompt += "Assistant:\n"
-            response = completion_request(self.openai_key, self.base_url, prompt,
+                time.sleep(client_pool.backoff_delay(_))
+            response = request(self.openai_key, self.base_url, prompt,
                                           model=self.model, process_id=process_id, **args)
             # import pdb; pdb.set_trace()
 
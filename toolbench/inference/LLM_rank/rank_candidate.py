@@ -3,26 +3,86 @@ Evaluate the score of a query corresponding to different candidates
 '''
 
 from Prompts.rank_prompts import LLM_PAIRWISE_RANK_SUBFIX_SYSTEM_PROMPT, LLM_PAIRWISE_RANK_USER_PROMPT
+import copy
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from Tree.Tree import tree_node
+from utils import softmax_bias
+
+
+class rank_memo:
+    '''
+    Comparisons and trace strings of one search, so a pair of candidates is never sent to the llm twice.
+    Candidates are tree nodes, which live as long as the search.
+    '''
+    def __init__(self):
+        self.comparisons = {}
+        self.trices = {}
+        self.lock = threading.Lock()
+
+    def get(self, cand1, cand2):
+        with self.lock:
+            if (id(cand1), id(cand2)) in self.comparisons:
+                return self.comparisons[(id(cand1), id(cand2))]
+            if (id(cand2), id(cand1)) in self.comparisons:
+                return -self.comparisons[(id(cand2), id(cand1))]
+        return None
+
+    def put(self, cand1, cand2, result):
+        with self.lock:
+            self.comparisons[(id(cand1), id(cand2))] = result
+
+    def trice(self, node, end_node):
+        key = (id(node), id(end_node))
+        with self.lock:
+            if key in self.trices:
+                return self.trices[key]
+        trice = node.get_former_trice_from_this_node(end_node=end_node)
+        with self.lock:
+            self.trices[key] = trice
+        return trice
+
+
+def run_concurrently(llm_interface, LLM_rank_args, jobs):
+    '''
+    jobs: list of (func, args), each called as func(llm, LLM_rank_args, *args).
+    With LLM_rank_args["workers"] > 1 they run in threads, each on its own shallow copy of the llm; the jobs
+    themselves then run their inner comparisons one after another, so at most "workers" llm calls are in flight.
+    '''
+    workers = LLM_rank_args.get("workers", 1)
+    if workers <= 1 or len(jobs) <= 1:
+        return [func(llm_interface, LLM_rank_args, *args) for func, args in jobs]
+    inner_args = dict(LLM_rank_args, workers=1)
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = [executor.submit(func, copy.copy(llm_interface), inner_args, *args) for func, args in jobs]
+        return [future.result() for future in futures]
 
 
 def rank2symmetry(llm_interface, LLM_rank_args, cand1,cand2):
     '''
     Use llm to compare the height, due to the sequence, you need to compare each of the two in the front
     '''
+    memo = LLM_rank_args.get("memo")
+    if memo is not None:
+        cached = memo.get(cand1, cand2)
+        if cached is not None:
+            return cached, 0, 0
     single_rank_func = LLM_rank_args["rank_func"]
     score = [0,0]
-    bigger1,query_count1, total_tokens1 = single_rank_func(llm_interface, LLM_rank_args, cand1,cand2)
+    (bigger1,query_count1, total_tokens1), (bigger2,query_count2, total_tokens2) = run_concurrently(
+        llm_interface, LLM_rank_args, [(single_rank_func, (cand1, cand2)), (single_rank_func, (cand2, cand1))])
     score[1 - bigger1] += 1
-    bigger2,query_count2, total_tokens2 = single_rank_func(llm_interface, LLM_rank_args, cand2,cand1)
     score[bigger2] += 1
     if score[0] > score[1]:
-        return 1 , query_count1 + query_count2, total_tokens1 + total_tokens2
+        result = 1
     elif score[0] < score[1]:
-        return -1, query_count1 + query_count2, total_tokens1 + total_tokens2
+        result = -1
     else:
-        return 0, query_count1 + query_count2, total_tokens1 + total_tokens2
+        result = 0
+    if memo is not None:
+        memo.put(cand1, cand2, result)
+    return result, query_count1 + query_count2, total_tokens1 + total_tokens2
 
 
 
@@ -32,9 +92,15 @@ def rank2_subfix(llm_interface,LLM_rank_args, cand1,cand2):
     '''
     anscestor_interesction = tree_node.find_ancestor_intersection(cand1,cand2)
     assert anscestor_interesction != None
-    intersect_trice = anscestor_interesction.get_former_trice_from_this_node(end_node=None)
-    trice_1 = cand1.get_former_trice_from_this_node(end_node=anscestor_interesction)
-    trice_2 = cand2.get_former_trice_from_this_node(end_node=anscestor_interesction)
+    memo = LLM_rank_args.get("memo")
+    if memo is not None:
+        intersect_trice = memo.trice(anscestor_interesction, None)
+        trice_1 = memo.trice(cand1, anscestor_interesction)
+        trice_2 = memo.trice(cand2, anscestor_interesction)
+    else:
+        intersect_trice = anscestor_interesction.get_former_trice_from_this_node(end_node=None)
+        trice_1 = cand1.get_former_trice_from_this_node(end_node=anscestor_interesction)
+        trice_2 = cand2.get_former_trice_from_this_node(end_node=anscestor_interesction)
 
     system_message = LLM_PAIRWISE_RANK_SUBFIX_SYSTEM_PROMPT
     system_message = system_message.replace("{task_description}", LLM_rank_args["task_description"])
@@ -57,21 +123,102 @@ def sum_based_rankn(llm_interface,LLM_rank_args, candidates):
     total_querys = 0
     total_tokens = 0
     scores = [0]*len(candidates)
-    for i in range(len(candidates)-1):
-        for j in range(i+1,len(candidates)):
-            pairwise_rank,query_count,rank2_tokens = rank2symmetry(llm_interface,LLM_rank_args, candidates[i],candidates[j])
+    pairs = [(i, j) for i in range(len(candidates)-1) for j in range(i+1,len(candidates))]
+    results = run_concurrently(llm_interface, LLM_rank_args,
+                               [(rank2symmetry, (candidates[i], candidates[j])) for i, j in pairs])
+    for (i, j), (pairwise_rank,query_count,rank2_tokens) in zip(pairs, results):
+        total_querys += query_count
+        total_tokens += rank2_tokens
+        if pairwise_rank > 0:
+            scores[i] += 1
+        elif pairwise_rank < 0:
+            scores[j] += 1
+        else:
+            scores[i] += 0.5
+            scores[j] += 0.5
+    return scores, total_querys, total_tokens
+
+
+def tournament_rankn(llm_interface,LLM_rank_args, candidates):
+    '''
+    Merge sort with rank2symmetry as comparator, O(n log n) comparisons instead of n(n-1)/2.
+    The merges of one level are independent and run concurrently. Score = number of candidates ranked below.
+    '''
+    usage = [0, 0]
+
+    def merge(llm, LLM_rank_args, left, right):
+        merged = []
+        query_count, tokens = 0, 0
+        while left and right:
+            pairwise_rank, rank_querys, rank_tokens = rank2symmetry(llm, LLM_rank_args, candidates[left[0]], candidates[right[0]])
+            query_count += rank_querys
+            tokens += rank_tokens
+            if pairwise_rank >= 0:  # ties keep the former order
+                merged.append(left.pop(0))
+            else:
+                merged.append(right.pop(0))
+        return merged + left + right, query_count, tokens
+
+    runs = [[i] for i in range(len(candidates))]
+    while len(runs) > 1:
+        jobs = [(merge, (runs[k], runs[k + 1])) for k in range(0, len(runs) - 1, 2)]
+        results = run_concurrently(llm_interface, LLM_rank_args, jobs)
+        next_runs = []
+        for merged, query_count, tokens in results:
+            next_runs.append(merged)
+            usage[0] += query_count
+            usage[1] += tokens
+        if len(runs) % 2 == 1:
+            next_runs.append(runs[-1])
+        runs = next_runs
+
+    scores = [0]*len(candidates)
+    for position, index in enumerate(runs[0] if runs else []):
+        scores[index] = len(candidates) - 1 - position
+    return scores, usage[0], usage[1]
+
+
+def elo_rankn(llm_interface,LLM_rank_args, candidates, rounds=None, k_factor=32):
+    '''
+    Swiss-system rounds: candidates with close Elo play each other, ceil(log2 n) rounds of n/2 concurrent matches.
+    The Elo field of the nodes is updated in place, so candidates keep their rating between rankings.
+    Score = Elo.
+    '''
+    total_querys = 0
+    total_tokens = 0
+    n = len(candidates)
+    if rounds is None:
+        rounds = max(1, (n - 1).bit_length())
+    played = set()
+    for _ in range(rounds):
+        order = sorted(range(n), key=lambda i: candidates[i].Elo, reverse=True)
+        pairs = []
+        while len(order) > 1:
+            i = order.pop(0)
+            # the closest rated candidate not played yet, or the closest one if all were played
+            j = next((j for j in order if (min(i, j), max(i, j)) not in played), order[0])
+            order.remove(j)
+            pairs.append((i, j))
+            played.add((min(i, j), max(i, j)))
+        results = run_concurrently(llm_interface, LLM_rank_args,
+                                   [(rank2symmetry, (candidates[i], candidates[j])) for i, j in pairs])
+        for (i, j), (pairwise_rank,query_count,rank2_tokens) in zip(pairs, results):
             total_querys += query_count
             total_tokens += rank2_tokens
-            if pairwise_rank > 0:
-                scores[i] += 1
-            elif pairwise_rank < 0:
-                scores[j] += 1
-            else:
-                scores[i] += 0.5
-                scores[j] += 0.5
+            expected_i, expected_j = softmax_bias([candidates[i].Elo, candidates[j].Elo])
+            actual_i = {1: 1.0, 0: 0.5, -1: 0.0}[pairwise_rank]
+            candidates[i].Elo = float(candidates[i].Elo + k_factor * (actual_i - expected_i))
+            candidates[j].Elo = float(candidates[j].Elo + k_factor * ((1.0 - actual_i) - expected_j))
+    scores = [candidate.Elo for candidate in candidates]
     return scores, total_querys, total_tokens
 
 
+RANK_STRATEGIES = {
+    "sum": sum_based_rankn,
+    "tournament": tournament_rankn,
+    "elo": elo_rankn,
+}
+
 
 if __name__ ==  "__main__":
     random.seed(42)
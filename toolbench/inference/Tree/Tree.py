@@ -1,6 +1,5 @@
 from termcolor import colored
 import numpy as np
-from copy import deepcopy
 from utils import softmax_bias
 import math
 
@@ -20,7 +19,62 @@ class my_tree:
         return js_obj
 
 
+class message_history:
+    """Persistent openai-message list of a tree node.
+
+    A child only stores the messages appended after it was forked, plus a link to its parent and the parent's
+    length at fork time, so the system prompt and the common prefix are held once for the whole tree. Messages
+    appended to the parent later on are not seen by the child, like with the former deepcopy. The full list is
+    built on the first read and cached on the node.
+    """
+
+    __slots__ = ("parent", "base_len", "delta", "_flat")
+
+    def __init__(self, messages=None, parent=None, base_len=0):
+        self.parent = parent
+        self.base_len = base_len
+        self.delta = list(messages) if messages is not None else []
+        self._flat = None
+
+    def fork(self):
+        return message_history(parent=self, base_len=len(self))
+
+    def append(self, message):
+        self.delta.append(message)
+        if self._flat is not None:
+            self._flat.append(message)
+
+    def to_list(self):
+        '''
+        The full message list, shared with the cache: do not modify it, append to the history instead
+        '''
+        if self._flat is None:
+            chain = []
+            node, limit = self, len(self)
+            while node is not None and node._flat is None:
+                chain.append((node, limit))
+                node, limit = node.parent, node.base_len
+            flat = node._flat[:limit] if node is not None else []
+            for history, history_limit in reversed(chain):
+                flat.extend(history.delta[:history_limit - history.base_len])
+            self._flat = flat
+        return self._flat
+
+    def __len__(self):
+        return self.base_len + len(self.delta)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        return self.to_list()[index]
+
+
 class tree_node:
+    # nodes are created by the thousand in wide searches, keep them small
+    __slots__ = ("is_terminal", "pruned", "finished", "node_type", "description", "observation", "observation_code",
+                 "children", "_father", "io_state", "expand_num", "Elo", "prior_score", "messages",
+                 "depth", "size", "height", "jumps")
 
     def __init__(self):
         self.is_terminal = False
@@ -33,6 +87,14 @@ class tree_node:
         self.observation_code = None
         self.children = []
 
+        # bookkeeping maintained by the father setter:
+        # depth of this node, size (node count) and height (max depth, leaf=1) of its subtree,
+        # jumps[k] is the 2^k-th ancestor
+        self.depth = 0
+        self.size = 1
+        self.height = 1
+        self.jumps = []
+        self._father = None
         self.father = None
 
 
@@ -44,9 +106,39 @@ class tree_node:
 
 
         self.Elo = 1000.0
+        self.prior_score = 0.0
 
         # openai-messages of this node
-        self.messages = []
+        self.messages = message_history()
+
+    @property
+    def father(self):
+        return self._father
+
+    @father.setter
+    def father(self, father):
+        '''
+        A node is attached once, right after its creation, so depth and ancestor tables are fixed from then on
+        '''
+        if father is self._father:
+            return
+        assert self._father is None, "tree_node can not be moved to another father"
+        self._father = father
+        if father is None:
+            return
+        self.depth = father.depth + 1
+        jumps = [father]
+        while len(jumps) <= len(jumps[-1].jumps):
+            jumps.append(jumps[-1].jumps[len(jumps) - 1])
+        self.jumps = jumps
+        height = self.height + 1
+        node = father
+        while node is not None:
+            node.size += self.size
+            if height > node.height:
+                node.height = height
+            height += 1
+            node = node._father
 
     def compute_weight(self):
         '''
@@ -58,24 +150,16 @@ class tree_node:
         '''
         maximum depth of subtrees including self
         '''
-        max_depth = 0
-        for child in self.children:
-            max_depth = max(max_depth,child.get_max_depth())
-        return max_depth + 1
+        return self.height
 
     def get_depth(self):
-        if self.father == None:
-            return 0
-        return self.father.get_depth() + 1
+        return self.depth
 
     def get_size(self):
         '''
         subtree, including itself
         '''
-        size = 1
-        for child in self.children:
-            size += child.get_size()
-        return size
+        return self.size
     
     def prune(self):
         '''
@@ -100,18 +184,27 @@ class tree_node:
     @classmethod
     def find_ancestor_intersection(cls, node1, node2):
         '''
-        find the first common ancestor
+        find the first common ancestor, in O(log depth) with the jump tables
         '''
         if node1 == None or node2 == None:
             return None
-        if node1 == node2:
+        if node1.depth < node2.depth:
+            node1, node2 = node2, node1
+        diff = node1.depth - node2.depth
+        k = 0
+        while diff:
+            if diff & 1:
+                node1 = node1.jumps[k]
+            diff >>= 1
+            k += 1
+        if node1 is node2:
             return node1
-        length1 = node1.get_depth()
-        length2 = node2.get_depth()
-        if length1 > length2:
-            return tree_node.find_ancestor_intersection(node1.father,node2)
-        else:
-            return tree_node.find_ancestor_intersection(node1, node2.father)
+        for k in range(len(node1.jumps) - 1, -1, -1):
+            if k < len(node1.jumps) and node1.jumps[k] is not node2.jumps[k]:
+                node1, node2 = node1.jumps[k], node2.jumps[k]
+        if node1._father is node2._father:
+            return node1._father
+        return None  # not in the same tree
 
     
 
@@ -153,13 +246,13 @@ class tree_node:
         result = []
         while now_node.father != None:
             if now_node.node_type == "Action Input":
-                use_messages = deepcopy(now_node.messages)
+                use_messages = list(now_node.messages)
                 while use_messages[-1]["role"] != "assistant":
                     use_messages = use_messages[:-1]
                 use_messages = sift_first_invalid_message(use_messages)
                 result = [use_messages] + result
             elif now_node.node_type == "Thought":
-                use_messages = deepcopy(now_node.messages)
+                use_messages = list(now_node.messages)
                 while use_messages[-1]["role"] == "user":
                     use_messages = use_messages[:-1]
                 use_messages = sift_first_invalid_message(use_messages)
@@ -55,10 +55,37 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument('--max_sequence_length', type=int,
                         help=CONFIG_DESCRIPTION["max_sequence_length"])
     parser.add_argument('--observ_compress_method', type=str,
-                        choices=["truncate", "filter", "random"],
+                        choices=["truncate", "filter", "random", "budget"],
                         help=CONFIG_DESCRIPTION["observ_compress_method"])
     parser.add_argument('--method', type=str,
                         help=CONFIG_DESCRIPTION["method"])
+    parser.add_argument('--expand_workers', type=int,
+                        help=CONFIG_DESCRIPTION["expand_workers"])
+    parser.add_argument('--rank_strategy', type=str,
+                        choices=["sum", "tournament", "elo"],
+                        help=CONFIG_DESCRIPTION["rank_strategy"])
+    parser.add_argument('--tool_call_workers', type=int,
+                        help=CONFIG_DESCRIPTION["tool_call_workers"])
+    parser.add_argument('--stream_tool_calls', action='store_true', default=None,
+                        help=CONFIG_DESCRIPTION["stream_tool_calls"])
+    parser.add_argument('--llm_max_concurrency', type=int,
+                        help=CONFIG_DESCRIPTION["llm_max_concurrency"])
+    parser.add_argument('--llm_max_retries', type=int,
+                        help=CONFIG_DESCRIPTION["llm_max_retries"])
+    parser.add_argument('--generation_batch_size', type=int,
+                        help=CONFIG_DESCRIPTION["generation_batch_size"])
+    parser.add_argument('--prefix_cache_mb', type=int,
+                        help=CONFIG_DESCRIPTION["prefix_cache_mb"])
+    parser.add_argument('--generation_cleanup_interval', type=int,
+                        help=CONFIG_DESCRIPTION["generation_cleanup_interval"])
+    parser.add_argument('--max_observation_tokens', type=int,
+                        help=CONFIG_DESCRIPTION["max_observation_tokens"])
+    parser.add_argument('--tool_executor_workers', type=int,
+                        help=CONFIG_DESCRIPTION["tool_executor_workers"])
+    parser.add_argument('--tool_timeout', type=float,
+                        help=CONFIG_DESCRIPTION["tool_timeout"])
+    parser.add_argument('--tool_memory_mb', type=int,
+                        help=CONFIG_DESCRIPTION["tool_memory_mb"])
 
     # Data Configuration
     parser.add_argument('--input_query_file', type=str,
@@ -81,12 +108,31 @@ def parse_arguments() -> argparse.Namespace:
                         help=CONFIG_DESCRIPTION["use_rapidapi_key"])
     parser.add_argument('--api_customization', action="store_true",
                         help=CONFIG_DESCRIPTION["api_customization"])
+    parser.add_argument('--validate_tool_input', action='store_true', default=None,
+                        help=CONFIG_DESCRIPTION["validate_tool_input"])
+    parser.add_argument('--service_rate_limit', type=int,
+                        help=CONFIG_DESCRIPTION["service_rate_limit"])
+    parser.add_argument('--cassette_mode', type=str,
+                        choices=["record", "replay", "read-through"],
+                        help=CONFIG_DESCRIPTION["cassette_mode"])
+    parser.add_argument('--cassette_path', type=str,
+                        help=CONFIG_DESCRIPTION["cassette_path"])
+    parser.add_argument('--cassette_max_bytes', type=int,
+                        help=CONFIG_DESCRIPTION["cassette_max_bytes"])
+
+    # Execution Configuration
+    parser.add_argument('--workers', type=int,
+                        help=CONFIG_DESCRIPTION["workers"])
+    parser.add_argument('--shard', type=str,
+                        help=CONFIG_DESCRIPTION["shard"])
 
     # Other Configuration
     parser.add_argument('--device', type=str,
                         help=CONFIG_DESCRIPTION["device"])
     parser.add_argument('--attack', type=str,
                         help=CONFIG_DESCRIPTION["attack"])
+    parser.add_argument('--attack_seed', type=int,
+                        help=CONFIG_DESCRIPTION["attack_seed"])
     parser.add_argument('--log_level', type=str, default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help='Logging level')
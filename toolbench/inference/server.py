@@ -1,8 +1,11 @@
 from pydantic import BaseModel
 import json
-import os
+import importlib
+import threading
 from typing import Union
 from toolbench.utils import standardize, change_name
+from toolbench.inference.Downstream_tasks.observation_budget import compress_response, DEFAULT_MAX_TOKENS
+from toolbench.inference.Downstream_tasks.response_schema import get_response_schema_index
 import random
 
 
@@ -24,12 +27,28 @@ def prepare_tool_name_and_url(tools_root, info):
     api_name = change_name(standardize(info.api_name)).split(f"_for_{tool_name}")[0]
     if not tool_name.endswith(f"_for_{standard_category}"):
         tool_name = standardize(info.tool_name)
-        code_string = f"""from {tools_root}.{standard_category}.{tool_name}.api import {api_name}"""
+        module_name = f"{tools_root}.{standard_category}.{tool_name}.api"
         tool_name += f"_for_{standard_category}"
     else:
         tmp_tool_name = standardize(tool_name.replace(f"_for_{standard_category}", ""))
-        code_string = f"""from {tools_root}.{standard_category}.{tmp_tool_name}.api import {api_name}"""
-    return tool_name, standard_category, api_name, code_string
+        module_name = f"{tools_root}.{standard_category}.{tmp_tool_name}.api"
+    return tool_name, standard_category, api_name, module_name
+
+
+# (module name, api name) -> the api function, each tool module is imported once per process
+_tool_functions = {}
+_tool_functions_lock = threading.Lock()
+
+
+def get_tool_function(module_name, api_name):
+    key = (module_name, api_name)
+    function = _tool_functions.get(key)
+    if function is None:
+        # import errors are raised to the caller, and not cached
+        function = getattr(importlib.import_module(module_name), api_name)
+        with _tool_functions_lock:
+            _tool_functions[key] = function
+    return function
 
 def process_error(response):
     save_cache_flag = False
@@ -76,66 +95,52 @@ def process_error(response):
         return_dict = {"error": "", "response": response}
     return return_dict, save_cache_flag, switch_flag
 
-def run(toolbench_code_string, toolbench_api_name, toolbench_input_params_str):
+def run(module_name, api_name, tool_input):
     # get observation
     success_flag = False
     switch_flag = False
     save_cache = False
-    exec(toolbench_code_string)
+    function = get_tool_function(module_name, api_name)
     try:
-        eval_func_str = f"{toolbench_api_name}({toolbench_input_params_str})"
-        new_func = eval(eval_func_str)
-        response, save_cache, switch_flag = process_error(new_func)
+        response, save_cache, switch_flag = process_error(function(**tool_input))
         success_flag = True
     except Exception as e:
-        response = {"error": f"Function executing {toolbench_code_string} error...\n{e}", "response": ""}
+        response = {"error": f"Function executing from {module_name} import {api_name} error...\n{e}", "response": ""}
         save_cache = False
     return success_flag, switch_flag, response, save_cache
 
 
-def dict_shorten(origin: dict, schema: dict):
-    for key, value in list(origin.items()):
-        if key not in schema:
-            del origin[key]
-        else:
-            if isinstance(value, dict):
-                dict_shorten(value, schema[key]) # schema[key] should be a dict
-            elif isinstance(value, list):
-                if value:
-                    if isinstance(value[0], dict):
-                        for item in value:
-                            dict_shorten(item, schema[key][0]) # schema[key] should be a list with only one dict element
-    return origin
-
-def observation_shorten(schema_root, response_dict, category, tool_name, api_name, strip_method):
-    print(random.random())
+def observation_shorten(schema_root, response_dict, category, tool_name, api_name, strip_method,
+                        max_tokens=DEFAULT_MAX_TOKENS):
+    if strip_method == "budget":
+        # valid json within max_tokens, see Downstream_tasks/observation_budget.py
+        return compress_response(response_dict["response"], max_tokens)
     if strip_method == "filter" or (strip_method == "random" and random.random() > 0.5):
         if isinstance(response_dict["response"], dict):
-            if os.path.exists(os.path.join(schema_root, category)):
-                if os.path.exists(os.path.join(schema_root, category, tool_name+".json")):
-                    schema_dicts = json.load(open(os.path.join(schema_root, category, tool_name+".json"), "r"))
-                    api_list = schema_dicts["api_list"]
-                    schema = None
-                    for schema_dict in api_list:
-                        schema_api_name = change_name(standardize(schema_dict["name"]))
-                        if schema_api_name == api_name and len(schema_dict["schema"]) > 0:
-                            schema = schema_dict["schema"]
-                            break
-                    if schema is not None:
-                        response_dict["response"] = dict_shorten(response_dict["response"], schema)
+            # the keys of the response examples of the api, see Downstream_tasks/response_schema.py
+            response_dict["response"] = get_response_schema_index(schema_root).shorten(
+                response_dict["response"], category, tool_name, api_name)
     return str(response_dict["response"])
 
 
+def shorten_response(schema_root, response_dict, category, tool_name, api_name, strip_method,
+                     max_tokens=DEFAULT_MAX_TOKENS):
+    '''
+    The response string the service sends back for response_dict
+    '''
+    observation = observation_shorten(schema_root, response_dict, category, tool_name, api_name, strip_method,
+                                      max_tokens=max_tokens)
+    if strip_method == "budget":
+        return observation
+    return str(observation)[:2048]
+
+
 def get_rapidapi_response(input_dict: dict, api_customization: bool=False, tools_root: str="data.toolenv.tools", schema_root: str="data/toolenv/response_examples"):
-    info = Info
-    info.category = input_dict['category']
-    info.tool_name = input_dict['tool_name']
-    info.api_name = input_dict['api_name']
-    info.tool_input = input_dict['tool_input']
-    info.strip = input_dict['strip']
+    info = Info(category=input_dict['category'], tool_name=input_dict['tool_name'], api_name=input_dict['api_name'],
+                tool_input=input_dict['tool_input'], strip=input_dict['strip'])
     rapidapi_key = input_dict['rapidapi_key']
 
-    tool_name, standard_category, api_name, code_string = prepare_tool_name_and_url(tools_root, info)
+    tool_name, standard_category, api_name, module_name = prepare_tool_name_and_url(tools_root, info)
     tool_input = info.tool_input
     
     strip_method = info.strip
@@ -150,18 +155,11 @@ def get_rapidapi_response(input_dict: dict, api_customization: bool=False, tools
             response_dict = {"error": f"Tool input parse error...\n", "response": ""}
             return response_dict
     
-    input_params_str = ""
-    if len(tool_input) > 0:
-        for key, value in tool_input.items():
-            if isinstance(value, str):
-                input_params_str += f'{key}="{value}", '
-            else:
-                input_params_str += f'{key}={value}, '
-    if not api_customization:
-        input_params_str += f"toolbench_rapidapi_key='{rapidapi_key}'"
-    success_flag, switch_flag, response_dict, save_cache = run(code_string, api_name, input_params_str)
-    observation = observation_shorten(schema_root, response_dict, standard_category, tool_name.replace(f"_for_{standard_category}", ""), api_name, strip_method)
-    result = str(observation)[:2048]
+    if not api_customization and isinstance(tool_input, dict):
+        tool_input = dict(tool_input, toolbench_rapidapi_key=rapidapi_key)
+    success_flag, switch_flag, response_dict, save_cache = run(module_name, api_name, tool_input)
+    result = shorten_response(schema_root, response_dict, standard_category, tool_name.replace(f"_for_{standard_category}", ""), api_name, strip_method,
+                              max_tokens=input_dict.get("max_observation_tokens", DEFAULT_MAX_TOKENS))
     return {"error": response_dict['error'], "response": result}
 
 
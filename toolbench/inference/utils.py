@@ -1,10 +1,12 @@
 import gc
 import abc
+import itertools
 import numpy as np
 import math
 from typing import Iterable
 import torch
 import re
+from toolbench.inference.LLM.streaming import react_stream
 from transformers.generation.logits_process import (
     LogitsProcessorList,
     RepetitionPenaltyLogitsProcessor,
@@ -25,7 +27,7 @@ CONFIG_DESCRIPTION = {
     "max_observation_length": "Maximum length of observations",
     "max_source_sequence_length": "Original maximum sequence length of the model",
     "max_sequence_length": "Extended maximum sequence length",
-    "observ_compress_method": "Method to compress observations (truncate, filter, random)",
+    "observ_compress_method": "Method to compress observations (truncate, filter, random, budget: valid json within max_observation_tokens)",
     "method": "Answer generation method (CoT@n, Reflexion@n, BFS, DFS, UCT_vote)",
     "input_query_file": "Path to input query file",
     "input_query_dir": "Directory containing input queries (optional)",
@@ -38,7 +40,28 @@ CONFIG_DESCRIPTION = {
     "attack": "Type of attack (if applicable)",
     "gt_data_file": "Path to ground truth data file",
     "service_url": "Service endpoint URL",
-    "cuda_device": "CUDA device ID"
+    "service_rate_limit": "Tool service calls per minute shared by all tasks of a process (0 for no limit)",
+    "cuda_device": "CUDA device ID",
+    "workers": "Number of worker processes running tasks in parallel (threads sharing one model when toolllama uses generation_batch_size > 1)",
+    "shard": "Only run the i-th of N shards of the query set, as i/N (optional)",
+    "cassette_mode": "Tool observation cassette: record, replay or read-through (optional)",
+    "cassette_path": "Path to the tool observation cassette file",
+    "cassette_max_bytes": "Size above which the cassette drops its oldest observations (optional)",
+    "attack_seed": "Seed of the D4 description shuffle, makes the D4 schemas deterministic and cacheable (optional)",
+    "validate_tool_input": "Answer unparsable tool inputs and missing required parameters locally, with the answer of server.py, instead of calling the tool service. Off by default: a /virtual service may answer them differently",
+    "expand_workers": "Number of concurrent llm calls of filtered DFS, when generating and ranking the children of a node (1 = one after another)",
+    "rank_strategy": "How filtered DFS orders the children of a node: sum (all pairs), tournament (merge sort) or elo (Swiss rounds)",
+    "tool_call_workers": "Number of tool calls of one assistant message sent concurrently (1 = one after another)",
+    "stream_tool_calls": "Stream the llm answer and send each tool call as soon as it is complete, cancelling the generation after Finish (chatgpt_function and ToolLLaMA_vllm)",
+    "llm_max_concurrency": "Maximum number of requests in flight to one LLM endpoint (base_url, key) per process",
+    "llm_max_retries": "Maximum number of retries of a failed LLM request, within the retry budget of its endpoint",
+    "generation_batch_size": "Maximum number of generations a local toolllama model decodes together (continuous batching, 1 = one at a time)",
+    "prefix_cache_mb": "Memory budget in MB of the prefix key/value cache of a local toolllama model, reused across the steps of a chain (0 = off)",
+    "generation_cleanup_interval": "Run gc and empty the cuda cache after every N-th generation of a local toolllama model (1 = after each, 0 = never)",
+    "max_observation_tokens": "Token budget of an observation with the budget compress method, counted with the backbone's tokenizer when it has one",
+    "tool_executor_workers": "Number of worker processes running the customized tools (use_rapidapi_key/api_customization) with deadlines, shared by the tasks of a process (0 = run them inline)",
+    "tool_timeout": "Deadline in seconds of a customized tool call in the tool executor, also its cpu cap (status 5 when missed)",
+    "tool_memory_mb": "Data segment (heap) cap in MB of a tool executor worker (0 = none)"
 }
 def change_name(name):
     change_list = ["from", "class", "return", "false", "true", "id", "and"]
@@ -110,12 +133,86 @@ def prepare_logits_processor(
         processor_list.append(TopKLogitsWarper(top_k))
     return processor_list
 
+class stop_checker:
+    '''
+    Detokenizes a generation token by token and tells when it should stop: at the first stop string, or, with
+    stop_on_action, once the json of "Action Input: " is closed. excess is the number of characters of the text
+    after the stop point.
+    '''
+
+    def __init__(self, tokenizer, stop_str=None, stop_on_action=False):
+        if stop_str is None:
+            stop_str = []
+        elif isinstance(stop_str, str):
+            stop_str = [stop_str]
+        elif not isinstance(stop_str, Iterable):
+            raise ValueError("Invalid stop field type.")
+        self.tokenizer = tokenizer
+        self.stop_str = [each_stop for each_stop in stop_str if each_stop]
+        self.max_stop_len = max([len(each_stop) for each_stop in self.stop_str], default=0)
+        self.action = react_stream() if stop_on_action else None
+        self.ids = []
+        # ids[prefix_offset:read_offset] is decoded again with the new tokens, so that pieces depending on the
+        # token before them (leading spaces) come out right
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+        self.stopped = False
+        self.excess = 0
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=True, spaces_between_special_tokens=False)
+
+    def add(self, token):
+        '''
+        Returns True once the generation should stop
+        '''
+        if self.stopped:
+            return True
+        self.ids.append(token)
+        prefix_text = self.decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            # no new character yet, or an incomplete utf-8 sequence
+            return False
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.ids)
+        start = len(self.text)
+        self.text += delta
+        end = len(self.text)
+        search_start = max(0, start - self.max_stop_len + 1)
+        for each_stop in self.stop_str:
+            pos = self.text.find(each_stop, search_start)
+            if pos != -1 and pos < end:
+                end = pos
+                self.stopped = True
+        if self.action is not None:
+            self.action.feed(delta)
+            if self.action.call_end != -1:
+                end = min(end, self.action.call_end)
+                self.stopped = True
+        self.excess = len(self.text) - end
+        return self.stopped
+
+    def cut(self, output):
+        return output[:len(output) - self.excess] if self.excess else output
+
+
+_generation_count = itertools.count(1)
+
+
 @torch.inference_mode()
 def generate_stream(
-    model, tokenizer, params, device, context_len=8192, stream_interval=2, force_generate=False
+    model, tokenizer, params, device, context_len=8192, stream_interval=2, force_generate=False, prefix_cache=None,
+    cleanup_interval=1
 ):
+    """
+    prefix_cache: a LLM.prefix_cache.prefix_kv_cache, the prompt then only prefills what follows the longest
+    prefix it already holds, and is kept for the next calls
+    params["stop_on_action"]: stop once the Action Input json of a ReAct answer is closed
+    cleanup_interval: run gc and empty the cuda cache after every cleanup_interval-th generation (0 = never)
+    """
     prompt = params["prompt"]
-    len_prompt = len(prompt)
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
     top_p = float(params.get("top_p", 1.0))
@@ -123,8 +220,8 @@ def generate_stream(
     max_new_tokens = int(params.get("max_new_tokens", 256))
     stop_str = params.get("stop", None)
     echo = bool(params.get("echo", True))
-    stop_token_ids = params.get("stop_token_ids", None) or []
-    stop_token_ids.append(tokenizer.eos_token_id)
+    stop_token_ids = set(params.get("stop_token_ids", None) or []) | {tokenizer.eos_token_id}
+    checker = stop_checker(tokenizer, stop_str, bool(params.get("stop_on_action", False)))
 
     logits_processor = prepare_logits_processor(
         temperature, repetition_penalty, top_p, top_k
@@ -152,6 +249,9 @@ def generate_stream(
         )
 
     past_key_values = out = None
+    # prompt and generated ids for the repetition penalty, filled in place rather than rebuilt at every token
+    penalty_ids = None
+    n_ids = len(output_ids)
     for i in range(max_new_tokens):
         if i == 0:
             if model.config.is_encoder_decoder:
@@ -161,6 +261,12 @@ def generate_stream(
                     use_cache=True,
                 )
                 logits = model.lm_head(out[0])
+            elif prefix_cache is not None:
+                reused, past_key_values = prefix_cache.lookup(input_ids)
+                out = model(torch.as_tensor([input_ids[reused:]], device=device), use_cache=True,
+                            past_key_values=past_key_values)
+                logits = out.logits
+                prefix_cache.insert(input_ids, out.past_key_values)
             else:
                 out = model(torch.as_tensor([input_ids], device=device), use_cache=True)
                 logits = out.logits
@@ -186,7 +292,10 @@ def generate_stream(
 
         if logits_processor:
             if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
+                if penalty_ids is None:
+                    penalty_ids = torch.empty((1, n_ids + max_new_tokens), dtype=torch.long, device=logits.device)
+                    penalty_ids[0, :n_ids] = torch.as_tensor(output_ids, device=logits.device)
+                tmp_output_ids = penalty_ids[:, :n_ids]
             else:
                 tmp_output_ids = None
             last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
@@ -204,41 +313,28 @@ def generate_stream(
             token = int(torch.multinomial(probs, num_samples=1))
 
         output_ids.append(token)
+        if penalty_ids is not None:
+            penalty_ids[0, n_ids] = token
+        n_ids += 1
 
-        if token in stop_token_ids:
-            stopped = True
-        else:
-            stopped = False
+        stopped = token in stop_token_ids or checker.add(token)
         if i == 0 and force_generate:
             stopped = False
         if i == max_new_tokens - 1 or stopped:
             if echo:
                 tmp_output_ids = output_ids
-                rfind_start = len_prompt
             else:
                 tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
 
             output = tokenizer.decode(
                 tmp_output_ids,
                 skip_special_tokens=True,
                 spaces_between_special_tokens=False,
             )
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                else:
-                    raise ValueError("Invalid stop field type.")
+            if checker.stopped:
+                # the stop string or what follows the action, found while decoding
+                output = checker.cut(output)
+                stopped = True
 
             yield {
                 "text": output,
@@ -273,8 +369,9 @@ def generate_stream(
 
     # clean
     del past_key_values, out
-    gc.collect()
-    torch.cuda.empty_cache()
+    if cleanup_interval and next(_generation_count) % cleanup_interval == 0:
+        gc.collect()
+        torch.cuda.empty_cache()
 
 # For IO presentation
 class ChatIO(abc.ABC):
@@ -0,0 +1,234 @@
+'''
+Virtual RapidAPI service, for offline runs, benchmarks and soak tests of the pipeline.
+
+qa_pipeline points SERVICE_URL at http://localhost:8080/virtual by default. This server takes the payloads
+rapidapi_wrapper._send posts, on /virtual and /rapidapi, and answers from a tool cassette first, then from the
+response example of the api in the response examples, shortened with the compress method of the payload like the
+real service shortens a real response. An api without an example answers "API not working error...".
+
+Latency, errors and a rate limit can be injected. An injected error is the answer the env maps to the matching
+_step status code: 5 holds the answer past the client timeout, 12 is an HTTP 500, 10 is the rate limit answer with
+a Retry-After the transport backs off by, the others are their error messages. The answer of an api is rendered
+once per (api, compress method), a request is then served from the cached bytes.
+
+    python toolbench/inference/virtual_server.py --port 8080 --workers 4 --cassette_path cassettes/tool_calls.bin
+
+The rate limit and the stats on GET /stats are per worker process.
+'''
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from toolbench.inference.server import Info, prepare_tool_name_and_url, shorten_response
+from toolbench.inference.Downstream_tasks.cassette import get_cassette, cassette_key
+from toolbench.inference.Downstream_tasks.response_schema import get_response_schema_index
+from toolbench.inference.Downstream_tasks.observation_budget import DEFAULT_MAX_TOKENS
+
+TOOLS_ROOT = "data.toolenv.tools"
+# status code -> the error of the answer rapidapi_wrapper._send maps to it
+INJECTED_ERRORS = {
+    6: "API not working error...",
+    7: "Unauthorized error...",
+    8: "Unsubscribed error...",
+    9: "Too many requests error...",
+    11: "Message error...",
+}
+# answered late (5) and with an HTTP 500 (12)
+INJECTED_CODES = tuple(INJECTED_ERRORS) + (5, 12)
+RATE_LIMIT_ERROR = "Rate limit per minute error..."
+# json of the virtual_service arguments, how the uvicorn workers get the settings of the command line
+CONFIG_ENV = "VIRTUAL_SERVER_CONFIG"
+JSON_TYPE = "application/json"
+
+
+def dump_answer(error, response):
+    return json.dumps({"error": error, "response": response}).encode("utf-8")
+
+
+class virtual_service:
+    def __init__(self, cassette_path=None, schema_root="data/toolenv/response_examples", latency_ms=0,
+                 latency_jitter_ms=0, error_rate=0.0, error_codes=INJECTED_CODES, timeout_seconds=20, rate_limit=0,
+                 seed=None, max_cached=100000):
+        '''
+        cassette_path: tool cassette answered from first, recorded by a cassette_mode record run
+        latency_ms, latency_jitter_ms: mean and standard deviation of the delay added to every answer
+        error_rate: share of the requests answered with an error, drawn from error_codes
+        timeout_seconds: how late an injected timeout (5) answers, past the 15s the env waits on /rapidapi
+        rate_limit: requests per minute before the rate limit answer (0 for none)
+        '''
+        unknown = [code for code in error_codes if code not in INJECTED_CODES]
+        if unknown:
+            raise ValueError(f"can not inject status codes {unknown}, only {list(INJECTED_CODES)}")
+        self.cassette = get_cassette(cassette_path) if cassette_path else None
+        self.schema_root = schema_root
+        self.schemas = get_response_schema_index(schema_root)
+        self.latency = latency_ms / 1000
+        self.latency_jitter = latency_jitter_ms / 1000
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.timeout_seconds = timeout_seconds
+        self.rng = random.Random(seed)
+        # (category, tool, api, strip, max tokens) as sent -> rendered answer
+        self.answers = {}
+        self.max_cached = max_cached
+        # token bucket of rate_limit a minute, the event loop is its only user
+        self.rate = rate_limit / 60 if rate_limit else None
+        self.capacity = max(1, rate_limit // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.stats = {"requests": 0, "cassette": 0, "examples": 0, "missing": 0, "injected": 0, "rate_limited": 0,
+                      "bad_requests": 0}
+
+    def take_token(self):
+        '''
+        0 when the request is within the rate limit, else the seconds until it would be
+        '''
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def render(self, category, tool_name, api_name, strip, max_tokens):
+        info = Info(category=category, tool_name=tool_name, api_name=api_name, tool_input="", strip=strip)
+        tool_name, standard_category, api_name, _ = prepare_tool_name_and_url(TOOLS_ROOT, info)
+        tool_name = tool_name.replace(f"_for_{standard_category}", "")
+        example = self.schemas.schema(standard_category, tool_name, api_name)
+        if example is None:
+            self.stats["missing"] += 1
+            return dump_answer(INJECTED_ERRORS[6], "")
+        self.stats["examples"] += 1
+        response = shorten_response(self.schema_root, {"error": "", "response": example}, standard_category,
+                                    tool_name, api_name, strip, max_tokens=max_tokens)
+        return dump_answer("", response)
+
+    def answer(self, payload):
+        '''
+        (http status, body) of the service for payload
+        '''
+        try:
+            category, tool_name, api_name = payload["category"], payload["tool_name"], payload["api_name"]
+            tool_input = payload.get("tool_input", "")
+            strip = payload.get("strip", "")
+            max_tokens = payload.get("max_observation_tokens", DEFAULT_MAX_TOKENS) if strip == "budget" else None
+            if not all(isinstance(value, str) for value in (category, tool_name, api_name, strip)):
+                raise TypeError("category, tool_name, api_name and strip must be strings")
+        except (KeyError, TypeError) as e:
+            self.stats["bad_requests"] += 1
+            return 400, dump_answer(f"request invalid, data error: {e!r}", "")
+        if self.cassette is not None:
+            recorded = self.cassette.get(cassette_key(category, tool_name, api_name, tool_input, strip, max_tokens))
+            if recorded is not None:
+                self.stats["cassette"] += 1
+                return 200, recorded[0].encode("utf-8")
+        if isinstance(tool_input, str) and tool_input != "":
+            try:
+                json.loads(tool_input)
+            except ValueError:
+                return 200, dump_answer("Tool input parse error...\n", "")
+        key = (category, tool_name, api_name, strip, max_tokens)
+        body = self.answers.get(key)
+        if body is None:
+            body = self.render(category, tool_name, api_name, strip, max_tokens)
+            # the random compress method draws again for every answer
+            if strip != "random":
+                if len(self.answers) >= self.max_cached:
+                    self.answers.clear()
+                self.answers[key] = body
+        return 200, body
+
+    async def handle(self, payload):
+        '''
+        (http status, body, headers) after the injected latency and errors
+        '''
+        self.stats["requests"] += 1
+        if self.latency or self.latency_jitter:
+            delay = self.rng.gauss(self.latency, self.latency_jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        wait = self.take_token()
+        if wait:
+            self.stats["rate_limited"] += 1
+            return 200, dump_answer(RATE_LIMIT_ERROR, ""), {"Retry-After": f"{wait:.3f}"}
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.stats["injected"] += 1
+            code = self.rng.choice(self.error_codes)
+            if code == 12:
+                return 500, dump_answer("Internal server error...", ""), {}
+            if code == 5:
+                await asyncio.sleep(self.timeout_seconds)
+            else:
+                return 200, dump_answer(INJECTED_ERRORS[code], ""), {}
+        status, body = self.answer(payload)
+        return status, body, {}
+
+
+def create_app(config=None):
+    '''
+    config: virtual_service arguments, read from the CONFIG_ENV variable when None
+    '''
+    if config is None:
+        config = json.loads(os.getenv(CONFIG_ENV, "{}"))
+    service = virtual_service(**config)
+    app = FastAPI()
+
+    async def call(request: Request):
+        try:
+            payload = json.loads(await request.body())
+        except ValueError as e:
+            service.stats["bad_requests"] += 1
+            return Response(dump_answer(f"request invalid, data error: {e!r}", ""), status_code=400,
+                            media_type=JSON_TYPE)
+        if not isinstance(payload, dict):
+            service.stats["bad_requests"] += 1
+            return Response(dump_answer("request invalid, data error: not an object", ""), status_code=400,
+                            media_type=JSON_TYPE)
+        status, body, headers = await service.handle(payload)
+        return Response(body, status_code=status, headers=headers, media_type=JSON_TYPE)
+
+    async def stats():
+        return dict(service.stats, pid=os.getpid(), cached=len(service.answers))
+
+    app.add_api_route("/virtual", call, methods=["POST"])
+    app.add_api_route("/rapidapi", call, methods=["POST"])
+    app.add_api_route("/stats", stats, methods=["GET"])
+    app.state.service = service
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Virtual RapidAPI service answering from cassettes and response "
+                                                 "examples")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument('--cassette_path', type=str, default=None, help="tool cassette answered from first")
+    parser.add_argument('--schema_root', type=str, default="data/toolenv/response_examples")
+    parser.add_argument('--latency_ms', type=float, default=0, help="mean delay added to every answer")
+    parser.add_argument('--latency_jitter_ms', type=float, default=0, help="standard deviation of the delay")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="share of the requests answered with an error")
+    parser.add_argument('--error_codes', type=int, nargs="+", default=list(INJECTED_CODES),
+                        help="status codes the injected errors are drawn from")
+    parser.add_argument('--timeout_seconds', type=float, default=20, help="delay of an injected timeout (5)")
+    parser.add_argument('--rate_limit', type=int, default=0, help="requests per minute and worker, 0 for none")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("host", "port", "workers")}
+    # checked here, before the workers start
+    virtual_service(**dict(config, cassette_path=None))
+    os.environ[CONFIG_ENV] = json.dumps(config)
+    uvicorn.run("toolbench.inference.virtual_server:create_app", factory=True, host=args.host, port=args.port,
+                workers=args.workers, access_log=False, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,8 @@ from typing import List,Dict
 import requests
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
-from openai import OpenAI
 import random
+from toolbench import client_pool
 
 __registered_evaluators__ = {}
 
@@ -53,8 +53,8 @@ class OpenaiPoolRequest:
         # print(len(self.pool))
         api_key = item['api_key']
         api_base = item.get('api_base', None)
-        client = OpenAI(api_key=api_key,base_url=api_base)
-        response = client.chat.completions.create(messages=messages,**kwargs)
+        response = client_pool.request(api_base, api_key,
+                                       lambda client: client.chat.completions.create(messages=messages,**kwargs))
         return response
     
     def __call__(self,messages,**kwargs):